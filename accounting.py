@@ -0,0 +1,217 @@
+from dataclasses import dataclass, field
+import logging
+import threading
+
+import config
+from tokens import count_message_tokens
+
+logger = logging.getLogger()
+
+# USD per 1K (prompt, completion) tokens. Dated snapshots are priced by their
+# longest matching prefix, so "gpt-3.5-turbo-0613" uses the "gpt-3.5-turbo" row.
+PRICING_PER_1K_TOKENS = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+DEFAULT_PRICING_MODEL = "gpt-3.5-turbo"
+
+# What each call was for, in the order the accountant lists them
+STAGES = [
+    "starter",
+    "conversation",
+    "correction",
+    "tuples",
+    "explanation",
+    "combined",
+    "summary",
+    "other",
+]
+
+
+class BudgetExceeded(Exception):
+    """A request was refused before being sent because it would exceed a budget."""
+
+
+def pricing(model: str) -> tuple[float, float]:
+    matches = [prefix for prefix in PRICING_PER_1K_TOKENS if model.startswith(prefix)]
+    if not matches:
+        logger.warning(f"No pricing for `{model}`, using `{DEFAULT_PRICING_MODEL}`")
+        return PRICING_PER_1K_TOKENS[DEFAULT_PRICING_MODEL]
+    return PRICING_PER_1K_TOKENS[max(matches, key=len)]
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = pricing(model)
+    return (prompt_price * prompt_tokens + completion_price * completion_tokens) / 1000
+
+
+@dataclass
+class CallRecord:
+    """
+    One request made (or served from the cache, or shared with another caller)
+    on behalf of a session.
+    """
+
+    stage: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    wall_time: float = 0.0
+    queue_time: float = 0.0
+    cached: bool = False
+    # Shared an identical request already in flight for another caller
+    coalesced: bool = False
+    # Streamed responses carry no usage, so their tokens are counted locally
+    estimated: bool = False
+
+    @property
+    def cost(self) -> float:
+        return cost(self.model, self.prompt_tokens, self.completion_tokens)
+
+
+@dataclass
+class StageTotals:
+    calls: int = 0
+    cached_calls: int = 0
+    coalesced_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    wall_time: float = 0.0
+    queue_time: float = 0.0
+
+    def add(self, record: CallRecord) -> None:
+        self.calls += 1
+        self.cached_calls += record.cached
+        self.coalesced_calls += record.coalesced
+        self.prompt_tokens += record.prompt_tokens
+        self.completion_tokens += record.completion_tokens
+        self.cost += record.cost
+        self.wall_time += record.wall_time
+        self.queue_time += record.queue_time
+
+
+@dataclass
+class Ledger:
+    """Thread-safe record of every call a session has made."""
+
+    records: list[CallRecord] = field(default_factory=list)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def record(self, record: CallRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def total(self) -> StageTotals:
+        totals = StageTotals()
+        with self._lock:
+            for record in self.records:
+                totals.add(record)
+        return totals
+
+    def by_stage(self) -> dict[str, StageTotals]:
+        totals: dict[str, StageTotals] = {}
+        with self._lock:
+            for record in self.records:
+                totals.setdefault(record.stage, StageTotals()).add(record)
+        return {
+            stage: totals[stage]
+            for stage in sorted(
+                totals, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)
+            )
+        }
+
+    def cost(self) -> float:
+        with self._lock:
+            return sum(record.cost for record in self.records)
+
+
+class Budget:
+    """
+    Checks each request against a prompt-token limit and the session's spending
+    limit before it is sent, using a local token count. Prompts over the token
+    limit are either rejected or trimmed by dropping the oldest conversation
+    messages; leading system messages and the final message are always kept.
+    A limit of 0 disables that check.
+    """
+
+    def __init__(
+        self,
+        max_prompt_tokens: int = config.PROMPT_TOKEN_BUDGET,
+        action: str = config.PROMPT_BUDGET_ACTION,
+        session_limit_usd: float = config.SESSION_BUDGET_USD,
+    ):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.action = action
+        self.session_limit_usd = session_limit_usd
+
+    def apply(
+        self,
+        ledger: Ledger,
+        model: str,
+        messages: list[dict],
+        extra_prompt_tokens: int = 0,
+        completion_tokens: int = config.SCHEDULER_COMPLETION_TOKENS_ESTIMATE,
+    ) -> tuple[list[dict], int]:
+        """
+        Return the messages to send, possibly trimmed, with their estimated prompt
+        tokens. `extra_prompt_tokens` covers anything sent besides the messages,
+        such as function definitions. Raises `BudgetExceeded` if it cannot comply.
+        """
+        prompt_tokens = count_message_tokens(messages, model) + extra_prompt_tokens
+        if self.max_prompt_tokens and prompt_tokens > self.max_prompt_tokens:
+            if self.action != "trim":
+                raise BudgetExceeded(
+                    f"Prompt of ~{prompt_tokens} tokens exceeds the limit of {self.max_prompt_tokens}"
+                )
+            messages, prompt_tokens = self._trim(
+                model, messages, extra_prompt_tokens, prompt_tokens
+            )
+        if self.session_limit_usd:
+            spent = ledger.cost()
+            if (
+                spent + cost(model, prompt_tokens, completion_tokens)
+                > self.session_limit_usd
+            ):
+                raise BudgetExceeded(
+                    f"This conversation has used ${spent:.3f} of its ${self.session_limit_usd:.2f} budget"
+                )
+        return messages, prompt_tokens
+
+    def _trim(
+        self,
+        model: str,
+        messages: list[dict],
+        extra_prompt_tokens: int,
+        prompt_tokens: int,
+    ) -> tuple[list[dict], int]:
+        keep_start = 0
+        while (
+            keep_start < len(messages) - 1 and messages[keep_start]["role"] == "system"
+        ):
+            keep_start += 1
+        head, middle, tail = (
+            messages[:keep_start],
+            messages[keep_start:-1],
+            messages[-1:],
+        )
+        while middle and prompt_tokens > self.max_prompt_tokens:
+            middle = middle[1:]
+            prompt_tokens = (
+                count_message_tokens(head + middle + tail, model) + extra_prompt_tokens
+            )
+        if prompt_tokens > self.max_prompt_tokens:
+            raise BudgetExceeded(
+                f"Prompt of ~{prompt_tokens} tokens exceeds the limit of {self.max_prompt_tokens} even after trimming"
+            )
+        logger.info(
+            f"Trimmed {len(messages) - len(head) - len(middle) - len(tail)} messages to fit the prompt budget"
+        )
+        return head + middle + tail, prompt_tokens
+
+
+budget = Budget()
@@ -0,0 +1,91 @@
+from difflib import SequenceMatcher
+import re
+import string
+
+from unidecode import unidecode
+
+from utils import normalise_for_comparison
+
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation + "¿¡")
+
+# Unchanged words between two edits that still get merged into one phrase
+MAX_GAP = 1
+
+
+def _key(token: str) -> str:
+    return normalise_for_comparison(token).translate(_PUNCTUATION_TABLE)
+
+
+def _is_accent_change(input_token: str, corrected_token: str) -> bool:
+    x = input_token.translate(_PUNCTUATION_TABLE).lower()
+    y = corrected_token.translate(_PUNCTUATION_TABLE).lower()
+    return x != y and unidecode(x) == unidecode(y)
+
+
+def pair_key(input_phrase: str, corrected_phrase: str) -> tuple[str, str]:
+    """Key under which two correction tuples count as the same change."""
+
+    def normalise(phrase: str) -> str:
+        return " ".join(phrase.translate(_PUNCTUATION_TABLE).lower().split())
+
+    return normalise(input_phrase), normalise(corrected_phrase)
+
+
+def align_correction(
+    input_str: str, corrected_str: str
+) -> tuple[list[tuple[str, str]], float]:
+    """
+    Word-level alignment of a learner's input with its correction, returning
+    `(input_phrase, corrected_phrase)` pairs in the same shape as the LLM
+    correction tuples, plus a confidence in [0, 1].
+
+    Words are matched ignoring case, accents and punctuation, so changes to
+    punctuation or capitalisation alone are not reported (they are filtered out
+    of explanations anyway), while accent changes are. Neighbouring edits are
+    grouped into phrases, and pure insertions or deletions borrow a word of
+    context so neither side of a pair is empty.
+    """
+    input_tokens = re.findall(r"\S+", input_str)
+    corrected_tokens = re.findall(r"\S+", corrected_str)
+    input_keys = [_key(token) for token in input_tokens]
+    corrected_keys = [_key(token) for token in corrected_tokens]
+    matcher = SequenceMatcher(None, input_keys, corrected_keys, autojunk=False)
+
+    # Edits as half-open token ranges `(i1, i2, j1, j2)` into both texts
+    edits: list[tuple[int, int, int, int]] = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            edits.append((i1, i2, j1, j2))
+            continue
+        for offset in range(i2 - i1):
+            if _is_accent_change(
+                input_tokens[i1 + offset], corrected_tokens[j1 + offset]
+            ):
+                edits.append(
+                    (i1 + offset, i1 + offset + 1, j1 + offset, j1 + offset + 1)
+                )
+    edits.sort()
+
+    groups: list[list[int]] = []
+    for i1, i2, j1, j2 in edits:
+        if groups and i1 - groups[-1][1] <= MAX_GAP and j1 - groups[-1][3] <= MAX_GAP:
+            group = groups[-1]
+            group[1] = max(group[1], i2)
+            group[3] = max(group[3], j2)
+        else:
+            groups.append([i1, i2, j1, j2])
+
+    correction_tuples = []
+    for i1, i2, j1, j2 in groups:
+        if i1 == i2 or j1 == j2:
+            if i1 > 0 and j1 > 0:
+                i1, j1 = i1 - 1, j1 - 1
+            elif i2 < len(input_tokens) and j2 < len(corrected_tokens):
+                i2, j2 = i2 + 1, j2 + 1
+        input_phrase = " ".join(input_tokens[i1:i2])
+        corrected_phrase = " ".join(corrected_tokens[j1:j2])
+        if input_phrase != corrected_phrase:
+            correction_tuples.append((input_phrase, corrected_phrase))
+
+    confidence = matcher.ratio() if input_keys or corrected_keys else 1.0
+    return correction_tuples, confidence
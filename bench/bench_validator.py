@@ -0,0 +1,94 @@
+"""
+Microbenchmark of the correction-explanation validator.
+
+Times `ExplanationValidator.validate_many` against a re-implementation of the
+previous validator (one closure per filter phrase, patterns and translation
+tables rebuilt per call) over a large synthetic corpus of explanation lines,
+and checks that both agree on every line.
+
+    python -m bench.bench_validator --lines 200000
+"""
+
+import argparse
+import logging
+import random
+import re
+import string
+import time
+
+from unidecode import unidecode
+
+from utils import PHRASES_TO_CHECK, explanation_validator
+
+TEMPLATES = [
+    '{n} | "{x}" was changed to "{y}" because the verb must agree with the subject',
+    '{n} | "{x}" was changed to "{y}" to add the missing accent',
+    '{n} | "{x}" was changed to "{y}" because "ser" describes permanent traits',
+    '{n} | "{x}" was changed to "{x}," to add a comma',
+    '{n} | "{x}" was changed to "¿{x}?" because questions need a question mark',
+    "{n} | The change makes the sentence sound more natural",
+    '{n} | "{x}" was changed to "{y}" because the preterite is used for past events',
+]
+WORDS = [
+    ("es", "está"),
+    ("como", "cómo"),
+    ("voy", "fui"),
+    ("gusta", "gustan"),
+    ("bueno", "buena"),
+    ("tengo", "tuviera"),
+    ("mas", "más"),
+]
+
+
+def corpus(size: int) -> list[str]:
+    rng = random.Random(0)
+    lines = []
+    for n in range(size):
+        x, y = rng.choice(WORDS)
+        lines.append(rng.choice(TEMPLATES).format(n=n % 9 + 1, x=x, y=y))
+    return lines
+
+
+def legacy_validate(line: str) -> str:
+    explanation = line.split("|")[1].strip(" .")
+    for phrase in PHRASES_TO_CHECK:
+        if phrase in explanation.lower():
+            return ""
+    match = re.search(r'"(.+?)" was changed to "(.+?)"', explanation)
+    if match:
+        x, y = (
+            unidecode(s).translate(str.maketrans("", "", string.punctuation)).lower()
+            for s in match.groups()
+        )
+        if x == y:
+            return ""
+    return explanation
+
+
+def timed(name: str, function, lines: list[str]) -> list:
+    started_at = time.perf_counter()
+    results = function(lines)
+    elapsed = time.perf_counter() - started_at
+    print(f"{name:<22}{elapsed * 1000:>10.1f} ms{len(lines) / elapsed:>14,.0f} lines/s")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lines", type=int, default=200_000)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    lines = corpus(args.lines)
+    legacy = timed("legacy", lambda x: [legacy_validate(line) for line in x], lines)
+    compiled = timed("validate_many", explanation_validator.validate_many, lines)
+    mismatches = sum(
+        old != ("" if failed_check else explanation)
+        for old, (explanation, failed_check) in zip(legacy, compiled)
+    )
+    passed = sum(failed_check is None for _, failed_check in compiled)
+    print(f"{passed:,} of {len(lines):,} lines passed, {mismatches} mismatches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Load test of `serve.py`, showing how throughput scales with worker count.
+
+For each worker count, starts the server against the local mock OpenAI server
+and has `--clients` concurrent learners each hold a conversation of `--turns`
+turns through the JSON `/turn` endpoint, one turn at a time. Each learner's
+turns land on whichever worker accepts them, so every turn after the first
+reads the session from the shared store. Reports turns per second, latency
+percentiles and errors per worker count, and throughput relative to the
+first worker count.
+
+    python -m bench.load_test --workers 1 2 4 --clients 32 --turns 5
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+async def wait_until_up(url: str, timeout: float = 120.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as client:
+        while True:
+            try:
+                async with client.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"`{url}` did not come up in {timeout:.0f}s")
+            await asyncio.sleep(0.5)
+
+
+async def learner(
+    client: aiohttp.ClientSession,
+    url: str,
+    corpus: list[str],
+    turns: int,
+    latencies: list[float],
+) -> int:
+    errors = 0
+    session_id = None
+    for _ in range(turns):
+        started_at = time.monotonic()
+        try:
+            async with client.post(
+                url,
+                json={"session_id": session_id, "user_input": random.choice(corpus)},
+            ) as response:
+                response.raise_for_status()
+                session_id = (await response.json())["session_id"]
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Turn failed: {e!r}", file=sys.stderr)
+            errors += 1
+            continue
+        latencies.append((time.monotonic() - started_at) * 1000)
+    return errors
+
+
+async def run_load(url: str, corpus: list[str], clients: int, turns: int) -> dict:
+    latencies: list[float] = []
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0),
+        timeout=aiohttp.ClientTimeout(total=300),
+    ) as client:
+        started_at = time.monotonic()
+        errors = await asyncio.gather(
+            *(learner(client, url, corpus, turns, latencies) for _ in range(clients))
+        )
+        elapsed = time.monotonic() - started_at
+    if not latencies:
+        return {"errors": sum(errors)}
+    return {
+        "turns": len(latencies),
+        "errors": sum(errors),
+        "turns_per_second": len(latencies) / elapsed,
+        "mean_ms": statistics.mean(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+    }
+
+
+def run_workers(
+    workers: int, args: argparse.Namespace, environment: dict, corpus: list[str]
+) -> dict:
+    port = free_port()
+    command = [sys.executable, "serve.py", "--workers", str(workers)]
+    command += ["--port", str(port), "--sticky" if args.sticky else "--no-sticky"]
+    server = subprocess.Popen(command, env=environment)
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{port}/config"))
+        url = f"http://127.0.0.1:{port}/turn"
+        # Warm up every worker's connections and caches before measuring
+        asyncio.run(run_load(url, corpus, workers * 2, 1))
+        return asyncio.run(run_load(url, corpus, args.clients, args.turns))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--sticky", action="store_true")
+    parser.add_argument("--corpus", default="bench/corpus.txt")
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--ms-per-token", type=float, default=5.0)
+    args = parser.parse_args()
+
+    with open(args.corpus, "r", encoding="utf-8") as file:
+        corpus = [line.strip() for line in file if line.strip()]
+    mock_port = free_port()
+    mock = subprocess.Popen(
+        [sys.executable, "-m", "bench.mock_openai", "--port", str(mock_port)]
+        + ["--latency-ms", str(args.latency_ms)]
+        + ["--ms-per-token", str(args.ms_per_token)],
+        stdout=subprocess.DEVNULL,
+    )
+    directory = tempfile.mkdtemp(prefix="load_test_")
+    environment = {
+        **os.environ,
+        "OPENAI_API_KEY": "sk-load-test",
+        "OPENAI_API_BASE": f"http://127.0.0.1:{mock_port}/v1",
+        "RESPONSE_CACHE_ENABLED": "0",
+        "STARTER_POOL_SIZE": "0",
+        "LOG_LEVEL": "WARNING",
+        "SESSION_STORE_PATH": os.path.join(directory, "sessions.sqlite3"),
+        # Only the mock's latency should limit a single worker
+        "SCHEDULER_TOKENS_PER_MINUTE": "1000000000",
+    }
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{mock_port}/"))
+        print(
+            f"{'workers':<9}{'turns/s':>9}{'scaling':>9}{'p50 ms':>9}"
+            f"{'p95 ms':>9}{'errors':>8}"
+        )
+        baseline = None
+        for workers in args.workers:
+            result = run_workers(workers, args, environment, corpus)
+            if "turns" not in result:
+                print(f"{workers:<9}{'all turns failed':>44}")
+                continue
+            baseline = baseline or result["turns_per_second"]
+            print(
+                f"{workers:<9}{result['turns_per_second']:>9.1f}"
+                f"{result['turns_per_second'] / baseline:>8.2f}x"
+                f"{result['p50_ms']:>9.0f}{result['p95_ms']:>9.0f}"
+                f"{result['errors']:>8}"
+            )
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, for benchmarks.
+
+Responses are shaped like the real API (including function calls, built from
+the request's JSON schema, and server-sent-event streams) with configurable
+latency, token counts, error rates and rates of malformed function call
+arguments. Every request is logged with its start and end time so callers can
+work out how many calls a turn made and how deep its critical path was.
+
+Run standalone with `python -m bench.mock_openai --port 8765`, then point the
+app at it with `OPENAI_API_BASE=http://localhost:8765/v1`.
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import json
+import random
+import re
+import threading
+import time
+from typing import Any
+
+from aiohttp import web
+
+# Deterministic "corrections" applied to quoted learner input
+CORRECTIONS = {
+    r"\bes muy cansado\b": "estoy muy cansado",
+    r"\bcomo\b": "cómo",
+    r"\banos\b": "años",
+    r"\bespanol\b": "español",
+    r"\bmas\b": "más",
+    r"\bbano\b": "baño",
+    r"\bvoy a la tienda ayer\b": "fui a la tienda ayer",
+    r"\bno me gusta los\b": "no me gustan los",
+    r"\bmuy bueno\b": "muy buena",
+    r"\bdesde dos\b": "desde hace dos",
+    r"\btengo mucho\b": "tuviera mucho",
+    r"\[beach\]": "playa",
+    r"\[coat\]": "abrigo",
+}
+
+
+@dataclass
+class MockSettings:
+    latency_ms: float = 300.0
+    ms_per_token: float = 5.0
+    jitter: float = 0.2
+    tail_rate: float = 0.0
+    tail_ms: float = 3000.0
+    error_rate: float = 0.0
+    # Share of function calls whose arguments are cut off mid-JSON
+    malformed_rate: float = 0.0
+    completion_tokens: int = 60
+
+
+@dataclass
+class RequestRecord:
+    model: str
+    started_at: float
+    ended_at: float
+    prompt_tokens: int
+    completion_tokens: int
+    status: int
+
+
+@dataclass
+class MockServer:
+    settings: MockSettings = field(default_factory=MockSettings)
+    records: list[RequestRecord] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def records_between(self, start: float, end: float) -> list[RequestRecord]:
+        with self._lock:
+            return [r for r in self.records if start <= r.started_at <= end]
+
+    def _record(self, record: RequestRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    async def _sleep(self, completion_tokens: int) -> None:
+        settings = self.settings
+        latency = settings.latency_ms + settings.ms_per_token * completion_tokens
+        latency *= random.uniform(1 - settings.jitter, 1 + settings.jitter)
+        if random.random() < settings.tail_rate:
+            latency = settings.tail_ms
+        await asyncio.sleep(latency / 1000)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        started_at = time.monotonic()
+        body = await request.json()
+        prompt_tokens = sum(
+            len(str(message.get("content") or "")) // 4 + 3
+            for message in body["messages"]
+        )
+        if random.random() < self.settings.error_rate:
+            await asyncio.sleep(self.settings.latency_ms / 4000)
+            self._record(
+                RequestRecord(body["model"], started_at, time.monotonic(), 0, 0, 429)
+            )
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+                headers={"Retry-After": "0.1"},
+            )
+
+        message = _message_for(body)
+        if (
+            message.get("function_call")
+            and random.random() < self.settings.malformed_rate
+        ):
+            arguments = message["function_call"]["arguments"]
+            message["function_call"]["arguments"] = arguments[: len(arguments) // 2]
+        completion_tokens = self.settings.completion_tokens
+        if body.get("stream"):
+            response = await self._stream(request, body, message, completion_tokens)
+        else:
+            await self._sleep(completion_tokens)
+            response = web.json_response(
+                {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [
+                        {"index": 0, "message": message, "finish_reason": "stop"}
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                }
+            )
+        self._record(
+            RequestRecord(
+                body["model"],
+                started_at,
+                time.monotonic(),
+                prompt_tokens,
+                completion_tokens,
+                200,
+            )
+        )
+        return response
+
+    async def _stream(
+        self,
+        request: web.Request,
+        body: dict,
+        message: dict,
+        completion_tokens: int,
+    ) -> web.StreamResponse:
+        settings = self.settings
+        await asyncio.sleep(settings.latency_ms / 1000)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        words = (message["content"] or "").split(" ")
+        for i, word in enumerate(words):
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word if i == 0 else " " + word},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(
+                settings.ms_per_token * completion_tokens / len(words) / 1000
+            )
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        return app
+
+    def start_in_thread(self, port: int = 0) -> str:
+        """Serve on a background thread; returns the API base URL."""
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(self.app())
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", port)
+        loop.run_until_complete(site.start())
+        port = runner.addresses[0][1]
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        return f"http://127.0.0.1:{port}/v1"
+
+
+def _correct(text: str) -> str:
+    for pattern, replacement in CORRECTIONS.items():
+        text = re.sub(pattern, replacement, text, flags=re.IGNORECASE)
+    text = text[:1].upper() + text[1:]
+    if text.endswith("?") and not text.startswith("¿"):
+        text = "¿" + text
+    return text
+
+
+def _value_for(schema: dict, prompt: str) -> Any:
+    if schema.get("type") == "array":
+        count = max(1, schema.get("minItems", 1))
+        if schema.get("items", {}).get("type") == "array":
+            quoted = re.findall(r'"([^"]+)"', prompt)
+            original = quoted[0] if quoted else "yo es"
+            return [[original, _correct(original)]]
+        return [_value_for(schema.get("items", {}), prompt) for _ in range(count)]
+    if schema.get("type") == "object":
+        return {
+            name: _value_for(property_schema, prompt)
+            for name, property_schema in schema.get("properties", {}).items()
+        }
+    return '1 | "es" was changed to "está" because estar describes a temporary state'
+
+
+def _message_for(body: dict) -> dict:
+    prompt = str(body["messages"][-1].get("content") or "")
+    if body.get("functions"):
+        function = body["functions"][0]
+        arguments = _value_for(function["parameters"], prompt)
+        if "corrected_input" in arguments:
+            arguments["corrected_input"] = _correct(prompt)
+            arguments["conversation_response"] = "¡Qué interesante! Cuéntame más."
+        return {
+            "role": "assistant",
+            "content": None,
+            "function_call": {
+                "name": function["name"],
+                "arguments": json.dumps(arguments, ensure_ascii=False),
+            },
+        }
+    quoted = re.search(r'"([^"]+)"', prompt)
+    if body["messages"][0]["role"] == "system" or not quoted:
+        content = "¡Qué interesante! " + "Cuéntame más sobre eso, por favor. " * 4
+    elif "explain" in prompt or "breakdown" in prompt:
+        content = f'1 | "{quoted.group(1)}" was changed because of agreement'
+    else:
+        content = f'"{_correct(quoted.group(1))}"'
+    return {"role": "assistant", "content": content.strip()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--ms-per-token", type=float, default=5.0)
+    parser.add_argument("--tail-rate", type=float, default=0.0)
+    parser.add_argument("--tail-ms", type=float, default=3000.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    args = parser.parse_args()
+    server = MockServer(
+        MockSettings(
+            latency_ms=args.latency_ms,
+            ms_per_token=args.ms_per_token,
+            tail_rate=args.tail_rate,
+            tail_ms=args.tail_ms,
+            error_rate=args.error_rate,
+            malformed_rate=args.malformed_rate,
+            completion_tokens=args.completion_tokens,
+        )
+    )
+    web.run_app(server.app(), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
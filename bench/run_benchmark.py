@@ -0,0 +1,195 @@
+"""
+Offline latency and cost benchmark of the correction handlers.
+
+Runs each handler's `call_api` over a corpus of learner inputs against the
+local mock OpenAI server, one turn at a time, and reports per handler:
+end-to-end latency percentiles, API calls per turn, critical-path depth (the
+longest chain of requests that had to run one after another) and tokens per
+turn. The response cache and similarity index are disabled so that every run
+pays full price. For `func_arg_handler` it also reports how often the fast path
+fell back to the multi-stage handler (see `--malformed-rate`) and the latency
+it saved.
+
+    python -m bench.run_benchmark --output bench_results.json
+    python -m bench.run_benchmark --baseline bench_results.json --max-regression 0.1
+
+With `--baseline`, the run exits non-zero if any handler's p95 latency, calls,
+depth or tokens per turn grew by more than `--max-regression` (a fraction).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any
+
+# Must be set before the handlers import config
+os.environ["RESPONSE_CACHE_ENABLED"] = "0"
+os.environ["SIMILARITY_INDEX_ENABLED"] = "0"
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import openai  # noqa: E402
+
+from bench.mock_openai import MockServer, MockSettings, RequestRecord  # noqa: E402
+import func_arg_handler  # noqa: E402
+import new_handler  # noqa: E402
+import orig_handler  # noqa: E402
+from store import MemorySessionStore  # noqa: E402
+
+HANDLERS = {
+    "orig_handler": orig_handler.call_api,
+    "new_handler": new_handler.call_api,
+    "func_arg_handler": func_arg_handler.call_api,
+}
+REGRESSION_METRICS = ["p95_ms", "calls_per_turn", "depth_per_turn", "tokens_per_turn"]
+PROMPT_SYSTEM_MAIN = open("prompts/system_main.txt", "r").read()
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def critical_path_depth(records: list[RequestRecord]) -> int:
+    """Length of the longest chain of requests that each started after the last ended."""
+    records = sorted(records, key=lambda record: record.started_at)
+    depths: list[int] = []
+    for i, record in enumerate(records):
+        depths.append(
+            1
+            + max(
+                (
+                    depths[j]
+                    for j in range(i)
+                    if records[j].ended_at <= record.started_at
+                ),
+                default=0,
+            )
+        )
+    return max(depths, default=0)
+
+
+def run_handler(name: str, server: MockServer, corpus: list[str], repeats: int) -> dict:
+    call_api = HANDLERS[name]
+    sessions = MemorySessionStore()
+    latencies, calls, depths, tokens, errors = [], [], [], [], 0
+    for _ in range(repeats):
+        for user_input in corpus:
+            session = sessions.create(
+                [{"role": "system", "content": PROMPT_SYSTEM_MAIN}]
+            )
+            started_at = time.monotonic()
+            try:
+                call_api(user_input, session)
+            except Exception as e:
+                print(f"{name} failed on `{user_input}`: {e!r}", file=sys.stderr)
+                errors += 1
+                continue
+            ended_at = time.monotonic()
+            records = server.records_between(started_at, ended_at)
+            latencies.append((ended_at - started_at) * 1000)
+            calls.append(len(records))
+            depths.append(critical_path_depth(records))
+            tokens.append(sum(session.tokens_used()))
+    if not latencies:
+        return {"errors": errors}
+    result: dict[str, Any] = {
+        "turns": len(latencies),
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "calls_per_turn": statistics.mean(calls),
+        "depth_per_turn": statistics.mean(depths),
+        "max_depth": max(depths),
+        "tokens_per_turn": statistics.mean(tokens),
+    }
+    if name == "func_arg_handler":
+        result["fast_path"] = func_arg_handler.fast_path.stats()
+    return result
+
+
+def find_regressions(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    regressions = []
+    for handler, handler_results in results.items():
+        for metric in REGRESSION_METRICS:
+            old = baseline.get(handler, {}).get(metric)
+            new = handler_results.get(metric)
+            if old and new is not None and new > old * (1 + max_regression):
+                regressions.append(f"{handler} {metric}: {old:.1f} -> {new:.1f}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--handlers", nargs="+", default=list(HANDLERS))
+    parser.add_argument("--corpus", default="bench/corpus.txt")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--ms-per-token", type=float, default=5.0)
+    parser.add_argument("--tail-rate", type=float, default=0.0)
+    parser.add_argument("--tail-ms", type=float, default=3000.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--baseline", help="Compare against a previous --output")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    with open(args.corpus, "r", encoding="utf-8") as file:
+        corpus = [line.strip() for line in file if line.strip()]
+    server = MockServer(
+        MockSettings(
+            latency_ms=args.latency_ms,
+            ms_per_token=args.ms_per_token,
+            tail_rate=args.tail_rate,
+            tail_ms=args.tail_ms,
+            error_rate=args.error_rate,
+            malformed_rate=args.malformed_rate,
+            completion_tokens=args.completion_tokens,
+        )
+    )
+    openai.api_base = server.start_in_thread()
+
+    results = {}
+    print(
+        f"{'handler':<18}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'calls':>8}{'depth':>8}{'tokens':>9}{'errors':>8}"
+    )
+    for name in args.handlers:
+        results[name] = result = run_handler(name, server, corpus, args.repeats)
+        if "turns" not in result:
+            print(f"{name:<18}{'all turns failed':>60}")
+            continue
+        print(
+            f"{name:<18}{result['p50_ms']:>9.0f}{result['p95_ms']:>9.0f}"
+            f"{result['p99_ms']:>9.0f}{result['calls_per_turn']:>8.2f}"
+            f"{result['depth_per_turn']:>8.2f}{result['tokens_per_turn']:>9.0f}"
+            f"{result['errors']:>8}"
+        )
+    if "turns" in results.get("func_arg_handler", {}):
+        fast_path = results["func_arg_handler"]["fast_path"]
+        print(
+            f"func_arg_handler fast path: {fast_path['fallback_rate'] or 0:.0%} fell back, "
+            f"{fast_path['saving_ms'] or 0:.0f} ms saved per fast turn, "
+            f"{fast_path['net_saving_ms'] or 0:.0f} ms per turn net of fallbacks"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = find_regressions(results, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
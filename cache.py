@@ -0,0 +1,224 @@
+from collections import OrderedDict
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any
+
+import config
+
+logger = logging.getLogger()
+
+
+class MemoryBackend:
+    """Thread-safe LRU of `key -> (expires_at, value)`."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteBackend:
+    """On-disk cache that survives restarts; evicts least recently used rows."""
+
+    # Expired and excess rows are purged in batches rather than on every write
+    EVICT_EVERY_N_WRITES = 100
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._writes_since_eviction = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS response_cache_last_access "
+            "ON response_cache (last_access)"
+        )
+        self._connection.commit()
+
+    def get(self, key: str) -> tuple[float, Any] | None:
+        """The unexpired `(expires_at, value)` entry for `key`, if any."""
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._connection.execute(
+                    "DELETE FROM response_cache WHERE key = ?", (key,)
+                )
+            else:
+                self._connection.execute(
+                    "UPDATE response_cache SET last_access = ? WHERE key = ?",
+                    (now, key),
+                )
+            self._connection.commit()
+        return (expires_at, json.loads(value)) if expires_at >= now else None
+
+    def set(self, key: str, value: Any, expires_at: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now),
+            )
+            self._writes_since_eviction += 1
+            if self._writes_since_eviction >= self.EVICT_EVERY_N_WRITES:
+                self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now: float) -> None:
+        self._writes_since_eviction = 0
+        self._connection.execute(
+            "DELETE FROM response_cache WHERE expires_at < ?", (now,)
+        )
+        self._connection.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            "SELECT key FROM response_cache ORDER BY last_access DESC "
+            "LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM response_cache")
+            self._connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM response_cache"
+            ).fetchone()[0]
+
+
+class ResponseCache:
+    """
+    Two-level cache for deterministic LLM stages: an in-memory LRU in front of
+    an optional SQLite backend. Values must be JSON-serialisable.
+    """
+
+    def __init__(
+        self,
+        memory: MemoryBackend,
+        disk: SQLiteBackend | None = None,
+        ttl: float = config.RESPONSE_CACHE_TTL_SECONDS,
+    ):
+        self.memory = memory
+        self.disk = disk
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, template: str, prompt: Any, temperature: float) -> str:
+        payload = json.dumps(
+            [model, template, prompt, temperature], sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Any | None:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                # Keep the disk expiry so promotion never extends an entry's life
+                expires_at, value = entry
+                self.memory.set(key, value, expires_at)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        expires_at = time.time() + self.ttl
+        self.memory.set(key, value, expires_at)
+        if self.disk is not None:
+            self.disk.set(key, value, expires_at)
+
+    async def aget(self, key: str) -> Any | None:
+        if self.disk is None:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: Any) -> None:
+        if self.disk is None:
+            self.set(key, value)
+        else:
+            await asyncio.to_thread(self.set, key, value)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_entries": len(self.disk) if self.disk is not None else 0,
+        }
+
+
+def _build_response_cache() -> ResponseCache | None:
+    if not config.RESPONSE_CACHE_ENABLED:
+        return None
+    disk = None
+    if config.RESPONSE_CACHE_SQLITE_PATH:
+        logger.info(
+            f"Using SQLite response cache at `{config.RESPONSE_CACHE_SQLITE_PATH}`"
+        )
+        disk = SQLiteBackend(
+            config.RESPONSE_CACHE_SQLITE_PATH, config.RESPONSE_CACHE_SQLITE_MAX_ENTRIES
+        )
+    return ResponseCache(MemoryBackend(config.RESPONSE_CACHE_MAX_ENTRIES), disk)
+
+
+response_cache = _build_response_cache()
@@ -0,0 +1,184 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.getenv(name) or default
+
+
+# Connection pool shared by every OpenAI request made by this process
+OPENAI_MAX_CONNECTIONS = _env_int("OPENAI_MAX_CONNECTIONS", 100)
+OPENAI_MAX_CONNECTIONS_PER_HOST = _env_int("OPENAI_MAX_CONNECTIONS_PER_HOST", 0)
+OPENAI_KEEPALIVE_SECONDS = _env_float("OPENAI_KEEPALIVE_SECONDS", 60.0)
+
+# Sessions that have not been used for this long are dropped from memory
+SESSION_IDLE_TIMEOUT_SECONDS = _env_float("SESSION_IDLE_TIMEOUT_SECONDS", 6 * 60 * 60)
+
+# Where sessions are kept: "memory" (this process only) or "sqlite" (a file
+# shared by every worker process on the host, see serve.py)
+SESSION_STORE = _env_str("SESSION_STORE", "memory")
+SESSION_STORE_PATH = _env_str("SESSION_STORE_PATH", "sessions.sqlite3")
+
+# Cache for the deterministic (low temperature) correction stages
+RESPONSE_CACHE_ENABLED = _env_bool("RESPONSE_CACHE_ENABLED", True)
+RESPONSE_CACHE_MAX_ENTRIES = _env_int("RESPONSE_CACHE_MAX_ENTRIES", 10_000)
+RESPONSE_CACHE_TTL_SECONDS = _env_float("RESPONSE_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60)
+RESPONSE_CACHE_SQLITE_PATH = _env_str("RESPONSE_CACHE_SQLITE_PATH", "")
+RESPONSE_CACHE_SQLITE_MAX_ENTRIES = _env_int(
+    "RESPONSE_CACHE_SQLITE_MAX_ENTRIES", 100_000
+)
+
+# Identical deterministic requests in flight at the same time, from any
+# sessions, share one upstream request
+SINGLE_FLIGHT_ENABLED = _env_bool("SINGLE_FLIGHT_ENABLED", True)
+
+# Corrections of past inputs are reused for inputs that are the same once
+# accents, punctuation and case are ignored, and for inputs whose character
+# n-grams are at least the minimum similarity (Jaccard) alike. Lowering it saves
+# more calls but is more likely to return another sentence's correction; 1 only
+# reuses corrections of inputs that are the same
+SIMILARITY_INDEX_ENABLED = _env_bool("SIMILARITY_INDEX_ENABLED", True)
+SIMILARITY_INDEX_PATH = _env_str("SIMILARITY_INDEX_PATH", "correction_index.npz")
+SIMILARITY_INDEX_MIN_SIMILARITY = _env_float("SIMILARITY_INDEX_MIN_SIMILARITY", 0.9)
+SIMILARITY_INDEX_MAX_ENTRIES = _env_int("SIMILARITY_INDEX_MAX_ENTRIES", 1_000_000)
+SIMILARITY_INDEX_SAVE_EVERY = _env_int("SIMILARITY_INDEX_SAVE_EVERY", 1000)
+
+# How each turn is handled: "new" (correction tuples explained one by one),
+# "orig" (sentence by sentence) or "func_arg" (a single function call)
+HANDLER_STRATEGY = _env_str("HANDLER_STRATEGY", "new")
+
+# The "func_arg" strategy falls back to the multi-stage "new" strategy for turns
+# whose combined response is malformed. Once more than the maximum rate of the
+# recent window of attempts fall back, turns skip straight to the multi-stage
+# handler, and only one in every `FAST_PATH_PROBE_EVERY` tries the fast path.
+FAST_PATH_WINDOW = _env_int("FAST_PATH_WINDOW", 20)
+FAST_PATH_MAX_FALLBACK_RATE = _env_float("FAST_PATH_MAX_FALLBACK_RATE", 0.3)
+FAST_PATH_PROBE_EVERY = _env_int("FAST_PATH_PROBE_EVERY", 10)
+
+# Stream the conversation response into the UI token by token
+STREAM_RESPONSES = _env_bool("STREAM_RESPONSES", True)
+
+# Answer each turn within this many seconds (0 for no deadline). Whatever of
+# the correction is not ready by then is shown as pending and filled in once it
+# arrives, unless the learner submits the next turn first, which cancels it.
+# The rest of the correction is held by the worker that answered the turn, so
+# serve.py only allows a deadline with sticky routing.
+TURN_DEADLINE_SECONDS = _env_float("TURN_DEADLINE_SECONDS", 0.0)
+
+# Conversation history sent with each conversation response request
+HISTORY_MAX_TURNS = _env_int("HISTORY_MAX_TURNS", 6)
+HISTORY_TOKEN_BUDGET = _env_int("HISTORY_TOKEN_BUDGET", 2000)
+HISTORY_SUMMARY_ENABLED = _env_bool("HISTORY_SUMMARY_ENABLED", True)
+
+# Skip the tuple and explanation stages when a correction only touches
+# punctuation, accents or capitalisation
+CORRECTION_PRECHECK_ENABLED = _env_bool("CORRECTION_PRECHECK_ENABLED", True)
+
+# Fix missing accents, inverted question and exclamation marks and sentence
+# capitals locally, with canned explanations, before the input is sent for
+# correction. Accents are only added to words in ACCENTED_WORDS_PATH whose
+# unaccented spelling is not a word itself.
+LOCAL_FIXER_ENABLED = _env_bool("LOCAL_FIXER_ENABLED", True)
+ACCENTED_WORDS_PATH = _env_str("ACCENTED_WORDS_PATH", "accented_words.txt")
+
+# How correction tuples are produced: "llm", "local" (word alignment), or
+# "local_with_fallback" (ask the LLM when the alignment has low confidence)
+CORRECTION_TUPLES_MODE = _env_str("CORRECTION_TUPLES_MODE", "local_with_fallback")
+ALIGNMENT_MIN_CONFIDENCE = _env_float("ALIGNMENT_MIN_CONFIDENCE", 0.5)
+
+# "batched" explains up to EXPLANATION_MAX_BATCH_SIZE corrections per
+# function-calling request; "per_item" sends one request per correction
+EXPLANATION_MODE = _env_str("EXPLANATION_MODE", "batched")
+EXPLANATION_MAX_BATCH_SIZE = _env_int("EXPLANATION_MAX_BATCH_SIZE", 8)
+
+# While the LLM extracts correction tuples, start explaining the locally aligned
+# changes, and reuse the explanations of any tuples the LLM agrees with
+SPECULATIVE_EXPLANATIONS_ENABLED = _env_bool("SPECULATIVE_EXPLANATIONS_ENABLED", True)
+
+# Correct each sentence in the background as soon as the learner finishes
+# typing it, so that submitting only waits on the unfinished tail. A sentence
+# must stay unchanged for the debounce period before any request is sent.
+INCREMENTAL_CORRECTION_ENABLED = _env_bool("INCREMENTAL_CORRECTION_ENABLED", True)
+INCREMENTAL_CORRECTION_DEBOUNCE_SECONDS = _env_float(
+    "INCREMENTAL_CORRECTION_DEBOUNCE_SECONDS", 0.5
+)
+
+# Request scheduler: concurrency caps, token-per-minute budgets, retries,
+# deadlines and hedging. Per-model overrides are "model=value,model=value".
+SCHEDULER_MAX_CONCURRENCY = _env_int("SCHEDULER_MAX_CONCURRENCY", 64)
+SCHEDULER_MODEL_CONCURRENCY = _env_int("SCHEDULER_MODEL_CONCURRENCY", 32)
+SCHEDULER_MODEL_CONCURRENCY_OVERRIDES = _env_str(
+    "SCHEDULER_MODEL_CONCURRENCY_OVERRIDES", ""
+)
+SCHEDULER_TOKENS_PER_MINUTE = _env_int("SCHEDULER_TOKENS_PER_MINUTE", 90_000)
+SCHEDULER_TOKENS_PER_MINUTE_OVERRIDES = _env_str(
+    "SCHEDULER_TOKENS_PER_MINUTE_OVERRIDES", ""
+)
+SCHEDULER_COMPLETION_TOKENS_ESTIMATE = _env_int(
+    "SCHEDULER_COMPLETION_TOKENS_ESTIMATE", 256
+)
+SCHEDULER_MAX_RETRIES = _env_int("SCHEDULER_MAX_RETRIES", 4)
+SCHEDULER_BACKOFF_BASE_SECONDS = _env_float("SCHEDULER_BACKOFF_BASE_SECONDS", 0.5)
+SCHEDULER_BACKOFF_MAX_SECONDS = _env_float("SCHEDULER_BACKOFF_MAX_SECONDS", 20.0)
+SCHEDULER_ATTEMPT_TIMEOUT_SECONDS = _env_float(
+    "SCHEDULER_ATTEMPT_TIMEOUT_SECONDS", 30.0
+)
+SCHEDULER_DEADLINE_SECONDS = _env_float("SCHEDULER_DEADLINE_SECONDS", 90.0)
+SCHEDULER_HEDGE_ENABLED = _env_bool("SCHEDULER_HEDGE_ENABLED", True)
+# Hedge once a request has run longer than this percentile of recent latencies
+SCHEDULER_HEDGE_PERCENTILE = _env_float("SCHEDULER_HEDGE_PERCENTILE", 95.0)
+SCHEDULER_HEDGE_MIN_DELAY_SECONDS = _env_float("SCHEDULER_HEDGE_MIN_DELAY_SECONDS", 2.0)
+
+# Checked locally before each request is sent. Prompts over
+# PROMPT_TOKEN_BUDGET are "trim"med (oldest messages first) or "reject"ed, and
+# requests that would take a session past SESSION_BUDGET_USD are rejected.
+# 0 disables either limit.
+PROMPT_TOKEN_BUDGET = _env_int("PROMPT_TOKEN_BUDGET", 0)
+PROMPT_BUDGET_ACTION = _env_str("PROMPT_BUDGET_ACTION", "trim")
+SESSION_BUDGET_USD = _env_float("SESSION_BUDGET_USD", 0.0)
+
+# Conversation starters generated ahead of time, so new sessions start without
+# waiting on the API. Refilled below the low-water mark; size 0 disables it.
+STARTER_POOL_SIZE = _env_int("STARTER_POOL_SIZE", 20)
+STARTER_POOL_LOW_WATER = _env_int("STARTER_POOL_LOW_WATER", 5)
+STARTER_POOL_PATH = _env_str("STARTER_POOL_PATH", "starter_pool.json")
+
+# Conversation topics: the outline they are parsed from, its compiled index,
+# optional "category=weight,category=weight" multipliers, and the learner level
+# ("beginner", "intermediate" or "advanced") that topics are weighted for
+TOPIC_SOURCE_PATH = _env_str("TOPIC_SOURCE_PATH", "conversation_topics.txt")
+TOPIC_INDEX_PATH = _env_str("TOPIC_INDEX_PATH", "conversation_topics.idx")
+TOPIC_CATEGORY_WEIGHTS = _env_str("TOPIC_CATEGORY_WEIGHTS", "")
+TOPIC_LEVEL = _env_str("TOPIC_LEVEL", "")
+
+# Logging and tracing. Traces are sampled per turn; sampled spans of stages and
+# API calls are written to a JSON-lines file and/or sent to an OpenTelemetry
+# collector (OTLP over HTTP), and sampled turns slower than the threshold are
+# logged with their slowest stage. Summarise a trace file with
+# `python -m tracing traces.jsonl`.
+LOG_LEVEL = _env_str("LOG_LEVEL", "INFO").upper()
+TRACE_SAMPLE_RATE = _env_float("TRACE_SAMPLE_RATE", 1.0)
+TRACE_PATH = _env_str("TRACE_PATH", "")
+TRACE_OTLP_ENDPOINT = _env_str("TRACE_OTLP_ENDPOINT", "")
+TRACE_SERVICE_NAME = _env_str("TRACE_SERVICE_NAME", "spanish-language-tutor")
+TRACE_SLOW_TURN_SECONDS = _env_float("TRACE_SLOW_TURN_SECONDS", 10.0)
@@ -0,0 +1,663 @@
+import asyncio
+from concurrent.futures import Future, InvalidStateError
+from dataclasses import dataclass, field
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import config
+from history import history_manager
+from incremental import Correction, IncrementalCorrector
+import llm
+from local_fixer import local_fixer
+import metrics
+from session import Session
+from tracing import tracer
+from utils import format_explanations, validated_explanations
+
+logger = logging.getLogger()
+
+engine_counters = metrics.counters(
+    "engine",
+    "turns",
+    "stages",
+    "calls",
+    "deduped",
+    "late_corrections",
+    "late_cancelled",
+)
+
+PENDING_EXPLANATIONS = "Explanations pending, they will appear here shortly."
+
+
+def message_content(message: dict) -> str:
+    return message["content"]
+
+
+def function_arguments(message: dict) -> dict:
+    return json.loads(message["function_call"]["arguments"])
+
+
+@dataclass(frozen=True)
+class Call:
+    """
+    A declarative LLM request: a prompt template filled in from keyword fields,
+    the model and temperature it is sent with, and the parser applied to the
+    returned message. A `template` name makes the call cacheable, and a
+    `function` definition forces the model to call it.
+    """
+
+    prompt: str
+    model: str = "gpt-3.5-turbo"
+    temperature: float = 0.2
+    stage: str = "other"
+    template: str | None = None
+    function: dict | None = None
+    parser: Callable[[dict], Any] = message_content
+
+    def request(self, function: dict | None = None, **fields: Any) -> dict:
+        """Keyword arguments for `llm.complete`; `function` overrides the default."""
+        request = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": self.prompt.format(**fields)}],
+            "temperature": self.temperature,
+            "stage": self.stage,
+            "template": self.template,
+        }
+        function = function or self.function
+        if function is not None:
+            request["functions"] = [function]
+            request["function_call"] = {"name": function["name"]}
+        return request
+
+
+@dataclass
+class _SharedCall:
+    task: asyncio.Task
+    waiters: int = 0
+
+
+class Turn:
+    """
+    One learner input being handled: the session, the result of each stage that
+    has finished, and the calls made so far, so that identical calls made by
+    different stages are only sent once. If `fix_locally`, the correction
+    stages correct `correction_input`, the input with the local fixes already
+    made.
+    """
+
+    def __init__(self, user_input: str, session: Session, fix_locally: bool = False):
+        self.user_input = user_input
+        self.session = session
+        self.local_fix = (
+            local_fixer.fix(user_input)
+            if fix_locally and local_fixer is not None
+            else None
+        )
+        self.results: dict[str, Any] = {}
+        # Set if the correction misses the turn deadline, in which case the
+        # turn is only closed once the late correction finishes
+        self.late_correction: Future | None = None
+        # Each sentence and the future of its correction, if the correction is
+        # made from the sentences prepared while the learner typed
+        self.sentence_corrections: list[tuple[str, Future]] = []
+        self._calls: dict[str, _SharedCall] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def correction_input(self) -> str:
+        return self.user_input if self.local_fix is None else self.local_fix.fixed
+
+    def __getitem__(self, stage: str) -> Any:
+        return self.results[stage]
+
+    def spawn(self, coroutine: Awaitable) -> asyncio.Task:
+        """Start work that is cancelled if still running when the turn ends."""
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.append(task)
+        return task
+
+    async def call(
+        self, call: Call, function: dict | None = None, **fields: Any
+    ) -> Any:
+        """
+        Make `call` with the prompt `fields` and return its parsed result. An
+        identical call already in flight this turn is shared rather than sent
+        again, and is only cancelled once every caller waiting on it is.
+        """
+        request = call.request(function, **fields)
+        key = json.dumps(request, sort_keys=True)
+        shared = self._calls.get(key)
+        if shared is None or shared.task.cancelled():
+            logger.info(f"Making `{call.template or call.stage}` request...")
+            engine_counters.increment("calls")
+            shared = self._calls[key] = _SharedCall(
+                self.spawn(llm.complete(self.session, **request))
+            )
+        else:
+            logger.debug("Sharing identical `%s` request", call.template or call.stage)
+            engine_counters.increment("deduped")
+        shared.waiters += 1
+        try:
+            message = await asyncio.shield(shared.task)
+        finally:
+            shared.waiters -= 1
+            if not shared.waiters and not shared.task.done():
+                shared.task.cancel()
+        return call.parser(message)
+
+    def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+
+def pending_correction(turn: Turn) -> Correction:
+    """The input, with every explanation pending, for a turn past its deadline."""
+    return turn.correction_input, [PENDING_EXPLANATIONS]
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    One node of a strategy's graph. `run` computes the stage's result once every
+    stage named in `after` has finished. The stage producing the conversation
+    reply may also give `stream`, which yields the reply as it is generated.
+    """
+
+    name: str
+    run: Callable[[Turn], Awaitable[Any]]
+    after: tuple[str, ...] = ()
+    stream: Callable[[Turn], AsyncIterator[str]] | None = None
+
+
+def call_stage(
+    name: str,
+    call: Call,
+    fields: Callable[[Turn], dict],
+    after: tuple[str, ...] = (),
+) -> Stage:
+    """A stage making a single `call`, with its prompt fields taken from the turn."""
+
+    async def run(turn: Turn) -> Any:
+        return await turn.call(call, **fields(turn))
+
+    return Stage(name, run, after)
+
+
+@dataclass(frozen=True)
+class Strategy:
+    """
+    A way of handling a turn: a graph of stages, the stage whose result is the
+    conversation reply, and how the corrected input and its explanations are
+    read from the results, including from a turn whose correction stages have
+    not all finished by the turn deadline (`partial_correction`). If the reply
+    stage is independent of the others, the strategy can be `incremental`,
+    correcting the input sentence by sentence while the learner types. Only
+    strategies whose correction stages correct `Turn.correction_input` can have
+    the input `fix_locally` first.
+    """
+
+    name: str
+    stages: tuple[Stage, ...]
+    reply: str
+    correction: Callable[[Turn], Correction]
+    partial_correction: Callable[[Turn], Correction] | None = None
+    validate_explanations: bool = True
+    incremental: bool = False
+    fix_locally: bool = False
+    # The stages in dependency order
+    order: tuple[Stage, ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        stages = {stage.name: stage for stage in self.stages}
+        if len(stages) != len(self.stages):
+            raise ValueError(f"Strategy `{self.name}` has duplicate stage names")
+        if self.reply not in stages:
+            raise ValueError(f"Strategy `{self.name}` has no `{self.reply}` stage")
+        for stage in self.stages:
+            for name in stage.after:
+                if name not in stages:
+                    raise ValueError(
+                        f"Stage `{stage.name}` of `{self.name}` depends on unknown stage `{name}`"
+                    )
+        if stages[self.reply].stream is not None and stages[self.reply].after:
+            raise ValueError(
+                f"Strategy `{self.name}` streams a reply that depends on other stages"
+            )
+        if self.incremental and (
+            stages[self.reply].after
+            or any(self.reply in stage.after for stage in self.stages)
+        ):
+            raise ValueError(
+                f"Strategy `{self.name}` cannot be incremental, its reply is not independent of the other stages"
+            )
+
+        # Dependencies first, so every stage can wait on those it needs
+        order: list[Stage] = []
+        visited: set[str] = set()
+        visiting: set[str] = set()
+
+        def visit(stage: Stage) -> None:
+            if stage.name in visited:
+                return
+            if stage.name in visiting:
+                raise ValueError(
+                    f"Strategy `{self.name}` has a cycle at `{stage.name}`"
+                )
+            visiting.add(stage.name)
+            for name in stage.after:
+                visit(stages[name])
+            visiting.discard(stage.name)
+            visited.add(stage.name)
+            order.append(stage)
+
+        for stage in self.stages:
+            visit(stage)
+        object.__setattr__(self, "order", tuple(order))
+
+    @property
+    def reply_stage(self) -> Stage:
+        return next(stage for stage in self.stages if stage.name == self.reply)
+
+    @property
+    def correction_stages(self) -> tuple[Stage, ...]:
+        return tuple(stage for stage in self.order if stage.name != self.reply)
+
+
+class Engine:
+    """
+    Runs a strategy's stages for each turn. Every stage starts as soon as the
+    stages it depends on have finished, so independent stages always run
+    concurrently, and work left over when the turn ends is cancelled. With a
+    `deadline`, a turn whose correction is not ready in time is answered with
+    the correction so far, and the rest is left to finish as the session's late
+    correction until the next turn.
+    """
+
+    def __init__(
+        self, strategy: Strategy, deadline: float = config.TURN_DEADLINE_SECONDS
+    ):
+        self.strategy = strategy
+        self.deadline = deadline
+        self.incremental_corrector = (
+            IncrementalCorrector(self.correct) if strategy.incremental else None
+        )
+
+    @property
+    def incremental(self) -> bool:
+        return (
+            self.incremental_corrector is not None
+            and config.INCREMENTAL_CORRECTION_ENABLED
+        )
+
+    def _prepared(self, session: Session) -> IncrementalCorrector | None:
+        """
+        The incremental corrector, if sentences of the session's input were
+        prepared while the learner typed. Turns nobody prepared, such as those
+        from the API or the benchmark, run the correction stages as usual.
+        """
+        if not self.incremental or not session.sentence_corrections:
+            return None
+        return self.incremental_corrector
+
+    def _start(
+        self,
+        turn: Turn,
+        stages: tuple[Stage, ...],
+        started: dict[str, Awaitable] | None = None,
+    ) -> dict[str, asyncio.Task]:
+        """Start `stages`, which must be in dependency order, as tasks."""
+        started = dict(started or {})
+        tasks = {}
+        for stage in stages:
+            tasks[stage.name] = started[stage.name] = turn.spawn(
+                self._run_stage(turn, stage, [started[name] for name in stage.after])
+            )
+        return tasks
+
+    async def _run_stage(
+        self, turn: Turn, stage: Stage, dependencies: list[Awaitable]
+    ) -> Any:
+        await asyncio.gather(*dependencies)
+        engine_counters.increment("stages")
+        logger.debug("Running stage `%s` of `%s`", stage.name, self.strategy.name)
+        with tracer.span(f"stage.{stage.name}", strategy=self.strategy.name):
+            turn.results[stage.name] = await stage.run(turn)
+        return turn.results[stage.name]
+
+    def _correction(self, turn: Turn) -> Correction:
+        """
+        The strategy's correction of the turn, with its explanations validated if
+        the strategy asks for that, after the canned explanations of the local
+        fixes it kept. Canned explanations are not validated, as they are about
+        exactly the accents and punctuation the validator filters out.
+        """
+        corrected_input, explanations = self.strategy.correction(turn)
+        if self.strategy.validate_explanations:
+            explanations = validated_explanations(explanations)
+        if local_fixer is not None and turn.local_fix is not None:
+            local_fixer.record_correction(turn.local_fix, corrected_input)
+            explanations = turn.local_fix.explanations(corrected_input) + explanations
+        return corrected_input, explanations
+
+    def _partial_correction(self, turn: Turn) -> Correction:
+        """The correction so far, with what is still missing marked as pending."""
+        if turn.sentence_corrections:
+            corrected_input, explanations = _partial_sentence_correction(turn)
+        else:
+            partial_correction = self.strategy.partial_correction or pending_correction
+            corrected_input, explanations = partial_correction(turn)
+        if turn.local_fix is not None:
+            explanations = turn.local_fix.explanations(corrected_input) + explanations
+        return corrected_input, explanations
+
+    def _format(self, correction: Correction) -> str:
+        corrected_input, correction_explanations = correction
+        # Sentences corrected separately can share a canned explanation
+        correction_explanation = format_explanations(
+            list(dict.fromkeys(correction_explanations))
+        )
+        return "{correction}\n\n{explanation}".format(
+            correction=corrected_input, explanation=correction_explanation
+        )
+
+    async def correct(self, text: str, session: Session) -> Correction:
+        """Run only the correction stages on `text`."""
+        turn = Turn(text, session, self.strategy.fix_locally)
+        try:
+            with tracer.span(
+                "correction", strategy=self.strategy.name, session=session.session_id
+            ):
+                await asyncio.gather(
+                    *self._start(turn, self.strategy.correction_stages).values()
+                )
+                return self._correction(turn)
+        finally:
+            turn.close()
+
+    def prepare(self, text: str, session: Session) -> None:
+        """Start correcting the sentences completed so far in the textbox."""
+        if self.incremental_corrector is not None and self.incremental:
+            self.incremental_corrector.update(text, session)
+
+    async def _correction_response(
+        self,
+        turn: Turn,
+        tasks: dict[str, asyncio.Task],
+        prepared: IncrementalCorrector | None = None,
+    ) -> str:
+        """
+        The correction response, once the correction stages among `tasks` finish,
+        or from the `prepared` sentence corrections.
+        """
+        if prepared is not None:
+            turn.sentence_corrections = prepared.submit(turn.user_input, turn.session)
+            return self._format(await prepared.gather(turn.sentence_corrections))
+        await asyncio.gather(
+            *(task for name, task in tasks.items() if name != self.strategy.reply)
+        )
+        return self._format(self._correction(turn))
+
+    async def _stream_correction_response(
+        self, turn: Turn, reply: Awaitable, prepared: IncrementalCorrector | None
+    ) -> str:
+        tasks = {}
+        if prepared is None:
+            tasks = self._start(
+                turn, self.strategy.correction_stages, {self.strategy.reply: reply}
+            )
+        return await self._correction_response(turn, tasks, prepared)
+
+    async def _by_deadline(
+        self, turn: Turn, correction_response: asyncio.Task, started_at: float
+    ) -> str:
+        """
+        The correction response, or if it is not ready by the turn deadline, the
+        partial correction response. The rest of the correction then carries on
+        as the session's late correction, and the turn is closed once it is done.
+        """
+        if not self.deadline:
+            return await correction_response
+        remaining = started_at + self.deadline - time.monotonic()
+        done, _ = await asyncio.wait({correction_response}, timeout=max(0.0, remaining))
+        if done:
+            return correction_response.result()
+        engine_counters.increment("late_corrections")
+        logger.info(
+            f"Correction missed the {self.deadline}s deadline, responding with a partial correction"
+        )
+        turn.late_correction = turn.session.late_correction = _hand_over(
+            turn, correction_response
+        )
+        return self._format(self._partial_correction(turn))
+
+    async def run(self, user_input: str, session: Session) -> tuple[str, str]:
+        """Handle a turn, returning `(correction_response, conversation_response)`."""
+        started_at = time.monotonic()
+        engine_counters.increment("turns")
+        logger.info(f"Running `{self.strategy.name}` strategy...")
+        cancel_late_correction(session)
+        turn = Turn(user_input, session, self.strategy.fix_locally)
+        try:
+            with tracer.span(
+                "turn", strategy=self.strategy.name, session=session.session_id
+            ):
+                prepared = self._prepared(session)
+                if prepared is not None:
+                    tasks = self._start(turn, (self.strategy.reply_stage,))
+                else:
+                    tasks = self._start(turn, self.strategy.order)
+                correction_response = turn.spawn(
+                    self._correction_response(turn, tasks, prepared)
+                )
+                conversation_response = await tasks[self.strategy.reply]
+                return (
+                    await self._by_deadline(turn, correction_response, started_at),
+                    conversation_response,
+                )
+        finally:
+            if turn.late_correction is None:
+                turn.close()
+
+    async def stream(
+        self, user_input: str, session: Session
+    ) -> AsyncIterator[tuple[str | None, str]]:
+        """
+        Yields `(correction_response, conversation_response)` pairs as the
+        conversation response streams in. The correction response is None until
+        its stages finish, and the final pair always carries both. Strategies
+        whose reply cannot be streamed yield a single pair.
+        """
+        reply_stage = self.strategy.reply_stage
+        if reply_stage.stream is None:
+            yield await self.run(user_input, session)
+            return
+        started_at = time.monotonic()
+        engine_counters.increment("turns")
+        logger.info(f"Streaming `{self.strategy.name}` strategy...")
+        cancel_late_correction(session)
+        turn = Turn(user_input, session, self.strategy.fix_locally)
+        try:
+            with tracer.span(
+                "turn", strategy=self.strategy.name, session=session.session_id
+            ):
+                reply = asyncio.get_running_loop().create_future()
+                correction_response_task = turn.spawn(
+                    self._stream_correction_response(
+                        turn, reply, self._prepared(session)
+                    )
+                )
+                conversation_response = ""
+                async for delta in reply_stage.stream(turn):
+                    conversation_response += delta
+                    correction_response = (
+                        correction_response_task.result()
+                        if correction_response_task.done()
+                        else None
+                    )
+                    yield correction_response, conversation_response
+                turn.results[reply_stage.name] = conversation_response
+                reply.set_result(conversation_response)
+                yield await self._by_deadline(
+                    turn, correction_response_task, started_at
+                ), conversation_response
+        finally:
+            if turn.late_correction is None:
+                turn.close()
+
+
+def _partial_sentence_correction(turn: Turn) -> Correction:
+    """The sentences corrected so far, and those still being corrected as they are."""
+    corrected_sentences, explanations, pending = [], [], False
+    for sentence, future in turn.sentence_corrections:
+        if future.done() and not future.cancelled() and future.exception() is None:
+            corrected_sentence, sentence_explanations = future.result()
+            corrected_sentences.append(corrected_sentence)
+            explanations += sentence_explanations
+        else:
+            corrected_sentences.append(sentence)
+            pending = True
+    if pending:
+        explanations.append(PENDING_EXPLANATIONS)
+    return " ".join(corrected_sentences), explanations
+
+
+def _hand_over(turn: Turn, correction_response: asyncio.Task) -> Future:
+    """
+    A thread-safe future of the late `correction_response`. Cancelling it
+    cancels the correction, and the turn is closed once the correction is done.
+    """
+    late: Future = Future()
+    loop = asyncio.get_running_loop()
+
+    def finished(task: asyncio.Task) -> None:
+        turn.close()
+        try:
+            if task.cancelled():
+                late.cancel()
+            elif task.exception() is not None:
+                late.set_exception(task.exception())
+            else:
+                late.set_result(task.result())
+        except InvalidStateError:
+            # Cancelled in the meantime
+            pass
+
+    def cancelled(late: Future) -> None:
+        if late.cancelled():
+            loop.call_soon_threadsafe(correction_response.cancel)
+
+    correction_response.add_done_callback(finished)
+    late.add_done_callback(cancelled)
+    return late
+
+
+def cancel_late_correction(session: Session) -> None:
+    """Cancel the late correction of the session's last turn, if still running."""
+    late, session.late_correction = session.late_correction, None
+    if late is not None and not late.done() and late.cancel():
+        logger.info("Cancelling the late correction of the last turn...")
+        engine_counters.increment("late_cancelled")
+
+
+async def late_correction(session: Session) -> str | None:
+    """
+    The correction response of the session's last turn once it is ready, if it
+    missed the turn deadline, or None if it did not, has been cancelled or has
+    already been returned.
+    """
+    late = session.late_correction
+    if late is None:
+        return None
+    try:
+        # Shielded, so that giving up waiting does not cancel the correction
+        correction_response = await asyncio.shield(asyncio.wrap_future(late))
+    except asyncio.CancelledError:
+        if late.cancelled():
+            return None
+        raise
+    if session.late_correction is late:
+        session.late_correction = None
+    return correction_response
+
+
+def _withdraw(session: Session, message: dict) -> None:
+    """Take `message` back out of the history, as it will get no reply."""
+    history = session.message_history
+    for i in range(len(history) - 1, -1, -1):
+        if history[i] is message:
+            del history[i]
+            return
+
+
+async def get_conversation_response(turn: Turn) -> str:
+    session = turn.session
+    # Sent as the newest message, and withdrawn if the reply fails or the turn
+    # is cancelled, so the history never holds a message without its reply
+    user_message = {"role": "user", "content": turn.user_input}
+    session.message_history.append(user_message)
+    logger.info("Making request for conversation response...")
+    logger.debug("Sending user input `%s` for conversation response", turn.user_input)
+    try:
+        message = await llm.complete(
+            session,
+            model="gpt-3.5-turbo",
+            messages=history_manager.build_messages(session),
+            temperature=0.8,
+            stage="conversation",
+        )
+    except BaseException:
+        _withdraw(session, user_message)
+        raise
+    conversation_response = message["content"]
+    logger.debug(
+        "Received conversation response `%s` for `%s`",
+        conversation_response,
+        turn.user_input,
+    )
+    session.message_history.append(
+        {"role": "assistant", "content": conversation_response}
+    )
+    history_manager.schedule_summary(session)
+    return conversation_response
+
+
+async def stream_conversation_response(turn: Turn) -> AsyncIterator[str]:
+    session = turn.session
+    # Withdrawn as in `get_conversation_response`, including when the stream
+    # is abandoned part way
+    user_message = {"role": "user", "content": turn.user_input}
+    session.message_history.append(user_message)
+    logger.info("Making streaming request for conversation response...")
+    logger.debug("Streaming conversation response for user input `%s`", turn.user_input)
+    conversation_response = ""
+    try:
+        async for delta in llm.stream(
+            session,
+            model="gpt-3.5-turbo",
+            messages=history_manager.build_messages(session),
+            temperature=0.8,
+            stage="conversation",
+        ):
+            conversation_response += delta
+            yield delta
+    except BaseException:
+        _withdraw(session, user_message)
+        raise
+    logger.debug(
+        "Received conversation response `%s` for `%s`",
+        conversation_response,
+        turn.user_input,
+    )
+    session.message_history.append(
+        {"role": "assistant", "content": conversation_response}
+    )
+    history_manager.schedule_summary(session)
+
+
+# The tutor's reply from the conversation history, shared by the strategies
+# that ask for it separately from the correction
+conversation_stage = Stage(
+    "conversation", get_conversation_response, stream=stream_conversation_response
+)
@@ -1,15 +1,19 @@
-import json
+from collections import deque
 import logging
+import threading
+import time
+from typing import AsyncIterator
 
-import openai
+import jsonschema
 
-from utils import parse_correction_explanations
+import config
+from engine import Engine, Stage, Strategy, Turn, function_arguments
+from history import history_manager
+import llm
+import metrics
+import new_handler
+from session import Session
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level=logging.DEBUG,
-)
 logger = logging.getLogger()
 
 
@@ -17,77 +21,251 @@ def dedent_multiline_string(multiline_string: str) -> str:
     return "\n".join([line.lstrip() for line in multiline_string.split("\n")]).lstrip()
 
 
-def call_api(
-    user_input: str,
-    main_message_history: list,
-    input_tokens_used: int,
-    output_tokens_used: int,
-) -> tuple:
-    function_definition = {
-        "name": "receive_outputs",
-        "description": "A function that receives outputs",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "corrected_input": {
+COMBINED_FUNCTION = {
+    "name": "receive_outputs",
+    "description": "A function that receives outputs",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "corrected_input": {
+                "type": "string",
+                "description": "A Spanish language correction of the user's input",
+            },
+            "corrections": {
+                "type": "array",
+                "items": {
                     "type": "string",
-                    "description": "A Spanish language correction of the user's input",
-                },
-                "corrections": {
-                    "type": "array",
-                    "items": {
-                        "type": "string",
-                        "description": "A specific correction that was made to the user's input",
-                    },
-                    "description": "An exhaustive list of corrections made to the user's input",
+                    "description": "A specific correction that was made to the user's input",
                 },
-                "correction_explanations": {
-                    "type": "array",
-                    "items": {
-                        "type": "string",
-                        "description": "An English language explanation of one specific correction made to the user's input",
-                    },
-                    "description": "An exhaustive list of corrections made to the user's input, with an explanation for each",
-                },
-                "conversation_response": {
+                "description": "An exhaustive list of corrections made to the user's input",
+            },
+            "correction_explanations": {
+                "type": "array",
+                "items": {
                     "type": "string",
-                    "description": "A Spanish language response to the user's input",
+                    "description": "An English language explanation of one specific correction made to the user's input",
                 },
+                "description": "An exhaustive list of corrections made to the user's input, with an explanation for each",
+            },
+            "conversation_response": {
+                "type": "string",
+                "description": "A Spanish language response to the user's input",
             },
-            "required": [
-                "corrected_input",
-                "correction_explanations",
-                "conversation_response",
-            ],
         },
-    }
-    completion = openai.ChatCompletion.create(
+        "required": [
+            "corrected_input",
+            "correction_explanations",
+            "conversation_response",
+        ],
+    },
+}
+
+
+class InvalidResponse(Exception):
+    """The combined response could not be parsed or does not match its schema."""
+
+
+def parse_combined_response(message: dict) -> dict:
+    try:
+        arguments = function_arguments(message)
+        jsonschema.validate(arguments, COMBINED_FUNCTION["parameters"])
+    except (KeyError, TypeError, ValueError, jsonschema.ValidationError) as e:
+        raise InvalidResponse(str(e).split("\n")[0]) from e
+    return arguments
+
+
+async def get_combined_response(turn: Turn) -> dict:
+    session = turn.session
+    # The user turn and the prompt tokens saved are only recorded once the
+    # response has been validated, so a fallback starts from an unchanged
+    # history and does not count the saving twice
+    messages, tokens_saved = history_manager.window(session)
+    messages.append({"role": "user", "content": turn.user_input})
+    logger.info("Making request for combined response...")
+    message = await llm.complete(
+        session,
         model="gpt-3.5-turbo-0613",
-        messages=[{"role": "user", "content": user_input}],
-        functions=[function_definition],
+        messages=messages,
+        functions=[COMBINED_FUNCTION],
         function_call={"name": "receive_outputs"},
         temperature=0.1,
+        stage="combined",
     )
-    logger.debug(f"Received response for `{user_input}`")
-    resp_dict = json.loads(
-        completion.choices[0].message.to_dict()["function_call"]["arguments"]
-    )
-    conversation_response = resp_dict["conversation_response"]
-    main_message_history.append({"role": "assistant", "content": conversation_response})
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
+    logger.debug("Received response for `%s`", turn.user_input)
+    arguments = parse_combined_response(message)
+    session.record_prompt_tokens_saved(tokens_saved)
+    return arguments
 
-    corrected_input = resp_dict["corrected_input"]
-    correction_explanations = resp_dict["correction_explanations"]
-    correction_explanation = parse_correction_explanations(correction_explanations)
 
-    correction_response = "{correction}\n\n{explanation}".format(
-        correction=corrected_input, explanation=correction_explanation
-    )
-    return (
-        correction_response,
-        conversation_response,
-        main_message_history,
-        input_tokens_used,
-        output_tokens_used,
+async def record_conversation_response(turn: Turn) -> str:
+    session = turn.session
+    conversation_response = turn["combined"]["conversation_response"]
+    session.message_history.append({"role": "user", "content": turn.user_input})
+    session.message_history.append(
+        {"role": "assistant", "content": conversation_response}
     )
+    history_manager.schedule_summary(session)
+    return conversation_response
+
+
+strategy = Strategy(
+    name="func_arg",
+    stages=(
+        Stage("combined", get_combined_response),
+        Stage("reply", record_conversation_response, after=("combined",)),
+    ),
+    reply="reply",
+    correction=lambda turn: (
+        turn["combined"]["corrected_input"],
+        turn["combined"]["correction_explanations"],
+    ),
+)
+
+
+class FastPath:
+    """
+    Handles each turn with the single combined request, falling back to the
+    multi-stage `fallback` engine for any turn whose response cannot be parsed
+    or fails schema validation. While fallbacks are common (more than
+    `max_fallback_rate` of the last `window` attempts) turns go straight to the
+    fallback, except every `probe_every`th turn, which tries the fast path again
+    to see whether it has recovered.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        fallback: Engine,
+        window: int = config.FAST_PATH_WINDOW,
+        max_fallback_rate: float = config.FAST_PATH_MAX_FALLBACK_RATE,
+        probe_every: int = config.FAST_PATH_PROBE_EVERY,
+    ):
+        self.engine = engine
+        self.fallback = fallback
+        self.max_fallback_rate = max_fallback_rate
+        self.probe_every = probe_every
+        self.counters = metrics.counters(
+            "fast_path", "turns", "fast", "fallbacks", "bypassed"
+        )
+        self.fast_timings = metrics.timings("fast_path.fast")
+        self.multi_stage_timings = metrics.timings("fast_path.multi_stage")
+        self.turn_timings = metrics.timings("fast_path.turn")
+        # Whether each recent fast path attempt fell back
+        self._window = window
+        self._outcomes: deque[bool] = deque(maxlen=window)
+        self._skipped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def incremental(self) -> bool:
+        return self.fallback.incremental
+
+    def _healthy(self) -> bool:
+        with self._lock:
+            if len(self._outcomes) < min(self._window, 5):
+                return True
+            return sum(self._outcomes) / len(self._outcomes) <= self.max_fallback_rate
+
+    def _try_fast_path(self) -> bool:
+        if self._healthy():
+            return True
+        with self._lock:
+            self._skipped += 1
+            if self._skipped < self.probe_every:
+                return False
+            self._skipped = 0
+        logger.info("Probing the fast path...")
+        return True
+
+    def prepare(self, text: str, session: Session) -> None:
+        # Background corrections are only of use to turns that will fall back
+        if not self._healthy():
+            self.fallback.prepare(text, session)
+
+    async def _fast(self, user_input: str, session: Session) -> tuple[str, str] | None:
+        self.counters.increment("turns")
+        if not self._try_fast_path():
+            self.counters.increment("bypassed")
+            return None
+        started_at = time.monotonic()
+        try:
+            result = await self.engine.run(user_input, session)
+        except InvalidResponse as e:
+            logger.warning(f"Falling back to the multi-stage handler: {e}")
+            self.counters.increment("fallbacks")
+            with self._lock:
+                self._outcomes.append(True)
+            return None
+        elapsed = time.monotonic() - started_at
+        self.counters.increment("fast")
+        self.fast_timings.observe(elapsed)
+        self.turn_timings.observe(elapsed)
+        with self._lock:
+            self._outcomes.append(False)
+        return result
+
+    def _observe_fallback(self, started_at: float, fallback_started_at: float) -> None:
+        ended_at = time.monotonic()
+        self.multi_stage_timings.observe(ended_at - fallback_started_at)
+        self.turn_timings.observe(ended_at - started_at)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Fast path stats: %s", self.stats())
+
+    async def run(self, user_input: str, session: Session) -> tuple[str, str]:
+        started_at = time.monotonic()
+        result = await self._fast(user_input, session)
+        if result is not None:
+            return result
+        fallback_started_at = time.monotonic()
+        result = await self.fallback.run(user_input, session)
+        self._observe_fallback(started_at, fallback_started_at)
+        return result
+
+    async def stream(
+        self, user_input: str, session: Session
+    ) -> AsyncIterator[tuple[str | None, str]]:
+        started_at = time.monotonic()
+        result = await self._fast(user_input, session)
+        if result is not None:
+            yield result
+            return
+        fallback_started_at = time.monotonic()
+        async for pair in self.fallback.stream(user_input, session):
+            yield pair
+        self._observe_fallback(started_at, fallback_started_at)
+
+    def stats(self) -> dict[str, float | None]:
+        """
+        The share of fast path attempts that fell back, and the mean latency
+        saved per fast turn and per turn overall, net of failed attempts,
+        compared with the multi-stage handler.
+        """
+        fast, fallbacks = self.counters["fast"], self.counters["fallbacks"]
+        fast_timings = self.fast_timings.snapshot()
+        multi_stage_timings = self.multi_stage_timings.snapshot()
+        turn_timings = self.turn_timings.snapshot()
+        has_both = fast_timings["count"] and multi_stage_timings["count"]
+        return {
+            "fallback_rate": (
+                fallbacks / (fast + fallbacks) if fast + fallbacks else None
+            ),
+            "fast_ms": fast_timings["mean"] * 1000,
+            "multi_stage_ms": multi_stage_timings["mean"] * 1000,
+            "saving_ms": (
+                (multi_stage_timings["mean"] - fast_timings["mean"]) * 1000
+                if has_both
+                else None
+            ),
+            "net_saving_ms": (
+                (multi_stage_timings["mean"] - turn_timings["mean"]) * 1000
+                if has_both
+                else None
+            ),
+        }
+
+
+fast_path = FastPath(Engine(strategy), new_handler.engine)
+
+
+def call_api(user_input: str, session: Session) -> tuple[str, str]:
+    return llm.run_sync(fast_path.run(user_input, session))
@@ -0,0 +1,260 @@
+"""
+Grade a batch of learner submissions offline, without the UI.
+
+Reads submissions from a JSON-lines file, one `{"id": ..., "text": ...}` per
+line (`id` defaults to the line number), runs each through the correction
+stages of the `new` or `orig` handler across a pool of worker processes, and
+appends one result per submission to a JSON-lines output file each time a
+chunk of submissions (see `--chunk-size`) has been graded. Submissions that
+could not be graded go to `<output>.errors.jsonl` instead, replacing the
+failures of any earlier run, and make the command exit with status 1.
+
+The output doubles as the checkpoint: rerunning the same command skips every
+submission already in it and retries the failed ones, so an interrupted run
+picks up where it stopped, regrading only the chunks that were in flight.
+
+    python grade.py homework.jsonl graded.jsonl --workers 4 --concurrency 16
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from typing import Iterator
+
+logger = logging.getLogger()
+
+HANDLERS = ["new", "orig"]
+
+# Set in each worker process by `_init_worker`
+_engine = None
+
+
+def read_submissions(path: str) -> Iterator[dict]:
+    with open(path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            submission = json.loads(line)
+            yield {
+                "id": str(submission.get("id", line_number)),
+                "text": submission.get("text") or submission.get("user_input", ""),
+            }
+
+
+def errors_path(output: str) -> str:
+    root, _ = os.path.splitext(output)
+    return f"{root}.errors.jsonl"
+
+
+def graded_ids(path: str) -> set[str]:
+    """Ids already in the output, after dropping a last line cut off mid-write."""
+    if not os.path.exists(path):
+        return set()
+    ids = set()
+    with open(path, "r+", encoding="utf-8") as file:
+        complete_bytes = 0
+        for line in file:
+            if not line.endswith("\n"):
+                break
+            ids.add(json.loads(line)["id"])
+            complete_bytes += len(line.encode("utf-8"))
+        file.truncate(complete_bytes)
+    return ids
+
+
+def _init_worker(handler: str, environment: dict[str, str]) -> None:
+    global _engine
+    os.environ.update(environment)
+    # Only now that the environment is set can the handlers import config
+    import tracing
+
+    tracing.configure_logging()
+    if handler == "orig":
+        import orig_handler
+
+        _engine = orig_handler.engine
+    else:
+        import new_handler
+
+        _engine = new_handler.engine
+
+
+async def _grade(submission: dict) -> dict:
+    from session import Session
+
+    session = Session(session_id=f"grade-{submission['id']}")
+    started_at = time.monotonic()
+    result = {"id": submission["id"], "text": submission["text"]}
+    assert _engine is not None, "_init_worker has not run in this process"
+    try:
+        corrected, explanations = await _engine.correct(submission["text"], session)
+        result.update(corrected=corrected, explanations=explanations)
+    except Exception as e:
+        logger.warning(f"Could not grade submission `{submission['id']}`: {e!r}")
+        result["error"] = repr(e)
+    prompt_tokens, completion_tokens = session.tokens_used()
+    result.update(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost=session.ledger.cost(),
+        calls=len(session.ledger.records),
+        seconds=round(time.monotonic() - started_at, 3),
+    )
+    return result
+
+
+async def _grade_all(submissions: list[dict], concurrency: int) -> list[dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def grade(submission: dict) -> dict:
+        async with semaphore:
+            return await _grade(submission)
+
+    return await asyncio.gather(*(grade(submission) for submission in submissions))
+
+
+def grade_chunk(submissions: list[dict], concurrency: int) -> list[dict]:
+    """Grade `submissions` in a worker process, up to `concurrency` at a time."""
+    import llm
+
+    return llm.run_sync(_grade_all(submissions, concurrency))
+
+
+def chunks(submissions: Iterator[dict], size: int) -> Iterator[list[dict]]:
+    while chunk := list(itertools.islice(submissions, size)):
+        yield chunk
+
+
+@dataclass
+class Progress:
+    total: int
+    graded: int = 0
+    errors: int = 0
+    cost: float = 0.0
+    started_at: float = field(default_factory=time.monotonic)
+    reported_at: float = field(default_factory=time.monotonic)
+
+    def add(self, result: dict) -> None:
+        self.graded += 1
+        self.errors += "error" in result
+        self.cost += result["cost"]
+
+    def report(self, every: float = 0.0) -> None:
+        now = time.monotonic()
+        if now - self.reported_at < every:
+            return
+        self.reported_at = now
+        rate = self.graded / (now - self.started_at)
+        projected = self.cost / self.graded * self.total if self.graded else 0.0
+        print(
+            f"{self.graded}/{self.total} graded ({self.errors} failed), "
+            f"{rate:.1f} submissions/s, ${self.cost:.4f} spent, "
+            f"${projected:.4f} projected",
+            flush=True,
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", help="JSON-lines file of submissions")
+    parser.add_argument("output", help="JSON-lines file of results, appended to")
+    parser.add_argument("--handler", choices=HANDLERS, default="new")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="submissions graded at once by each worker",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=0,
+        help="submissions sent to a worker at a time (default: --concurrency)",
+    )
+    parser.add_argument("--limit", type=int, help="grade at most this many")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    import config
+    from tracing import configure_logging
+
+    configure_logging()
+    if not os.getenv("OPENAI_API_KEY"):
+        parser.error("OPENAI_API_KEY must be set in the environment or .env file")
+
+    done = graded_ids(args.output)
+    if done:
+        logger.info(f"Resuming, {len(done)} submissions already graded")
+    pending = itertools.islice(
+        (
+            submission
+            for submission in read_submissions(args.input)
+            if submission["id"] not in done
+        ),
+        args.limit,
+    )
+    total = sum(
+        1 for submission in read_submissions(args.input) if submission["id"] not in done
+    )
+    progress = Progress(total if args.limit is None else min(total, args.limit))
+
+    environment = {"STARTER_POOL_SIZE": "0"}
+    if "LOG_LEVEL" not in os.environ:
+        # Keep the progress lines readable
+        environment["LOG_LEVEL"] = "WARNING"
+    if "SCHEDULER_TOKENS_PER_MINUTE" not in os.environ:
+        # The rate limit is for the API key, which every worker shares
+        environment["SCHEDULER_TOKENS_PER_MINUTE"] = str(
+            max(1, config.SCHEDULER_TOKENS_PER_MINUTE // args.workers)
+        )
+    with ProcessPoolExecutor(
+        args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(args.handler, environment),
+    ) as pool, open(args.output, "a", encoding="utf-8") as output, open(
+        errors_path(args.output), "w", encoding="utf-8"
+    ) as errors:
+
+        def collect(finished: set[Future]) -> None:
+            for future in finished:
+                for result in future.result():
+                    # Failures stay out of the output, so a rerun retries them
+                    file = errors if "error" in result else output
+                    file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    progress.add(result)
+            output.flush()
+            errors.flush()
+            progress.report(every=5.0)
+
+        in_flight: set[Future] = set()
+        for chunk in chunks(pending, args.chunk_size or args.concurrency):
+            # Two chunks per worker keeps every worker busy without reading
+            # the whole input into memory
+            while len(in_flight) >= 2 * args.workers:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(finished)
+            in_flight.add(pool.submit(grade_chunk, chunk, args.concurrency))
+        while in_flight:
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(finished)
+    progress.report()
+    if progress.errors:
+        print(f"Failures written to {errors_path(args.output)}", flush=True)
+        sys.exit(1)
+    os.remove(errors_path(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+
+import config
+import llm
+from session import Session
+from tokens import count_message_tokens, count_single_message_tokens
+
+logger = logging.getLogger()
+
+PROMPT_SUMMARISE_HISTORY = open("prompts/summarise_history.txt", "r").read()
+
+
+class HistoryManager:
+    """
+    Builds the prompt for conversation response requests from a session's full
+    message history: the system prompt, a rolling summary of older turns, and as
+    many recent messages as fit in the last `max_turns` turns and `token_budget`.
+    """
+
+    def __init__(
+        self,
+        max_turns: int = config.HISTORY_MAX_TURNS,
+        token_budget: int = config.HISTORY_TOKEN_BUDGET,
+        summarise: bool = config.HISTORY_SUMMARY_ENABLED,
+        model: str = "gpt-3.5-turbo",
+    ):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summarise = summarise
+        self.model = model
+
+    def build_messages(self, session: Session) -> list[dict]:
+        messages, tokens_saved = self.window(session)
+        session.record_prompt_tokens_saved(tokens_saved)
+        return messages
+
+    def window(self, session: Session) -> tuple[list[dict], int]:
+        """
+        The messages `build_messages` sends and the prompt tokens they save,
+        without recording the saving, for callers whose request may not count.
+        """
+        history = session.message_history
+        messages = history[:1]
+        if session.history_summary:
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"Summary of the earlier conversation: {session.history_summary}",
+                }
+            )
+
+        # A turn is a learner message and the tutor's reply to it
+        first_candidate = max(
+            1 + session.summarised_messages, len(history) - 2 * self.max_turns
+        )
+        budget = self.token_budget - count_message_tokens(messages, self.model)
+        window_start = len(history)
+        while window_start > first_candidate:
+            cost = count_single_message_tokens(history[window_start - 1], self.model)
+            # The newest message is always sent, whatever the budget
+            if cost > budget and window_start < len(history):
+                break
+            budget -= cost
+            window_start -= 1
+        messages.extend(history[window_start:])
+        session.history_window_start = window_start
+
+        full_tokens = count_message_tokens(history, self.model)
+        sent_tokens = count_message_tokens(messages, self.model)
+        tokens_saved = max(0, full_tokens - sent_tokens)
+        logger.debug(
+            "Sending %s of %s history messages, saving %s prompt tokens",
+            len(messages),
+            len(history),
+            tokens_saved,
+        )
+        return messages, tokens_saved
+
+    def schedule_summary(self, session: Session) -> None:
+        """Fold messages that fell out of the window into the summary, off the critical path."""
+        if not self.summarise or session.summary_in_progress:
+            return
+        if session.history_window_start <= 1 + session.summarised_messages:
+            return
+        session.summary_in_progress = True
+        asyncio.run_coroutine_threadsafe(
+            self._update_summary(session), llm.client_loop()
+        )
+
+    async def _update_summary(self, session: Session) -> None:
+        try:
+            start = 1 + session.summarised_messages
+            end = session.history_window_start
+            messages = session.message_history[start:end]
+            conversation = "\n".join(
+                f"{message['role']}: {message['content']}" for message in messages
+            )
+            prompt = PROMPT_SUMMARISE_HISTORY.format(
+                summary=session.history_summary or "(none)",
+                conversation=conversation,
+            )
+            logger.info("Making request for conversation history summary...")
+            message = await llm.complete(
+                session,
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.2,
+                stage="summary",
+            )
+            session.history_summary = message["content"]
+            session.summarised_messages = end - 1
+            logger.debug("Updated conversation summary `%s`", session.history_summary)
+        except Exception:
+            logger.exception("Failed to summarise conversation history")
+        finally:
+            session.summary_in_progress = False
+
+
+history_manager = HistoryManager()
@@ -0,0 +1,139 @@
+import asyncio
+from concurrent.futures import Future
+import hashlib
+import logging
+import re
+import threading
+from typing import Awaitable, Callable
+
+import config
+import llm
+import metrics
+from session import Session
+
+logger = logging.getLogger()
+
+SENTENCE_SPLIT_REGEX = re.compile(r"(?<=[.!?])\s+")
+SENTENCE_END_REGEX = re.compile(r"[.!?]$")
+
+Correction = tuple[str, list[str]]
+
+
+def split_sentences(text: str) -> tuple[list[str], str]:
+    """Split `text` into its completed sentences and the unfinished tail."""
+    sentences = [s for s in SENTENCE_SPLIT_REGEX.split(text.strip()) if s]
+    if sentences and not SENTENCE_END_REGEX.search(sentences[-1]):
+        return sentences[:-1], sentences[-1]
+    return sentences, ""
+
+
+def sentence_key(sentence: str) -> str:
+    return hashlib.sha256(sentence.encode("utf-8")).hexdigest()
+
+
+class IncrementalCorrector:
+    """
+    Corrects the learner's input one sentence at a time while they type. Every
+    change to the textbox starts background work on newly completed sentences
+    and cancels work on sentences that are no longer there, so that on submit
+    only sentences that have not been seen yet (usually just the unfinished
+    tail) still need a round trip.
+
+    Work runs on the LLM client loop and is tracked per session, keyed by a hash
+    of each sentence.
+    """
+
+    def __init__(
+        self,
+        correct: Callable[[str, Session], Awaitable[Correction]],
+        debounce: float = config.INCREMENTAL_CORRECTION_DEBOUNCE_SECONDS,
+    ):
+        self.correct = correct
+        self.debounce = debounce
+        self.counters = metrics.counters(
+            "incremental_correction", "started", "cancelled", "reused", "submitted"
+        )
+        self._lock = threading.Lock()
+
+    async def _correct_sentence(
+        self, sentence: str, session: Session, delay: float
+    ) -> Correction:
+        if delay:
+            await asyncio.sleep(delay)
+        return await self.correct(sentence, session)
+
+    def _start(self, sentence: str, session: Session, delay: float) -> Future:
+        return asyncio.run_coroutine_threadsafe(
+            self._correct_sentence(sentence, session, delay), llm.client_loop()
+        )
+
+    def update(self, text: str, session: Session) -> None:
+        """Start or cancel background corrections to match the current `text`."""
+        sentences, _ = split_sentences(text)
+        keys = {sentence_key(sentence): sentence for sentence in sentences}
+        with self._lock:
+            pending = session.sentence_corrections
+            for key in [key for key in pending if key not in keys]:
+                pending.pop(key).cancel()
+                self.counters.increment("cancelled")
+            for key, sentence in keys.items():
+                if key not in pending:
+                    logger.debug("Correcting completed sentence `%s`", sentence)
+                    pending[key] = self._start(sentence, session, self.debounce)
+                    self.counters.increment("started")
+
+    async def finish(self, text: str, session: Session) -> Correction:
+        """Correct the submitted `text` (see `submit`)."""
+        return await self.gather(self.submit(text, session))
+
+    def submit(self, text: str, session: Session) -> list[tuple[str, Future]]:
+        """
+        Each sentence of the submitted `text` with the future of its correction,
+        reusing the background work on sentences that were completed while
+        typing, and reset for the next input.
+        """
+        sentences, tail = split_sentences(text)
+        if tail:
+            sentences.append(tail)
+        if not sentences:
+            sentences = [text]
+        with self._lock:
+            pending, session.sentence_corrections = session.sentence_corrections, {}
+        futures = []
+        for sentence in sentences:
+            future = pending.pop(sentence_key(sentence), None)
+            if (
+                future is None
+                or future.cancelled()
+                or (future.done() and future.exception() is not None)
+            ):
+                future = self._start(sentence, session, 0)
+                self.counters.increment("submitted")
+            else:
+                self.counters.increment("reused")
+            futures.append(future)
+        for future in pending.values():
+            future.cancel()
+        logger.info(
+            f"Correcting {len(sentences)} sentences on submit, {sum(not f.done() for f in futures)} still in flight"
+        )
+        return list(zip(sentences, futures))
+
+    async def gather(self, submitted: list[tuple[str, Future]]) -> Correction:
+        """The correction of the submitted sentences, once they are all corrected."""
+        futures = [future for _, future in submitted]
+        try:
+            corrections = await asyncio.gather(
+                *(asyncio.wrap_future(future) for future in futures)
+            )
+        finally:
+            for future in futures:
+                future.cancel()
+        return (
+            " ".join(corrected for corrected, _ in corrections),
+            [
+                explanation
+                for _, explanations in corrections
+                for explanation in explanations
+            ],
+        )
@@ -0,0 +1,343 @@
+import asyncio
+import atexit
+import json
+import logging
+import threading
+import time
+from typing import Any, AsyncIterator, Coroutine, TypeVar
+
+import aiohttp
+import openai
+
+from accounting import CallRecord, budget
+from cache import ResponseCache, response_cache
+import config
+from scheduler import CallTiming, call_timing, scheduler
+from session import Session
+from singleflight import single_flight
+from tokens import count_message_tokens, count_tokens
+from tracing import tracer
+
+logger = logging.getLogger()
+
+T = TypeVar("T")
+
+_STREAM_END = object()
+
+# All upstream requests run on one long-lived event loop in a daemon thread, so
+# that one pooled aiohttp session (and its keep-alive TLS connections) can be
+# shared by every caller, whichever event loop or worker thread they run on.
+_client_loop: asyncio.AbstractEventLoop | None = None
+_client_loop_lock = threading.Lock()
+_client_session: aiohttp.ClientSession | None = None
+
+
+def client_loop() -> asyncio.AbstractEventLoop:
+    global _client_loop
+    with _client_loop_lock:
+        if _client_loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="openai-client-loop", daemon=True
+            )
+            thread.start()
+            _client_loop = loop
+    return _client_loop
+
+
+def _get_client_session() -> aiohttp.ClientSession:
+    # Only ever called from the client loop, so no locking is needed here
+    global _client_session
+    if _client_session is None or _client_session.closed:
+        logger.info("Opening pooled HTTP session for OpenAI requests...")
+        connector = aiohttp.TCPConnector(
+            limit=config.OPENAI_MAX_CONNECTIONS,
+            limit_per_host=config.OPENAI_MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=config.OPENAI_KEEPALIVE_SECONDS,
+        )
+        _client_session = aiohttp.ClientSession(connector=connector)
+    return _client_session
+
+
+def _function_tokens(model: str, kwargs: dict) -> int:
+    if "functions" not in kwargs:
+        return 0
+    return count_tokens(json.dumps(kwargs["functions"]), model)
+
+
+def _completion_tokens_estimate(kwargs: dict) -> int:
+    return kwargs.get("max_tokens", config.SCHEDULER_COMPLETION_TOKENS_ESTIMATE)
+
+
+def _estimate_tokens(model: str, kwargs: dict) -> int:
+    """Tokens to reserve from the budget before the real usage is known."""
+    return (
+        count_message_tokens(kwargs["messages"], model)
+        + _function_tokens(model, kwargs)
+        + _completion_tokens_estimate(kwargs)
+    )
+
+
+async def _create_chat_completion(timing: CallTiming | None, **kwargs: Any) -> Any:
+    openai.aiosession.set(_get_client_session())
+    call_timing.set(timing)
+    model = kwargs["model"]
+    estimated_tokens = _estimate_tokens(model, kwargs)
+    completion = await scheduler.call(
+        model, estimated_tokens, lambda: openai.ChatCompletion.acreate(**kwargs)
+    )
+    scheduler.token_bucket(model).adjust(
+        completion.usage.total_tokens - estimated_tokens
+    )
+    return completion
+
+
+async def create_chat_completion(
+    *, timing: CallTiming | None = None, **kwargs: Any
+) -> Any:
+    """
+    Async drop-in for `openai.ChatCompletion.create`, usable from any event loop.
+    Cancelling the awaiting task cancels the upstream request. Time spent queued
+    by the scheduler is added to `timing`, if given.
+    """
+    future = asyncio.run_coroutine_threadsafe(
+        _create_chat_completion(timing, **kwargs), client_loop()
+    )
+    return await asyncio.wrap_future(future)
+
+
+async def _stream_chat_completion(
+    queue: asyncio.Queue,
+    consumer_loop: asyncio.AbstractEventLoop,
+    timing: CallTiming | None,
+    **kwargs: Any,
+) -> None:
+    def put(item: Any) -> None:
+        consumer_loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    openai.aiosession.set(_get_client_session())
+    call_timing.set(timing)
+    model = kwargs["model"]
+    estimated_tokens = _estimate_tokens(model, kwargs)
+    charged = False
+    chunks = []
+    try:
+        # The slot is held for the whole stream; only opening it is retried
+        async with scheduler.slot(model, estimated_tokens):
+            charged = True
+            response = await scheduler.call(
+                model,
+                estimated_tokens,
+                lambda: openai.ChatCompletion.acreate(stream=True, **kwargs),
+                hedge=False,
+                acquire_slot=False,
+            )
+            async for chunk in response:
+                delta = chunk.choices[0].delta.get("content")
+                if delta:
+                    chunks.append(delta)
+                    put(delta)
+    except Exception as e:
+        put(e)
+    finally:
+        if charged:
+            # Streams carry no usage, so the completion estimate is swapped for
+            # a local count of the tokens actually streamed
+            scheduler.token_bucket(model).adjust(
+                count_tokens("".join(chunks), model)
+                - _completion_tokens_estimate(kwargs)
+            )
+        put(_STREAM_END)
+
+
+async def stream_chat_completion(
+    *, timing: CallTiming | None = None, **kwargs: Any
+) -> AsyncIterator[str]:
+    """
+    Stream the content deltas of a chat completion, usable from any event loop.
+    Closing the iterator early cancels the upstream request.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        _stream_chat_completion(queue, asyncio.get_running_loop(), timing, **kwargs),
+        client_loop(),
+    )
+    try:
+        while (item := await queue.get()) is not _STREAM_END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        future.cancel()
+
+
+async def complete(
+    session: Session,
+    *,
+    model: str,
+    messages: list[dict],
+    temperature: float,
+    stage: str = "other",
+    template: str | None = None,
+    **kwargs: Any,
+) -> dict:
+    """
+    Request a chat completion and return its message as a dict, recording the
+    call against `session` under `stage`. Passing the name of the prompt
+    `template` marks the call as deterministic, so its message is served from and
+    stored in the response cache, and an identical request already in flight for
+    any session is shared rather than repeated; both cost no tokens. Raises
+    `accounting.BudgetExceeded` without sending anything if the request is over
+    budget.
+    """
+    with tracer.span(
+        "llm.complete", stage=stage, model=model, template=template
+    ) as span:
+        messages, _ = budget.apply(
+            session.ledger,
+            model,
+            messages,
+            _function_tokens(model, kwargs),
+            _completion_tokens_estimate(kwargs),
+        )
+        cache_key = None
+        if template is not None:
+            cache_key = ResponseCache.make_key(
+                model, template, {"messages": messages, **kwargs}, temperature
+            )
+        if cache_key is not None and response_cache is not None:
+            message = await response_cache.aget(cache_key)
+            if message is not None:
+                logger.debug("Serving `%s` response from cache", template)
+                session.record_call(CallRecord(stage, model, cached=True))
+                span.set(cached=True)
+                return message
+        timing = CallTiming()
+        started_at = time.monotonic()
+        request = dict(model=model, messages=messages, temperature=temperature)
+        if cache_key is not None and single_flight is not None:
+            completion, owner = await single_flight.do(
+                cache_key,
+                lambda: _create_chat_completion(timing, **request, **kwargs),
+                client_loop(),
+            )
+        else:
+            completion = await create_chat_completion(
+                timing=timing, **request, **kwargs
+            )
+            owner = True
+        message = completion.choices[0].message.to_dict_recursive()
+        if not owner:
+            logger.debug("Shared in-flight `%s` request", template)
+            session.record_call(
+                CallRecord(
+                    stage,
+                    model,
+                    wall_time=time.monotonic() - started_at,
+                    coalesced=True,
+                )
+            )
+            span.set(cached=False, coalesced=True)
+            return message
+        record = CallRecord(
+            stage,
+            model,
+            prompt_tokens=completion.usage.prompt_tokens,
+            completion_tokens=completion.usage.completion_tokens,
+            wall_time=time.monotonic() - started_at,
+            queue_time=timing.queue_time,
+        )
+        session.record_call(record)
+        span.set(
+            cached=False,
+            prompt_tokens=record.prompt_tokens,
+            completion_tokens=record.completion_tokens,
+            queue_time=timing.queue_time,
+            retries=timing.retries,
+            hedged=timing.hedged,
+        )
+        if cache_key is not None and response_cache is not None:
+            await response_cache.aset(cache_key, message)
+        return message
+
+
+async def stream(
+    session: Session,
+    *,
+    model: str,
+    messages: list[dict],
+    temperature: float,
+    stage: str = "other",
+    **kwargs: Any,
+) -> AsyncIterator[str]:
+    """
+    Like `complete`, but yields the message content as it is generated. Streamed
+    responses carry no `usage`, so tokens are counted locally and charged to
+    `session` once the stream ends, including when it is abandoned part way.
+    """
+    with tracer.span("llm.stream", stage=stage, model=model) as span:
+        messages, prompt_tokens = budget.apply(
+            session.ledger,
+            model,
+            messages,
+            _function_tokens(model, kwargs),
+            _completion_tokens_estimate(kwargs),
+        )
+        chunks = []
+        timing = CallTiming()
+        started_at = time.monotonic()
+        try:
+            async for delta in stream_chat_completion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                timing=timing,
+                **kwargs,
+            ):
+                chunks.append(delta)
+                yield delta
+        finally:
+            record = CallRecord(
+                stage,
+                model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=count_tokens("".join(chunks), model),
+                wall_time=time.monotonic() - started_at,
+                queue_time=timing.queue_time,
+                estimated=True,
+            )
+            session.record_call(record)
+            span.set(
+                prompt_tokens=record.prompt_tokens,
+                completion_tokens=record.completion_tokens,
+                queue_time=timing.queue_time,
+                retries=timing.retries,
+            )
+
+
+def complete_sync(session: Session, **kwargs: Any) -> dict:
+    return run_sync(complete(session, **kwargs))
+
+
+def run_sync(coroutine: Coroutine[Any, Any, T]) -> T:
+    """
+    Run a coroutine on the client loop and block until it finishes. Must not be
+    called from a coroutine already running on the client loop.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, client_loop()).result()
+
+
+async def _close_client_session() -> None:
+    if _client_session is not None and not _client_session.closed:
+        await _client_session.close()
+
+
+@atexit.register
+def close() -> None:
+    if _client_loop is None or not _client_loop.is_running():
+        return
+    future = asyncio.run_coroutine_threadsafe(_close_client_session(), _client_loop)
+    try:
+        future.result(timeout=5)
+    except Exception:
+        logger.exception("Failed to close pooled HTTP session")
@@ -0,0 +1,251 @@
+"""
+Fixes the errors that need no model to correct: missing accents on words that
+are never written without one, the accent on the question word opening a
+question, inverted question and exclamation marks, and the capital letter at
+the start of each sentence. The input is fixed before it is sent for
+correction, so the model only has the remaining errors left to find, and each
+fix comes with a canned explanation.
+"""
+
+from dataclasses import dataclass
+import logging
+import re
+
+from unidecode import unidecode
+
+import config
+import metrics
+
+logger = logging.getLogger()
+
+# Keeps the whitespace between sentences, so the text can be put back together
+SENTENCE_SPLIT_REGEX = re.compile(r"(?<=[.!?])(\s+)")
+WORD_REGEX = re.compile(r"[^\W\d_]+")
+ENDING_REGEX = re.compile(r"[?!]+\W*$")
+CLAUSE_REGEX = re.compile(r"[,;:]\s*(?=[^,;:]*$)")
+
+INTERROGATIVES = {
+    "adonde": "adónde",
+    "como": "cómo",
+    "cual": "cuál",
+    "cuales": "cuáles",
+    "cuando": "cuándo",
+    "cuanta": "cuánta",
+    "cuantas": "cuántas",
+    "cuanto": "cuánto",
+    "cuantos": "cuántos",
+    "donde": "dónde",
+    "que": "qué",
+    "quien": "quién",
+    "quienes": "quiénes",
+}
+# The question word opening a clause, possibly after "por" ("por qué")
+INTERROGATIVE_REGEX = re.compile(
+    r"(?:por\s+)?({})\b".format(
+        "|".join(sorted(INTERROGATIVES, key=len, reverse=True))
+    ),
+    re.IGNORECASE,
+)
+# Every Spanish word with one of these endings carries the accent on it
+ACCENTED_SUFFIXES = (("cion", "ción"), ("sion", "sión"))
+INVERTED_MARKS = {"?": "¿", "!": "¡"}
+
+MARK_EXPLANATIONS = {
+    "¿": '"¿" was added because Spanish questions open with an inverted question mark.',
+    "¡": '"¡" was added because Spanish exclamations open with an inverted exclamation mark.',
+}
+
+
+def _match_case(word: str, replacement: str) -> str:
+    if len(word) > 1 and word.isupper():
+        return replacement.upper()
+    if word[0].isupper():
+        return replacement[0].upper() + replacement[1:]
+    return replacement
+
+
+@dataclass(frozen=True)
+class Fix:
+    """One change made by the fixer: `before` became `after`."""
+
+    kind: str
+    before: str
+    after: str
+    explanation: str
+
+    def kept_in(self, corrected: str) -> bool:
+        """Whether the change is still there in the final `corrected` text."""
+        pattern = re.escape(self.after)
+        if self.after[0].isalnum():
+            pattern = rf"(?<!\w){pattern}"
+        if self.after[-1].isalnum():
+            pattern = rf"{pattern}(?!\w)"
+        # A capitalised accent fix still counts as kept
+        flags = re.IGNORECASE if self.kind == "accent" else 0
+        return re.search(pattern, corrected, flags) is not None
+
+
+@dataclass
+class LocalFix:
+    text: str
+    fixed: str
+    fixes: list[Fix]
+
+    def explanations(self, corrected: str) -> list[str]:
+        """Explanations of the fixes that `corrected` kept, each given once."""
+        return list(
+            dict.fromkeys(
+                fix.explanation for fix in self.fixes if fix.kept_in(corrected)
+            )
+        )
+
+
+class LocalFixer:
+    """
+    Rule-based fixer for accents, inverted punctuation and capitalisation.
+    `accented_words` maps words written without their accents (and with "n"
+    for "ñ") to their correct spelling, and must only hold words whose
+    unaccented spelling is not a word itself.
+    """
+
+    def __init__(self, accented_words: dict[str, str]):
+        self.accented_words = accented_words
+        self.counters = metrics.counters(
+            "local_fixer", "inputs", "fixed", "fixes", "sufficient"
+        )
+
+    @classmethod
+    def load(cls, path: str = config.ACCENTED_WORDS_PATH) -> "LocalFixer":
+        with open(path, "r", encoding="utf-8") as file:
+            words = [
+                line.strip()
+                for line in file
+                if line.strip() and not line.startswith("#")
+            ]
+        return cls({unidecode(word).lower(): word.lower() for word in words})
+
+    def fix(self, text: str) -> LocalFix:
+        self.counters.increment("inputs")
+        fixes: list[Fix] = []
+        parts = SENTENCE_SPLIT_REGEX.split(text)
+        # Odd parts are the whitespace between sentences
+        fixed = "".join(
+            part if i % 2 else self._fix_sentence(part, fixes)
+            for i, part in enumerate(parts)
+        )
+        if fixes:
+            self.counters.increment("fixed")
+            self.counters.increment("fixes", len(fixes))
+            logger.debug("Fixed `%s` locally to `%s`", text, fixed)
+        return LocalFix(text, fixed, fixes)
+
+    def record_correction(self, local_fix: LocalFix, corrected: str) -> None:
+        """Count the turns where the fixes were the only correction needed."""
+        if local_fix.fixes and corrected.strip() == local_fix.fixed.strip():
+            self.counters.increment("sufficient")
+
+    def _fix_sentence(self, sentence: str, fixes: list[Fix]) -> str:
+        sentence = WORD_REGEX.sub(
+            lambda match: self._accent(match.group(), fixes), sentence
+        )
+        ending = ENDING_REGEX.search(sentence)
+        if ending is not None:
+            sentence = self._mark(sentence, INVERTED_MARKS[ending.group()[0]], fixes)
+        return self._capitalise(sentence, fixes)
+
+    def _mark(self, sentence: str, mark: str, fixes: list[Fix]) -> str:
+        if mark in sentence:
+            start = sentence.index(mark) + 1
+        else:
+            clause_start = self._clause_start(sentence)
+            if clause_start is None:
+                return sentence
+            sentence = sentence[:clause_start] + mark + sentence[clause_start:]
+            fixes.append(Fix("mark", "", mark, MARK_EXPLANATIONS[mark]))
+            start = clause_start + 1
+        # Exclamations are left alone, as "que" there is often a wish ("que te
+        # vaya bien"), and so are questions that carry on past a comma, as the
+        # word opening them may not be a question word ("cuando llegas, ...")
+        if mark == "¿" and CLAUSE_REGEX.search(sentence, start) is None:
+            sentence = self._accent_interrogative(sentence, start, fixes)
+        return sentence
+
+    def _accent(self, word: str, fixes: list[Fix]) -> str:
+        lower = word.lower()
+        accented = self.accented_words.get(lower)
+        if accented is None:
+            for suffix, accented_suffix in ACCENTED_SUFFIXES:
+                if lower.endswith(suffix) and len(lower) > len(suffix) + 1:
+                    accented = lower[: -len(suffix)] + accented_suffix
+                    break
+        if accented is None or accented == lower:
+            return word
+        accented = _match_case(word, accented)
+        reason = (
+            "it is always written with an accent"
+            if any(c in "áéíóú" for c in accented.lower())
+            else 'it is written with "ñ"'
+        )
+        fixes.append(
+            Fix(
+                "accent",
+                word,
+                accented,
+                f'"{word}" was changed to "{accented}" because {reason}.',
+            )
+        )
+        return accented
+
+    def _clause_start(self, sentence: str) -> int | None:
+        """
+        Where the question or exclamation starts: with the sentence if it has
+        no comma, or after the last comma if a question word follows it ("Hola,
+        ¿cómo estás?"). Otherwise it could start with either ("Cuando llegas,
+        ¿me llamas?" but "¿Dónde está el baño, por favor?"), and is left to the
+        model (None).
+        """
+        clause = CLAUSE_REGEX.search(sentence)
+        if clause is None:
+            return len(sentence) - len(sentence.lstrip())
+        if INTERROGATIVE_REGEX.match(sentence, clause.end()):
+            return clause.end()
+        return None
+
+    def _accent_interrogative(self, sentence: str, start: int, fixes: list[Fix]) -> str:
+        match = INTERROGATIVE_REGEX.match(sentence, start)
+        if match is None:
+            return sentence
+        word = match.group(1)
+        accented = _match_case(word, INTERROGATIVES[word.lower()])
+        fixes.append(
+            Fix(
+                "accent",
+                word,
+                accented,
+                f'"{word}" was changed to "{accented}" because question words are written with an accent.',
+            )
+        )
+        return sentence[: match.start(1)] + accented + sentence[match.end(1) :]
+
+    def _capitalise(self, sentence: str, fixes: list[Fix]) -> str:
+        match = WORD_REGEX.search(sentence)
+        if (
+            match is None
+            or not match.group()[0].islower()
+            or sentence[: match.start()].strip("¿¡\"'«( ")
+        ):
+            return sentence
+        word = match.group()
+        capitalised = word[0].upper() + word[1:]
+        fixes.append(
+            Fix(
+                "capital",
+                word,
+                capitalised,
+                f'"{word}" was changed to "{capitalised}" because sentences start with a capital letter.',
+            )
+        )
+        return sentence[: match.start()] + capitalised + sentence[match.end() :]
+
+
+local_fixer = LocalFixer.load() if config.LOCAL_FIXER_ENABLED else None
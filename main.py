@@ -1,18 +1,23 @@
 import logging
 import os
-import random
+from typing import AsyncIterator, Awaitable
 
 from dotenv import load_dotenv
 import gradio
 import openai
 
-from new_handler import call_api
+from accounting import BudgetExceeded
+import config
+from engine import Engine, late_correction
+import func_arg_handler
+from func_arg_handler import FastPath
+import new_handler
+import orig_handler
+from session import Session
+from starter_pool import starter_pool
+from store import build_session_store
+import tracing
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level=logging.DEBUG,
-)
 logger = logging.getLogger()
 
 load_dotenv()
@@ -36,90 +41,144 @@ def check_api_key() -> None:
             exit()
 
 
-check_api_key()
-
-COST_PER_1K_INPUT_TOKENS = 0.0015  # USD
-COST_PER_1K_OUTPUT_TOKENS = 0.002  # USD
-PROMPT_CONVERSATION_STARTER = open("prompts/conversation_starter.txt", "r").read()
 PROMPT_SYSTEM_MAIN = open("prompts/system_main.txt", "r").read()
 
-main_message_history = [
-    {"role": "system", "content": PROMPT_SYSTEM_MAIN},
-]
-input_tokens_used = 0
-output_tokens_used = 0
+ENGINES: dict[str, Engine | FastPath] = {
+    "new": new_handler.engine,
+    "orig": orig_handler.engine,
+    "func_arg": func_arg_handler.fast_path,
+}
+engine = ENGINES[config.HANDLER_STRATEGY]
 
+sessions = build_session_store()
 
-def conversation_topic() -> str:
-    with open("conversation_topics_parsed.txt", "r", encoding="utf-8") as file:
-        lines = file.readlines()
-    return random.choice(lines).strip()
 
+def accountant_message(session: Session) -> str:
+    input_tokens_used, output_tokens_used = session.tokens_used()
+    message = f"You've spent ${session.ledger.cost():.3f} USD on this conversation. You've used {input_tokens_used} input tokens and {output_tokens_used} output tokens."
+    if session.cached_responses:
+        message += f" {session.cached_responses} responses were served from the cache at no cost."
+    if session.coalesced_responses:
+        message += f" {session.coalesced_responses} responses were shared with identical requests from other learners at no cost."
+    if session.prompt_tokens_saved:
+        message += f" Trimming the conversation history saved {session.last_prompt_tokens_saved} prompt tokens this turn and {session.prompt_tokens_saved} in total."
+    stage_lines = [
+        f"{stage}: {totals.calls} calls, {totals.prompt_tokens + totals.completion_tokens} tokens, ${totals.cost:.4f}, {totals.wall_time / totals.calls:.2f}s average ({totals.queue_time / totals.calls:.2f}s queued)"
+        for stage, totals in session.ledger.by_stage().items()
+    ]
+    if stage_lines:
+        message += "\n\n" + "\n".join(stage_lines)
+    return message
 
-def conversation_starter(conversation_topic: str) -> str:
-    global input_tokens_used, output_tokens_used
-    logger.info(
-        f"Making request for conversation starter about topic `{conversation_topic}`..."
-    )
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": PROMPT_SYSTEM_MAIN},
-            {
-                "role": "user",
-                "content": PROMPT_CONVERSATION_STARTER.format(conversation_topic),
-            },
-        ],
-        temperature=0.8,
-    )
-    conversation_starter = completion.choices[0].message.content
-    logger.debug(f"Received conversation starter `{conversation_starter}`")
-    main_message_history.append({"role": "assistant", "content": conversation_starter})
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
-    return conversation_starter
 
+def session_description(session: Session) -> str:
+    return f'**A Spanish language tutor powered by GPT3.5**.<br><br>Your conversation topic is: **{session.topic}**. Your conversation starter is...<br><br>"{session.starter}"'
 
-def accountant_message(input_tokens_used: int, output_tokens_used: int) -> str:
-    input_cost = COST_PER_1K_INPUT_TOKENS * input_tokens_used / 1000
-    output_cost = COST_PER_1K_OUTPUT_TOKENS * output_tokens_used / 1000
-    return f"You've spent ${input_cost + output_cost:.3f} USD on this conversation. You've used {input_tokens_used} input tokens and {output_tokens_used} output tokens."
 
+async def create_session() -> Session:
+    session = sessions.create([{"role": "system", "content": PROMPT_SYSTEM_MAIN}])
+    logger.info(f"Starting session `{session.session_id}`...")
+    session.topic, session.starter = await starter_pool.get(session)
+    session.message_history.append({"role": "assistant", "content": session.starter})
+    await sessions.asave(session)
+    return session
 
-def chat(user_input: str) -> tuple:
-    global main_message_history, input_tokens_used, output_tokens_used
-    logger.info("Chat initiated by user...")
-    (
-        correction_message,
-        response_message,
-        main_message_history,
-        input_tokens_used,
-        output_tokens_used,
-    ) = call_api(
-        user_input, main_message_history, input_tokens_used, output_tokens_used
-    )
-    return (
-        correction_message,
-        response_message,
-        accountant_message(input_tokens_used, output_tokens_used),
-    )
 
+async def start_session() -> tuple[str, str]:
+    session = await create_session()
+    return session.session_id, session_description(session)
 
-convo_topic = conversation_topic()
-convo_starter = conversation_starter(convo_topic)
 
-demo = gradio.Interface(
-    fn=chat,
-    inputs=gradio.inputs.Textbox(
+async def chat(user_input: str, session_id: str | None) -> AsyncIterator[tuple]:
+    session = await sessions.aget(session_id or None)
+    if session is None:
+        raise gradio.Error("Your session has expired. Please reload the page.")
+    logger.info("Chat initiated by user...")
+    if config.STREAM_RESPONSES:
+        responses = engine.stream(user_input, session)
+    else:
+        responses = _single_response(engine.run(user_input, session))
+    try:
+        async for correction_message, response_message in responses:
+            yield (
+                correction_message or "",
+                response_message,
+                accountant_message(session),
+            )
+    except BudgetExceeded as e:
+        await sessions.asave(session)
+        raise gradio.Error(str(e))
+    # A summary of older messages still being made is saved with the next turn
+    await sessions.asave(session)
+
+
+async def fill_late_correction(session_id: str | None) -> tuple:
+    """
+    Replace the partial correction shown for a turn that missed its deadline
+    with the full correction once it is ready.
+    """
+    session = await sessions.aget(session_id or None)
+    if session is None:
+        return gradio.update(), gradio.update()
+    try:
+        correction_message = await late_correction(session)
+    except Exception:
+        logger.exception("Late correction failed")
+        correction_message = None
+    if correction_message is None:
+        return gradio.update(), gradio.update()
+    await sessions.asave(session)
+    return correction_message, accountant_message(session)
+
+
+def prepare_correction(user_input: str, session_id: str | None) -> None:
+    session = sessions.get(session_id or None)
+    if session is not None:
+        engine.prepare(user_input, session)
+
+
+async def _single_response(
+    response: Awaitable[tuple[str, str]],
+) -> AsyncIterator[tuple[str, str]]:
+    yield await response
+
+
+with gradio.Blocks(title="Spanish Language Tutor") as demo:
+    # Held in the page rather than in gradio.State, which lives in the memory
+    # of whichever worker process served the page
+    session_id = gradio.Textbox(visible=False)
+    gradio.Markdown("# Spanish Language Tutor")
+    description = gradio.Markdown()
+    user_input = gradio.Textbox(
         label="User input", lines=2, placeholder="Say something..."
-    ),
-    outputs=[
-        gradio.outputs.Textbox(label="Correction"),
-        gradio.outputs.Textbox(label="Response"),
-        gradio.outputs.Textbox(label="Accountant"),
-    ],
-    title="Spanish Language Tutor",
-    description=f'<b>A Spanish language tutor powered by GPT3.5</b>.<br><br>Your conversation topic is: <b>{convo_topic}</b>. Your conversation starter is...<br><br>"{convo_starter}"',
-)
-
-demo.launch()
+    )
+    submit_button = gradio.Button("Submit", variant="primary")
+    correction_output = gradio.Textbox(label="Correction")
+    response_output = gradio.Textbox(label="Response")
+    accountant_output = gradio.Textbox(label="Accountant")
+
+    demo.load(start_session, inputs=None, outputs=[session_id, description])
+    if engine.incremental:
+        user_input.change(
+            prepare_correction, inputs=[user_input, session_id], queue=False
+        )
+    turn_event = submit_button.click(
+        chat,
+        inputs=[user_input, session_id],
+        outputs=[correction_output, response_output, accountant_output],
+    )
+    if config.TURN_DEADLINE_SECONDS:
+        # Not queued, so that waiting for the late correction holds up nobody,
+        # including the learner's own next turn, which cancels it
+        turn_event.then(
+            fill_late_correction,
+            inputs=[session_id],
+            outputs=[correction_output, accountant_output],
+            queue=False,
+        )
+
+if __name__ == "__main__":
+    tracing.configure_logging()
+    check_api_key()
+    starter_pool.start()
+    demo.queue().launch()
@@ -0,0 +1,86 @@
+from collections import deque
+import threading
+
+
+class Counters:
+    """Thread-safe named counters for process-wide metrics."""
+
+    def __init__(self, *names: str):
+        self._counts = dict.fromkeys(names, 0)
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def __getitem__(self, name: str) -> int:
+        with self._lock:
+            return self._counts.get(name, 0)
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+class Timings:
+    """Thread-safe record of durations, keeping the most recent for percentiles."""
+
+    def __init__(self, window: int = 1000):
+        self._recent: deque[float] = deque(maxlen=window)
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._recent.append(seconds)
+            self._count += 1
+            self._total += seconds
+            self._max = max(self._max, seconds)
+
+    def percentile(self, p: float) -> float | None:
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, int(p / 100 * len(recent)))]
+
+    def snapshot(self) -> dict[str, float]:
+        with self._lock:
+            count, total, maximum = self._count, self._total, self._max
+        return {
+            "count": count,
+            "mean": total / count if count else 0.0,
+            "p50": self.percentile(50) or 0.0,
+            "p95": self.percentile(95) or 0.0,
+            "p99": self.percentile(99) or 0.0,
+            "max": maximum,
+        }
+
+
+_counters: dict[str, Counters] = {}
+_timings: dict[str, Timings] = {}
+_registry_lock = threading.Lock()
+
+
+def counters(group: str, *names: str) -> Counters:
+    """Get or create the counters registered under `group`."""
+    with _registry_lock:
+        if group not in _counters:
+            _counters[group] = Counters(*names)
+        return _counters[group]
+
+
+def timings(name: str) -> Timings:
+    """Get or create the timings registered under `name`."""
+    with _registry_lock:
+        if name not in _timings:
+            _timings[name] = Timings()
+        return _timings[name]
+
+
+def snapshot() -> dict[str, dict]:
+    with _registry_lock:
+        metrics: dict[str, Counters | Timings] = {**_counters, **_timings}
+    return {name: metric.snapshot() for name, metric in metrics.items()}
@@ -1,72 +1,71 @@
-from concurrent.futures import ThreadPoolExecutor
-import json
+import asyncio
+from dataclasses import dataclass
 import logging
+from typing import AsyncIterator
 
-import openai
-
-from utils import parse_correction_explanations
-
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level=logging.DEBUG,
+from alignment import align_correction, pair_key
+import config
+from engine import (
+    PENDING_EXPLANATIONS,
+    Call,
+    Engine,
+    Stage,
+    Strategy,
+    Turn,
+    conversation_stage,
+    function_arguments,
+    pending_correction,
+)
+from incremental import Correction
+import llm
+import metrics
+from session import Session
+from similarity_index import indexed_correction
+from utils import (
+    batched,
+    correction_is_trivial,
+    explanations_function_definition,
+    parse_explanations_function_call,
 )
+
 logger = logging.getLogger()
 
 PROMPT_TRANSLATE_INPUT = open("prompts/translate_input.txt", "r").read()
 PROMPT_CORRECTION_TUPLES = open("prompts/correction_tuples.txt", "r").read()
 PROMPT_EXPLAIN_CORRECTION = open("prompts/explain_correction.txt", "r").read()
+PROMPT_EXPLAIN_CORRECTIONS_BATCH = open(
+    "prompts/explain_corrections_batch.txt", "r"
+).read()
 
-main_message_history: list | None = None
-input_tokens_used: int | None = None
-output_tokens_used: int | None = None
+alignment_counters = metrics.counters("correction_alignment", "local", "llm_fallbacks")
+speculation_counters = metrics.counters(
+    "correction_speculation", "turns", "speculated", "hits", "misses", "cancelled"
+)
 
+# Where a turn keeps the explanations received so far, by `pair_key`, for a
+# partial correction to show if the turn misses its deadline
+FINISHED_EXPLANATIONS = "finished_explanations"
 
-def get_conversation_response(user_input: str) -> str:
-    global main_message_history, input_tokens_used, output_tokens_used
-    if main_message_history is None:
-        raise ValueError("main_message_history is not set")
-    main_message_history.append({"role": "user", "content": user_input})
-    logger.info("Making request for conversation response...")
-    logger.debug(f"Sending user input `{user_input}` for conversation response")
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", messages=main_message_history, temperature=0.8
-    )
-    conversation_response = completion.choices[0].message.content
-    logger.debug(
-        f"Received conversation response `{conversation_response}` for `{user_input}`"
-    )
-    main_message_history.append({"role": "assistant", "content": conversation_response})
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
-    return conversation_response
-
-
-def get_corrected_input(input_str: str) -> str:
-    global input_tokens_used, output_tokens_used
-    prompt = PROMPT_TRANSLATE_INPUT.format(input_str=input_str)
-    logger.info("Making request for corrected input...")
-    logger.debug(f"Sending input `{input_str}` for correction")
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-    )
-    corrected_input = completion.choices[0].message.content.replace('"', "")
-    logger.debug(f"Received corrected input `{corrected_input}` for `{input_str}`")
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
-    return corrected_input
-
-
-def get_correction_tuples(
-    input_str: str, corrected_input: str
-) -> list[tuple[str, str]]:
-    global input_tokens_used, output_tokens_used
-    prompt = PROMPT_CORRECTION_TUPLES.format(
-        input_text=input_str, corrected_text=corrected_input
-    )
-    function_definition = {
+
+def parse_correction_tuples(message: dict) -> list[tuple[str, str]]:
+    correction_tuples = function_arguments(message)["correction_tuples"]
+    return [ct for ct in correction_tuples if ct[0] != ct[1]]
+
+
+CORRECTED_INPUT = Call(
+    PROMPT_TRANSLATE_INPUT,
+    temperature=0.2,
+    stage="correction",
+    template="translate_input",
+    parser=lambda message: message["content"].replace('"', ""),
+)
+CORRECTION_TUPLES = Call(
+    PROMPT_CORRECTION_TUPLES,
+    model="gpt-3.5-turbo-0613",
+    temperature=0.1,
+    stage="tuples",
+    template="correction_tuples",
+    function={
         "name": "receive_outputs",
         "description": "A function that receives outputs",
         "parameters": {
@@ -90,106 +89,336 @@ def get_correction_tuples(
                 "correction_tuples",
             ],
         },
-    }
-    logger.info("Making request for correction tuples...")
-    logger.debug(f"Getting correction tuples for `{input_str}` and `{corrected_input}`")
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo-0613",
-        messages=[{"role": "user", "content": prompt}],
-        functions=[function_definition],
-        function_call={"name": "receive_outputs"},
-        temperature=0.1,
+    },
+    parser=parse_correction_tuples,
+)
+EXPLAIN_CORRECTION = Call(
+    PROMPT_EXPLAIN_CORRECTION,
+    temperature=0.2,
+    stage="explanation",
+    template="explain_correction",
+)
+EXPLAIN_CORRECTIONS_BATCH = Call(
+    PROMPT_EXPLAIN_CORRECTIONS_BATCH,
+    model="gpt-3.5-turbo-0613",
+    temperature=0.2,
+    stage="explanation",
+    template="explain_corrections_batch",
+    parser=parse_explanations_function_call,
+)
+
+
+async def get_corrected_input(turn: Turn) -> str:
+    return await indexed_correction(
+        turn, CORRECTED_INPUT, turn.correction_input, input_str=turn.correction_input
     )
+
+
+async def align(turn: Turn) -> tuple[list[tuple[str, str]], float] | None:
+    """The local alignment of the correction, or None if it needs no explaining."""
+    corrected_input = turn["corrected_input"]
+    if config.CORRECTION_PRECHECK_ENABLED and correction_is_trivial(
+        turn.correction_input, corrected_input
+    ):
+        logger.info("Skipping correction explanations for trivial correction")
+        return None
+    return align_correction(turn.correction_input, corrected_input)
+
+
+def needs_llm_correction_tuples(confidence: float) -> bool:
+    """Whether tuples come from the LLM, given the local alignment's confidence."""
+    return config.CORRECTION_TUPLES_MODE == "llm" or (
+        config.CORRECTION_TUPLES_MODE != "local"
+        and confidence < config.ALIGNMENT_MIN_CONFIDENCE
+    )
+
+
+async def get_correction_tuples(turn: Turn) -> list[tuple[str, str]] | None:
+    alignment = turn["alignment"]
+    if alignment is None:
+        return None
+    if config.CORRECTION_TUPLES_MODE == "llm":
+        return await get_llm_correction_tuples(turn)
+    correction_tuples, confidence = alignment
     logger.debug(
-        f"Received response for correction tuples for `{input_str}` and `{corrected_input}`"
+        "Aligned correction tuples %s locally with confidence %.2f",
+        correction_tuples,
+        confidence,
     )
-    resp_dict = json.loads(
-        completion.choices[0].message.to_dict()["function_call"]["arguments"]
+    if not needs_llm_correction_tuples(confidence):
+        alignment_counters.increment("local")
+        return correction_tuples
+    logger.info("Local alignment has low confidence, falling back to LLM...")
+    alignment_counters.increment("llm_fallbacks")
+    return await get_llm_correction_tuples(turn)
+
+
+async def get_llm_correction_tuples(turn: Turn) -> list[tuple[str, str]]:
+    logger.debug(
+        "Getting correction tuples for `%s` and `%s`",
+        turn.correction_input,
+        turn["corrected_input"],
+    )
+    return await turn.call(
+        CORRECTION_TUPLES,
+        input_text=turn.correction_input,
+        corrected_text=turn["corrected_input"],
     )
-    correction_tuples = resp_dict["correction_tuples"]
-    correction_tuples = [ct for ct in correction_tuples if ct[0] != ct[1]]
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
-    return correction_tuples
 
 
-def get_correction_explanation(
-    input_phrase: str, corrected_phrase: str, entire_correction: str
+async def get_correction_explanation(
+    turn: Turn, input_phrase: str, corrected_phrase: str
 ) -> str:
-    global input_tokens_used, output_tokens_used
-    prompt = PROMPT_EXPLAIN_CORRECTION.format(
+    logger.debug(
+        "Sending input phrase `%s` and corrected phrase `%s` for correction explanation",
+        input_phrase,
+        corrected_phrase,
+    )
+    correction_explanation = await turn.call(
+        EXPLAIN_CORRECTION,
         input_phrase=input_phrase,
         corrected_phrase=corrected_phrase,
-        entire_correction=entire_correction,
+        entire_correction=turn["corrected_input"],
     )
-    logger.info("Making request for correction explanation...")
     logger.debug(
-        f"Sending input phrase `{input_phrase}` and corrected phrase `{corrected_phrase}` for correction explanation"
+        "Received correction explanation `%s` for input phrase `%s` and corrected phrase `%s`",
+        correction_explanation,
+        input_phrase,
+        corrected_phrase,
     )
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
+    return correction_explanation
+
+
+async def get_correction_explanations_batch(
+    turn: Turn, correction_tuples: list[tuple[str, str]]
+) -> list[str]:
+    correction_explanations = await _get_correction_explanations_batch(
+        turn, correction_tuples
     )
-    correction_explanation = completion.choices[0].message.content
-    logger.debug(
-        f"Received correction explanation `{correction_explanation}` for input phrase `{input_phrase}` and corrected phrase `{corrected_phrase}`"
+    turn.results.setdefault(FINISHED_EXPLANATIONS, {}).update(
+        zip(
+            (pair_key(*correction_tuple) for correction_tuple in correction_tuples),
+            correction_explanations,
+        )
     )
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
-    return correction_explanation
+    return correction_explanations
+
 
+async def _get_correction_explanations_batch(
+    turn: Turn, correction_tuples: list[tuple[str, str]]
+) -> list[str]:
+    if len(correction_tuples) == 1:
+        return [await get_correction_explanation(turn, *correction_tuples[0])]
+    corrections = "\n".join(
+        f'{i}. Input phrase: "{input_phrase}" | Corrected phrase: "{corrected_phrase}"'
+        for i, (input_phrase, corrected_phrase) in enumerate(correction_tuples, 1)
+    )
+    logger.debug("Sending correction tuples %s for explanation", correction_tuples)
+    correction_explanations = await turn.call(
+        EXPLAIN_CORRECTIONS_BATCH,
+        function=explanations_function_definition(
+            len(correction_tuples),
+            "One English explanation of why each correction was made, in the same order as the pairs",
+        ),
+        corrections=corrections,
+        entire_correction=turn["corrected_input"],
+    )
+    logger.debug("Received correction explanations %s", correction_explanations)
 
-def call_api(
-    user_input: str,
-    _main_message_history: list,
-    _input_tokens_used: int,
-    _output_tokens_used: int,
-) -> tuple:
-    global main_message_history, input_tokens_used, output_tokens_used
-    main_message_history = _main_message_history
-    input_tokens_used = _input_tokens_used
-    output_tokens_used = _output_tokens_used
-    logger.info("Chat initiated by user...")
-
-    with ThreadPoolExecutor() as executor:
-        conversation_response_future = executor.submit(
-            get_conversation_response, user_input
+    # Anything the batch left out is explained one request at a time
+    missing = correction_tuples[len(correction_explanations) :]
+    if missing:
+        logger.warning(f"Batch omitted {len(missing)} explanations, requesting them")
+        correction_explanations += await asyncio.gather(
+            *(
+                get_correction_explanation(turn, input_phrase, corrected_phrase)
+                for input_phrase, corrected_phrase in missing
+            )
         )
-        corrected_input_future = executor.submit(get_corrected_input, user_input)
+    return correction_explanations[: len(correction_tuples)]
 
-        conversation_response = conversation_response_future.result()
-        corrected_input = corrected_input_future.result()
 
-        correction_tuples_future = executor.submit(
-            get_correction_tuples, user_input, corrected_input
+async def get_correction_explanations(
+    turn: Turn, correction_tuples: list[tuple[str, str]]
+) -> list[str]:
+    # Unbatched, every correction is a batch of its own
+    batch_size = (
+        config.EXPLANATION_MAX_BATCH_SIZE if config.EXPLANATION_MODE == "batched" else 1
+    )
+    batches = await asyncio.gather(
+        *(
+            get_correction_explanations_batch(turn, batch)
+            for batch in batched(correction_tuples, batch_size)
         )
-        correction_tuples = correction_tuples_future.result()
-
-        correction_explanations_futures = [
-            executor.submit(
-                get_correction_explanation,
-                input_phrase,
-                corrected_phrase,
-                corrected_input,
-            )
-            for input_phrase, corrected_phrase in correction_tuples
-        ]
-        correction_explanations = [
-            future.result() for future in correction_explanations_futures
-        ]
+    )
+    return [explanation for batch in batches for explanation in batch]
 
-    correction_explanation = parse_correction_explanations(
-        correction_explanations, validate=False
+
+@dataclass
+class Speculation:
+    """Explanations of the locally aligned changes, requested batch by batch."""
+
+    batches: list[list[tuple[str, str]]]
+    tasks: list[asyncio.Task]
+
+
+async def speculate_correction_explanations(turn: Turn) -> Speculation | None:
+    """
+    Start explaining the locally aligned changes if the LLM is going to be asked
+    for the correction tuples, so that the explanations are requested while the
+    tuples are still being extracted.
+    """
+    alignment = turn["alignment"]
+    if (
+        alignment is None
+        or not config.SPECULATIVE_EXPLANATIONS_ENABLED
+        or not needs_llm_correction_tuples(alignment[1])
+    ):
+        return None
+    speculative_tuples, _ = alignment
+    batch_size = (
+        config.EXPLANATION_MAX_BATCH_SIZE if config.EXPLANATION_MODE == "batched" else 1
     )
+    batches = batched(speculative_tuples, batch_size)
+    speculation_counters.increment("turns")
+    speculation_counters.increment("speculated", len(speculative_tuples))
+    logger.info(f"Speculatively explaining {len(speculative_tuples)} corrections...")
+    return Speculation(
+        batches,
+        [
+            turn.spawn(get_correction_explanations_batch(turn, batch))
+            for batch in batches
+        ],
+    )
+
+
+async def get_speculative_correction_explanations(
+    turn: Turn, correction_tuples: list[tuple[str, str]], speculation: Speculation
+) -> list[str]:
+    """
+    Keep the speculative explanations of tuples the LLM agrees with, cancel
+    requests none of whose tuples survived, and explain whatever the alignment
+    missed.
+    """
+    # Where each speculated change can be found: (task index, index in batch)
+    speculated = {
+        pair_key(*correction_tuple): (i, j)
+        for i, batch in enumerate(speculation.batches)
+        for j, correction_tuple in enumerate(batch)
+    }
+    locations = [
+        speculated.get(pair_key(*correction_tuple))
+        for correction_tuple in correction_tuples
+    ]
+    used = {location[0] for location in locations if location is not None}
+    for i, task in enumerate(speculation.tasks):
+        if i not in used:
+            task.cancel()
+            speculation_counters.increment("cancelled", len(speculation.batches[i]))
+    misses = [
+        correction_tuple
+        for correction_tuple, location in zip(correction_tuples, locations)
+        if location is None
+    ]
+    hits = len(correction_tuples) - len(misses)
+    speculation_counters.increment("hits", hits)
+    speculation_counters.increment("misses", len(misses))
+    logger.info(f"Reusing {hits} of {len(correction_tuples)} speculative explanations")
 
-    correction_response = "{correction}\n\n{explanation}".format(
-        correction=corrected_input, explanation=correction_explanation
+    speculative_results, miss_explanations = await asyncio.gather(
+        asyncio.gather(*(speculation.tasks[i] for i in sorted(used))),
+        get_correction_explanations(turn, misses),
     )
-    return (
-        correction_response,
-        conversation_response,
-        main_message_history,
-        input_tokens_used,
-        output_tokens_used,
+    explanations_by_task = dict(zip(sorted(used), speculative_results))
+    remaining_miss_explanations = iter(miss_explanations)
+    return [
+        (
+            explanations_by_task[location[0]][location[1]]
+            if location is not None
+            else next(remaining_miss_explanations)
+        )
+        for location in locations
+    ]
+
+
+def speculation_hit_rate() -> float | None:
+    """Share of final correction tuples whose explanation was speculated."""
+    hits, misses = speculation_counters["hits"], speculation_counters["misses"]
+    return hits / (hits + misses) if hits + misses else None
+
+
+async def explain_corrections(turn: Turn) -> list[str]:
+    correction_tuples = turn["correction_tuples"]
+    if correction_tuples is None:
+        return []
+    speculation = turn["speculative_explanations"]
+    if speculation is None:
+        return await get_correction_explanations(turn, correction_tuples)
+    return await get_speculative_correction_explanations(
+        turn, correction_tuples, speculation
     )
+
+
+def partial_correction(turn: Turn) -> Correction:
+    """
+    The correction so far of a turn past its deadline, with every change whose
+    explanation is not ready yet marked as pending.
+    """
+    corrected_input = turn.results.get("corrected_input")
+    if corrected_input is None:
+        return pending_correction(turn)
+    if "alignment" in turn.results and turn["alignment"] is None:
+        return corrected_input, []
+    correction_tuples = turn.results.get("correction_tuples")
+    if correction_tuples is None:
+        return corrected_input, [PENDING_EXPLANATIONS]
+    finished = turn.results.get(FINISHED_EXPLANATIONS, {})
+    return corrected_input, [
+        finished.get(
+            pair_key(input_phrase, corrected_phrase),
+            f'"{input_phrase}" was changed to "{corrected_phrase}" (explanation pending)',
+        )
+        for input_phrase, corrected_phrase in correction_tuples
+    ]
+
+
+strategy = Strategy(
+    name="new",
+    stages=(
+        conversation_stage,
+        Stage("corrected_input", get_corrected_input),
+        Stage("alignment", align, after=("corrected_input",)),
+        Stage("correction_tuples", get_correction_tuples, after=("alignment",)),
+        Stage(
+            "speculative_explanations",
+            speculate_correction_explanations,
+            after=("alignment",),
+        ),
+        Stage(
+            "explanations",
+            explain_corrections,
+            after=("correction_tuples", "speculative_explanations"),
+        ),
+    ),
+    reply="conversation",
+    correction=lambda turn: (turn["corrected_input"], turn["explanations"]),
+    partial_correction=partial_correction,
+    validate_explanations=False,
+    incremental=True,
+    fix_locally=True,
+)
+engine = Engine(strategy)
+
+
+async def async_call_api(user_input: str, session: Session) -> tuple[str, str]:
+    return await engine.run(user_input, session)
+
+
+def async_stream_call_api(
+    user_input: str, session: Session
+) -> AsyncIterator[tuple[str | None, str]]:
+    return engine.stream(user_input, session)
+
+
+def call_api(user_input: str, session: Session) -> tuple[str, str]:
+    return llm.run_sync(engine.run(user_input, session))
@@ -1,138 +1,204 @@
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import logging
 import re
 
-import openai
-
-from utils import parse_correction_explanations
-
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level=logging.DEBUG,
+import config
+from engine import (
+    PENDING_EXPLANATIONS,
+    Call,
+    Engine,
+    Stage,
+    Strategy,
+    Turn,
+    conversation_stage,
+    pending_correction,
 )
+from incremental import Correction
+import llm
+from session import Session
+from similarity_index import indexed_correction
+from utils import (
+    batched,
+    correction_is_trivial,
+    explanations_function_definition,
+    parse_explanations_function_call,
+)
+
 logger = logging.getLogger()
 
 PROMPT_ANALYSE_CORRECTION = open("prompts/analyse_correction.txt", "r").read()
 PROMPT_TRANSLATE_SENTENCE = open("prompts/translate_sentence.txt", "r").read()
+PROMPT_ANALYSE_CORRECTIONS_BATCH = open(
+    "prompts/analyse_corrections_batch.txt", "r"
+).read()
 
-main_message_history: list | None = None
-input_tokens_used: int | None = None
-output_tokens_used: int | None = None
 
+CORRECTED_SENTENCE = Call(
+    PROMPT_TRANSLATE_SENTENCE,
+    temperature=0.2,
+    stage="correction",
+    template="translate_sentence",
+    parser=lambda message: message["content"].replace('"', ""),
+)
+ANALYSE_CORRECTION = Call(
+    PROMPT_ANALYSE_CORRECTION,
+    temperature=0.2,
+    stage="explanation",
+    template="analyse_correction",
+)
+ANALYSE_CORRECTIONS_BATCH = Call(
+    PROMPT_ANALYSE_CORRECTIONS_BATCH,
+    model="gpt-3.5-turbo-0613",
+    temperature=0.2,
+    stage="explanation",
+    template="analyse_corrections_batch",
+    parser=parse_explanations_function_call,
+)
 
-def get_conversation_response(user_input: str) -> str:
-    global main_message_history, input_tokens_used, output_tokens_used
-    if main_message_history is None:
-        raise ValueError("main_message_history is not set")
-    main_message_history.append({"role": "user", "content": user_input})
-    logger.info("Making request for conversation response...")
-    logger.debug(f"Sending user input `{user_input}` for conversation response")
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", messages=main_message_history, temperature=0.8
-    )
-    conversation_response = completion.choices[0].message.content
-    logger.debug(
-        f"Received conversation response `{conversation_response}` for `{user_input}`"
+
+async def split_input(turn: Turn) -> list[str]:
+    split_regex = r"(?<=[.!?])\s+"
+    return re.split(split_regex, turn.correction_input)
+
+
+async def get_corrected_sentences(turn: Turn) -> list[str]:
+    """Correct each sentence separately; repeated sentences share one request."""
+    return list(
+        await asyncio.gather(
+            *(
+                get_corrected_sentence(turn, input_sentence)
+                for input_sentence in turn["input_sentences"]
+            )
+        )
     )
-    main_message_history.append({"role": "assistant", "content": conversation_response})
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
-    return conversation_response
-
-
-def get_corrected_sentence(input_sentence: str) -> str:
-    global input_tokens_used, output_tokens_used
-    prompt = PROMPT_TRANSLATE_SENTENCE.format(sentence=input_sentence)
-    logger.info("Making request for corrected sentence...")
-    logger.debug(f"Sending input sentence `{input_sentence}` for correction")
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
+
+
+async def get_corrected_sentence(turn: Turn, input_sentence: str) -> str:
+    logger.debug("Sending input sentence `%s` for correction", input_sentence)
+    corrected_sentence = await indexed_correction(
+        turn, CORRECTED_SENTENCE, input_sentence, sentence=input_sentence
     )
-    corrected_sentence = completion.choices[0].message.content.replace('"', "")
     logger.debug(
-        f"Received corrected sentence `{corrected_sentence}` for `{input_sentence}`"
+        "Received corrected sentence `%s` for `%s`", corrected_sentence, input_sentence
     )
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
     return corrected_sentence
 
 
-def get_correction_explanation(input_sentence: str, corrected_sentence: str) -> str:
-    global input_tokens_used, output_tokens_used
-    prompt = PROMPT_ANALYSE_CORRECTION.format(
-        input_sentence=input_sentence, corrected_sentence=corrected_sentence
-    )
-    logger.info("Making request for correction explanation...")
+async def get_correction_explanation(
+    turn: Turn, input_sentence: str, corrected_sentence: str
+) -> str:
     logger.debug(
-        f"Sending input sentence `{input_sentence}` and corrected sentence `{corrected_sentence}` for correction explanation"
+        "Sending input sentence `%s` and corrected sentence `%s` for correction explanation",
+        input_sentence,
+        corrected_sentence,
     )
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
+    correction_explanation = await turn.call(
+        ANALYSE_CORRECTION,
+        input_sentence=input_sentence,
+        corrected_sentence=corrected_sentence,
     )
-    correction_explanation = completion.choices[0].message.content
     logger.debug(
-        f"Received correction explanation `{correction_explanation}` for input sentence `{input_sentence}` and corrected sentence `{corrected_sentence}`"
+        "Received correction explanation `%s` for input sentence `%s` and corrected sentence `%s`",
+        correction_explanation,
+        input_sentence,
+        corrected_sentence,
     )
-    input_tokens_used += completion.usage.prompt_tokens
-    output_tokens_used += completion.usage.completion_tokens
     return correction_explanation
 
 
-def call_api(
-    user_input: str,
-    _main_message_history: list,
-    _input_tokens_used: int,
-    _output_tokens_used: int,
-) -> tuple:
-    global main_message_history, input_tokens_used, output_tokens_used
-    main_message_history = _main_message_history
-    input_tokens_used = _input_tokens_used
-    output_tokens_used = _output_tokens_used
-    logger.info("Chat initiated by user...")
+async def get_correction_explanations_batch(
+    turn: Turn, sentence_pairs: list[tuple[str, str]]
+) -> list[str]:
+    if len(sentence_pairs) == 1:
+        return [await get_correction_explanation(turn, *sentence_pairs[0])]
+    logger.debug("Sending sentence pairs %s for correction explanation", sentence_pairs)
+    correction_explanations = await turn.call(
+        ANALYSE_CORRECTIONS_BATCH,
+        function=explanations_function_definition(
+            len(sentence_pairs),
+            "One breakdown of the changes per pair of sentences, in the same order as the pairs",
+        ),
+        sentence_pairs="\n\n".join(
+            f'{i}. Original sentence: "{input_sentence}"\nCorrected sentence: "{corrected_sentence}"'
+            for i, (input_sentence, corrected_sentence) in enumerate(sentence_pairs, 1)
+        ),
+    )
+    logger.debug("Received correction explanations %s", correction_explanations)
+
+    # Anything the batch left out is explained one request at a time
+    correction_explanations += await asyncio.gather(
+        *(
+            get_correction_explanation(turn, input_sentence, corrected_sentence)
+            for input_sentence, corrected_sentence in sentence_pairs[
+                len(correction_explanations) :
+            ]
+        )
+    )
+    return correction_explanations[: len(sentence_pairs)]
 
-    split_regex = r"(?<=[.!?])\s+"
-    input_sentences = re.split(split_regex, user_input)
 
-    with ThreadPoolExecutor() as executor:
-        conversation_response_future = executor.submit(
-            get_conversation_response, user_input
+async def explain_corrections(turn: Turn) -> list[str]:
+    sentence_pairs = [
+        (input_sentence, corrected_sentence)
+        for input_sentence, corrected_sentence in zip(
+            turn["input_sentences"], turn["corrected_sentences"]
         )
-        corrected_sentences_futures = [
-            executor.submit(get_corrected_sentence, sentence)
-            for sentence in input_sentences
-        ]
-
-        conversation_response = conversation_response_future.result()
-        corrected_sentences = [
-            future.result() for future in corrected_sentences_futures
-        ]
-
-        correction_explanations_futures = [
-            executor.submit(
-                get_correction_explanation, input_sentence, corrected_sentence
+        if not config.CORRECTION_PRECHECK_ENABLED
+        or not correction_is_trivial(input_sentence, corrected_sentence)
+    ]
+    if config.EXPLANATION_MODE == "batched":
+        batches = await asyncio.gather(
+            *(
+                get_correction_explanations_batch(turn, batch)
+                for batch in batched(sentence_pairs, config.EXPLANATION_MAX_BATCH_SIZE)
             )
-            for input_sentence, corrected_sentence in zip(
-                input_sentences, corrected_sentences
+        )
+        return [explanation for batch in batches for explanation in batch]
+    return list(
+        await asyncio.gather(
+            *(
+                get_correction_explanation(turn, input_sentence, corrected_sentence)
+                for input_sentence, corrected_sentence in sentence_pairs
             )
-        ]
-        correction_explanations = [
-            future.result() for future in correction_explanations_futures
-        ]
+        )
+    )
 
-    correction_explanation = parse_correction_explanations(correction_explanations)
 
-    correction_response = "{correction}\n\n{explanation}".format(
-        correction=" ".join(corrected_sentences), explanation=correction_explanation
-    )
-    return (
-        correction_response,
-        conversation_response,
-        main_message_history,
-        input_tokens_used,
-        output_tokens_used,
-    )
+def partial_correction(turn: Turn) -> Correction:
+    """The correction so far of a turn past its deadline, explanations pending."""
+    corrected_sentences = turn.results.get("corrected_sentences")
+    if corrected_sentences is None:
+        return pending_correction(turn)
+    return " ".join(corrected_sentences), [PENDING_EXPLANATIONS]
+
+
+strategy = Strategy(
+    name="orig",
+    stages=(
+        conversation_stage,
+        Stage("input_sentences", split_input),
+        Stage(
+            "corrected_sentences",
+            get_corrected_sentences,
+            after=("input_sentences",),
+        ),
+        Stage(
+            "explanations",
+            explain_corrections,
+            after=("input_sentences", "corrected_sentences"),
+        ),
+    ),
+    reply="conversation",
+    correction=lambda turn: (
+        " ".join(turn["corrected_sentences"]),
+        turn["explanations"],
+    ),
+    partial_correction=partial_correction,
+    incremental=True,
+    fix_locally=True,
+)
+engine = Engine(strategy)
+
+
+def call_api(user_input: str, session: Session) -> tuple[str, str]:
+    return llm.run_sync(engine.run(user_input, session))
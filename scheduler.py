@@ -0,0 +1,321 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+import logging
+import random
+import time
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+import openai
+
+import config
+import metrics
+
+logger = logging.getLogger()
+
+T = TypeVar("T")
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    asyncio.TimeoutError,
+)
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+@dataclass
+class CallTiming:
+    """What the scheduler did for one call, across all its attempts."""
+
+    queue_time: float = 0.0
+    retries: int = 0
+    hedged: bool = False
+
+
+# Set by the caller so the scheduler can report back to it; tasks spawned
+# for retries and hedges copy the context and so share the same object
+call_timing: ContextVar[CallTiming | None] = ContextVar("call_timing", default=None)
+
+
+def parse_overrides(overrides: str) -> dict[str, int]:
+    """Parse `model=value,model=value` into a dict."""
+    parsed = {}
+    for item in overrides.split(","):
+        if "=" in item:
+            model, value = item.split("=", 1)
+            parsed[model.strip()] = int(value)
+    return parsed
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return (
+        isinstance(error, openai.error.APIError)
+        and getattr(error, "http_status", None) in RETRYABLE_STATUSES
+    )
+
+
+class TokenBucket:
+    """Token-per-minute budget, refilled continuously."""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.capacity / 60
+        )
+        self.updated_at = now
+
+    def try_acquire(self, tokens: int) -> bool:
+        self._refill()
+        tokens = min(tokens, self.capacity)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens: int) -> None:
+        tokens = min(tokens, self.capacity)
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) * 60 / self.capacity)
+
+    def adjust(self, tokens: int) -> None:
+        """Charge (or refund, if negative) the difference from an estimate."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - tokens)
+
+
+class RequestScheduler:
+    """
+    Admission control for every upstream request: a global and a per-model
+    concurrency cap, a per-model token-per-minute budget, retries with jittered
+    exponential backoff, an overall deadline per call, and a hedged second
+    attempt for requests running longer than recent tail latency.
+
+    All methods must run on the LLM client loop (see `llm.client_loop`).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = config.SCHEDULER_MAX_CONCURRENCY,
+        model_concurrency: int = config.SCHEDULER_MODEL_CONCURRENCY,
+        tokens_per_minute: int = config.SCHEDULER_TOKENS_PER_MINUTE,
+        max_retries: int = config.SCHEDULER_MAX_RETRIES,
+        attempt_timeout: float = config.SCHEDULER_ATTEMPT_TIMEOUT_SECONDS,
+        deadline: float = config.SCHEDULER_DEADLINE_SECONDS,
+        hedge: bool = config.SCHEDULER_HEDGE_ENABLED,
+    ):
+        self.model_concurrency = model_concurrency
+        self.model_concurrency_overrides = parse_overrides(
+            config.SCHEDULER_MODEL_CONCURRENCY_OVERRIDES
+        )
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens_per_minute_overrides = parse_overrides(
+            config.SCHEDULER_TOKENS_PER_MINUTE_OVERRIDES
+        )
+        self.max_retries = max_retries
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.hedge = hedge
+        self._global_semaphore = asyncio.Semaphore(max_concurrency)
+        self._model_semaphores: dict[str, asyncio.Semaphore] = {}
+        self._token_buckets: dict[str, TokenBucket] = {}
+        self.counters = metrics.counters(
+            "scheduler", "attempts", "retries", "hedges", "hedge_wins", "timeouts"
+        )
+        self.queue_wait = metrics.timings("scheduler.queue_wait")
+
+    def _model_semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._model_semaphores:
+            self._model_semaphores[model] = asyncio.Semaphore(
+                self.model_concurrency_overrides.get(model, self.model_concurrency)
+            )
+        return self._model_semaphores[model]
+
+    def token_bucket(self, model: str) -> TokenBucket:
+        if model not in self._token_buckets:
+            self._token_buckets[model] = TokenBucket(
+                self.tokens_per_minute_overrides.get(model, self.tokens_per_minute)
+            )
+        return self._token_buckets[model]
+
+    @asynccontextmanager
+    async def slot(self, model: str, estimated_tokens: int) -> AsyncIterator[None]:
+        """
+        Wait for concurrency and token budget, recording the time spent queued.
+        Passing no `estimated_tokens` only waits for concurrency.
+        """
+        queued_at = time.monotonic()
+        # Budget first, so a model that is out of tokens does not hold global slots
+        if estimated_tokens:
+            await self.token_bucket(model).acquire(estimated_tokens)
+        async with self._global_semaphore, self._model_semaphore(model):
+            queue_time = time.monotonic() - queued_at
+            self.queue_wait.observe(queue_time)
+            timing = call_timing.get()
+            if timing is not None:
+                timing.queue_time += queue_time
+            yield
+
+    async def _try_hedge_slot(self, model: str, estimated_tokens: int) -> bool:
+        # Hedges only use spare capacity and never queue: acquiring a semaphore
+        # that is not locked completes without suspending
+        model_semaphore = self._model_semaphore(model)
+        if self._global_semaphore.locked() or model_semaphore.locked():
+            return False
+        if not self.token_bucket(model).try_acquire(estimated_tokens):
+            return False
+        await self._global_semaphore.acquire()
+        await model_semaphore.acquire()
+        return True
+
+    def _release_hedge_slot(self, model: str) -> None:
+        self._global_semaphore.release()
+        self._model_semaphore(model).release()
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        ceiling = min(
+            config.SCHEDULER_BACKOFF_MAX_SECONDS,
+            config.SCHEDULER_BACKOFF_BASE_SECONDS * 2**attempt,
+        )
+        return random.uniform(0, ceiling)
+
+    def _hedge_delay(self, model: str) -> float:
+        latency = metrics.timings(f"scheduler.latency.{model}").percentile(
+            config.SCHEDULER_HEDGE_PERCENTILE
+        )
+        return max(config.SCHEDULER_HEDGE_MIN_DELAY_SECONDS, latency or 0.0)
+
+    async def call(
+        self,
+        model: str,
+        estimated_tokens: int,
+        request: Callable[[], Awaitable[T]],
+        *,
+        hedge: bool = True,
+        acquire_slot: bool = True,
+    ) -> T:
+        """
+        Run `request` (a factory, so it can be retried or hedged) under the
+        scheduler's limits, raising `openai.error.Timeout` past the deadline.
+        """
+        try:
+            return await asyncio.wait_for(
+                self._call_with_retries(
+                    model, estimated_tokens, request, hedge, acquire_slot
+                ),
+                timeout=self.deadline,
+            )
+        except asyncio.TimeoutError:
+            self.counters.increment("timeouts")
+            raise openai.error.Timeout(
+                f"Request to `{model}` did not finish within {self.deadline}s"
+            )
+
+    async def _call_with_retries(
+        self,
+        model: str,
+        estimated_tokens: int,
+        request: Callable[[], Awaitable[T]],
+        hedge: bool,
+        acquire_slot: bool,
+    ) -> T:
+        attempt = 0
+        while True:
+            self.counters.increment("attempts")
+            try:
+                if not acquire_slot:
+                    return await self._attempt(model, estimated_tokens, request, False)
+                # The budget is charged once per call, not once per attempt
+                async with self.slot(model, 0 if attempt else estimated_tokens):
+                    return await self._attempt(model, estimated_tokens, request, hedge)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning(
+                    f"Request to `{model}` failed with `{e!r}`, retrying in {delay:.2f}s"
+                )
+                self.counters.increment("retries")
+                timing = call_timing.get()
+                if timing is not None:
+                    timing.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _attempt(
+        self,
+        model: str,
+        estimated_tokens: int,
+        request: Callable[[], Awaitable[T]],
+        hedge: bool,
+    ) -> T:
+        started_at = time.monotonic()
+        primary = asyncio.ensure_future(
+            asyncio.wait_for(request(), timeout=self.attempt_timeout)
+        )
+        tasks = {primary}
+        hedged = False
+        try:
+            if hedge and self.hedge:
+                done, _ = await asyncio.wait(tasks, timeout=self._hedge_delay(model))
+                if not done and await self._try_hedge_slot(model, estimated_tokens):
+                    logger.info(f"Hedging slow request to `{model}`...")
+                    self.counters.increment("hedges")
+                    hedged = True
+                    timing = call_timing.get()
+                    if timing is not None:
+                        timing.hedged = True
+                    tasks.add(
+                        asyncio.ensure_future(
+                            asyncio.wait_for(request(), timeout=self.attempt_timeout)
+                        )
+                    )
+            winner = await self._first_success(tasks)
+            if winner is not primary:
+                self.counters.increment("hedge_wins")
+            metrics.timings(f"scheduler.latency.{model}").observe(
+                time.monotonic() - started_at
+            )
+            return winner.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if hedged:
+                self._release_hedge_slot(model)
+                # Only one of the two answers is used, and the caller adjusts
+                # the budget by the usage of that one alone
+                self.token_bucket(model).adjust(-estimated_tokens)
+
+    @staticmethod
+    async def _first_success(tasks: set[asyncio.Task[T]]) -> asyncio.Task[T]:
+        pending = set(tasks)
+        error: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task
+                error = task.exception()
+        assert error is not None
+        raise error
+
+
+scheduler = RequestScheduler()
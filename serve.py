@@ -0,0 +1,325 @@
+"""
+Serve the tutor from several worker processes behind one port.
+
+Every worker runs its own event loop, API client and scheduler, and sessions
+are kept in a SQLite file shared by all of them (see store.py), so any worker
+can serve any turn. By default a small proxy on the public port pins each
+browser to one worker, which keeps its sessions warm in that worker's memory,
+along with the work a session leaves running between requests: sentences
+corrected while typing and summaries of older history. With `--no-sticky`,
+the workers share the port instead and those features are turned off.
+
+    python serve.py --workers 4 --port 7860 [--no-sticky]
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+
+logger = logging.getLogger()
+
+WORKER_COOKIE = "tutor_worker"
+
+
+def worker_environment(index: int, workers: int, sticky: bool) -> dict[str, str]:
+    """Settings for worker `index`, keeping any shared ones set explicitly."""
+    import config
+
+    environment = {
+        "SESSION_STORE": "sqlite",
+        "RESPONSE_CACHE_SQLITE_PATH": "response_cache.sqlite3",
+        # The rate limit is for the API key, which every worker shares
+        "SCHEDULER_TOKENS_PER_MINUTE": str(
+            max(1, config.SCHEDULER_TOKENS_PER_MINUTE // workers)
+        ),
+    }
+    if not sticky:
+        # Their results are only held in the memory of the worker that started
+        # them, which the session's next request is unlikely to reach
+        environment["INCREMENTAL_CORRECTION_ENABLED"] = "0"
+        environment["HISTORY_SUMMARY_ENABLED"] = "0"
+    environment = {
+        name: value for name, value in environment.items() if name not in os.environ
+    }
+    environment["WORKER_INDEX"] = str(index)
+    if config.STARTER_POOL_PATH:
+        # Each worker keeps its own pool, as pools are not shared safely
+        root, extension = os.path.splitext(config.STARTER_POOL_PATH)
+        environment["STARTER_POOL_PATH"] = f"{root}.{index}{extension}"
+    return environment
+
+
+def create_app(private_port: int):
+    """The worker's app: the Gradio UI plus a JSON endpoint for single turns."""
+    from fastapi import FastAPI, HTTPException
+    import gradio
+    from pydantic import BaseModel
+
+    from accounting import BudgetExceeded
+    import main
+    from starter_pool import starter_pool
+    import tracing
+
+    class TurnRequest(BaseModel):
+        user_input: str
+        session_id: str | None = None
+
+    app = FastAPI()
+
+    @app.on_event("startup")
+    async def startup() -> None:
+        tracing.configure_logging()
+        starter_pool.start()
+
+    @app.post("/turn")
+    async def turn(request: TurnRequest) -> dict:
+        session = (
+            await main.create_session()
+            if request.session_id is None
+            else await main.sessions.aget(request.session_id)
+        )
+        if session is None:
+            raise HTTPException(404, "Unknown or expired session")
+        try:
+            correction, response = await main.engine.run(request.user_input, session)
+        except BudgetExceeded as e:
+            raise HTTPException(402, str(e))
+        finally:
+            await main.sessions.asave(session)
+        return {
+            "session_id": session.session_id,
+            "correction": correction,
+            "response": response,
+        }
+
+    # The queue calls back into the app over HTTP, so point it at this
+    # worker's own port rather than the shared one
+    return gradio.mount_gradio_app(
+        app,
+        main.demo.queue(),
+        path="/",
+        gradio_api_url=f"http://127.0.0.1:{private_port}/",
+    )
+
+
+def run_worker(
+    environment: dict[str, str],
+    private_port: int,
+    shared_socket: socket.socket | None,
+) -> None:
+    os.environ.update(environment)
+    # Only now that the environment is set can the app's modules be imported
+    import uvicorn
+
+    import config
+
+    private_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    private_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    private_socket.bind(("127.0.0.1", private_port))
+    sockets = [private_socket]
+    if shared_socket is not None:
+        sockets.append(shared_socket)
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_app(private_port),
+            log_level=config.LOG_LEVEL.lower(),
+            timeout_keep_alive=30,
+        )
+    )
+    server.run(sockets=sockets)
+
+
+def run_sticky_proxy(host: str, port: int, worker_ports: list[int]) -> None:
+    """Forward each browser's requests, websockets included, to one worker."""
+    import aiohttp
+    from aiohttp import web
+
+    hop_headers = {
+        "connection",
+        "content-length",
+        "host",
+        "keep-alive",
+        "sec-websocket-accept",
+        "sec-websocket-extensions",
+        "sec-websocket-key",
+        "sec-websocket-version",
+        "transfer-encoding",
+        "upgrade",
+    }
+
+    async def proxy(request: web.Request) -> web.StreamResponse:
+        try:
+            index = int(request.cookies[WORKER_COOKIE]) % len(worker_ports)
+        except (KeyError, ValueError):
+            index = random.randrange(len(worker_ports))
+        url = f"http://127.0.0.1:{worker_ports[index]}{request.rel_url}"
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name.lower() not in hop_headers
+        }
+        client: aiohttp.ClientSession = request.app["client"]
+        if request.headers.get("Upgrade", "").lower() == "websocket":
+            websocket = web.WebSocketResponse()
+            await websocket.prepare(request)
+            async with client.ws_connect(url, headers=headers) as upstream_websocket:
+                await asyncio.gather(
+                    _pipe_websocket(websocket, upstream_websocket),
+                    _pipe_websocket(upstream_websocket, websocket),
+                )
+            return websocket
+        try:
+            upstream = await client.request(
+                request.method,
+                url,
+                headers=headers,
+                data=await request.read(),
+                allow_redirects=False,
+            )
+        except aiohttp.ClientConnectorError:
+            logger.warning(f"Worker {index} is not accepting connections")
+            raise web.HTTPBadGateway()
+        async with upstream:
+            response = web.StreamResponse(
+                status=upstream.status,
+                headers={
+                    name: value
+                    for name, value in upstream.headers.items()
+                    if name.lower() not in hop_headers
+                },
+            )
+            response.set_cookie(WORKER_COOKIE, str(index), httponly=True)
+            await response.prepare(request)
+            try:
+                async for chunk in upstream.content.iter_any():
+                    await response.write(chunk)
+                await response.write_eof()
+            except ConnectionResetError:
+                # The browser went away before the response was finished
+                pass
+            return response
+
+    async def start_client(app: web.Application) -> None:
+        app["client"] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0),
+            timeout=aiohttp.ClientTimeout(total=None),
+            auto_decompress=False,
+        )
+
+    async def close_client(app: web.Application) -> None:
+        await app["client"].close()
+
+    app = web.Application()
+    app.router.add_route("*", "/{path:.*}", proxy)
+    app.on_startup.append(start_client)
+    app.on_cleanup.append(close_client)
+    web.run_app(app, host=host, port=port, print=None)
+
+
+async def _pipe_websocket(source, destination) -> None:
+    from aiohttp import WSMsgType
+
+    async for message in source:
+        if message.type == WSMsgType.TEXT:
+            await destination.send_str(message.data)
+        elif message.type == WSMsgType.BINARY:
+            await destination.send_bytes(message.data)
+        else:
+            break
+    await destination.close()
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve the tutor from several worker processes."
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument(
+        "--sticky",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="pin each browser to one worker rather than sharing the port",
+    )
+    args = parser.parse_args()
+
+    import config
+    from tracing import configure_logging
+
+    configure_logging()
+    if not os.getenv("OPENAI_API_KEY"):
+        # main.check_api_key() prompts for the key, which workers cannot do
+        parser.error("OPENAI_API_KEY must be set in the environment or .env file")
+    if config.TURN_DEADLINE_SECONDS and not args.sticky:
+        # The late correction is only filled in by the worker that started it
+        parser.error("TURN_DEADLINE_SECONDS can only be set with sticky routing")
+
+    shared_socket = None
+    if not args.sticky:
+        shared_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        shared_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        shared_socket.bind((args.host, args.port))
+        shared_socket.listen(2048)
+        shared_socket.set_inheritable(True)
+
+    context = multiprocessing.get_context("spawn")
+    worker_ports = [free_port() for _ in range(args.workers)]
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(
+                worker_environment(index, args.workers, args.sticky),
+                worker_ports[index],
+                shared_socket,
+            ),
+            name=f"worker-{index}",
+        )
+        for index in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(
+        f"Serving on http://{args.host}:{args.port} with {args.workers} workers"
+        + (" and sticky routing" if args.sticky else "")
+    )
+
+    def stop(*_) -> None:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        if args.sticky:
+            run_sticky_proxy(args.host, args.port, worker_ports)
+        else:
+            for process in processes:
+                process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    main()
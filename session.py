@@ -0,0 +1,87 @@
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass, field, fields
+import threading
+import time
+
+from accounting import CallRecord, Ledger
+
+# Session state that only means something inside the process holding it
+TRANSIENT_FIELDS = {
+    "last_active",
+    "late_correction",
+    "seen_topics",
+    "sentence_corrections",
+    "summary_in_progress",
+    "_lock",
+}
+
+
+@dataclass
+class Session:
+    """Everything that belongs to one learner's conversation."""
+
+    session_id: str
+    message_history: list[dict] = field(default_factory=list)
+    topic: str = ""
+    starter: str = ""
+    input_tokens_used: int = 0
+    output_tokens_used: int = 0
+    cached_responses: int = 0
+    coalesced_responses: int = 0
+    # Rolling summary of the messages that no longer fit in the history window
+    history_summary: str = ""
+    summarised_messages: int = 0
+    history_window_start: int = 1
+    summary_in_progress: bool = False
+    last_prompt_tokens_saved: int = 0
+    prompt_tokens_saved: int = 0
+    last_active: float = field(default_factory=time.monotonic)
+    ledger: Ledger = field(default_factory=Ledger, repr=False)
+    # Background corrections of the sentences typed so far, by sentence hash
+    sentence_corrections: dict[str, Future] = field(default_factory=dict, repr=False)
+    # Conversation topics already given to this learner, not to be repeated
+    seen_topics: set[str] = field(default_factory=set, repr=False)
+    # The correction response of the last turn, if it missed the turn deadline
+    late_correction: Future | None = field(default=None, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+
+    def record_call(self, record: CallRecord) -> None:
+        """Thread-safe accounting of one call made on behalf of this session."""
+        with self._lock:
+            self.input_tokens_used += record.prompt_tokens
+            self.output_tokens_used += record.completion_tokens
+            self.cached_responses += record.cached
+            self.coalesced_responses += record.coalesced
+        self.ledger.record(record)
+
+    def record_prompt_tokens_saved(self, tokens_saved: int) -> None:
+        with self._lock:
+            self.last_prompt_tokens_saved = tokens_saved
+            self.prompt_tokens_saved += tokens_saved
+
+    def tokens_used(self) -> tuple[int, int]:
+        with self._lock:
+            return self.input_tokens_used, self.output_tokens_used
+
+    def touch(self) -> None:
+        self.last_active = time.monotonic()
+
+    def to_dict(self) -> dict:
+        """The session's persistent state, as JSON-serialisable data."""
+        with self._lock:
+            data = {
+                f.name: getattr(self, f.name)
+                for f in fields(self)
+                if f.name not in TRANSIENT_FIELDS and f.name != "ledger"
+            }
+            data["message_history"] = list(self.message_history)
+        data["ledger"] = [asdict(record) for record in list(self.ledger.records)]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Session":
+        data = dict(data)
+        records = [CallRecord(**record) for record in data.pop("ledger", [])]
+        return cls(**data, ledger=Ledger(records))
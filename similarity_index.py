@@ -0,0 +1,359 @@
+"""
+Local index of past corrections, looked up by what the learner typed.
+
+Inputs are normalised the way `utils.normalise_for_comparison` does (accents,
+punctuation and case removed) and whitespace is collapsed, so inputs that
+differ only in what a correction would fix anyway share one entry, and its
+correction can be reused without an API call. Inputs whose character n-grams
+are merely similar can match too: each entry is also indexed by the bands of
+a MinHash signature of its n-grams (locality-sensitive hashing), and
+candidates sharing a band are checked by exact Jaccard similarity, those
+sharing the most bands first, up to a fixed number of them. Entries are
+kept apart by the prompt template that produced them, so a whole input and a
+single sentence never share a correction.
+
+Every key (the hash of the normalised input, and each band) is kept in a
+sorted numpy array searched by bisection, plus a small dict of recent
+additions that is merged in once it outgrows a fraction of the array. A
+lookup is a few bisections of arrays and a bounded number of similarity
+checks, whatever the size of the index. The
+index is saved to an `.npz` file every so often and at exit, and loaded back
+on startup.
+"""
+
+from array import array
+import atexit
+from collections import Counter
+import hashlib
+import logging
+import os
+import threading
+from typing import Any
+import zlib
+
+import numpy as np
+
+import config
+import metrics
+from accounting import CallRecord
+from engine import Call, Turn
+from utils import normalise_for_comparison
+
+logger = logging.getLogger()
+
+FORMAT_VERSION = 1
+# Recent additions are merged into the sorted keys once there are this many,
+# or a sixteenth of the sorted keys if that is more
+MIN_MERGE_SIZE = 4096
+# Only the most recent entries sharing a band this common are counted as
+# candidates, so that a band every input has does not slow lookups down
+MAX_BAND_ENTRIES = 1024
+# MinHash uses `(a * x + b) % p` with every operand below this prime, so the
+# arithmetic stays exact in uint64
+_MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+
+
+def normalise(text: str) -> str:
+    return " ".join(normalise_for_comparison(text).split())
+
+
+def _hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def ngrams(normalised: str, n: int) -> set[str]:
+    padded = f" {normalised} "
+    return {padded[i : i + n] for i in range(max(1, len(padded) - n + 1))}
+
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class _Keys:
+    """A multimap of uint64 keys to entry ids: sorted arrays plus recent additions."""
+
+    def __init__(
+        self, keys: np.ndarray | None = None, ids: np.ndarray | None = None
+    ) -> None:
+        self.keys = np.empty(0, np.uint64) if keys is None else keys
+        self.ids = np.empty(0, np.uint32) if ids is None else ids
+        self.recent: dict[int, list[int]] = {}
+        self.recent_count = 0
+
+    def add(self, key: int, entry: int) -> None:
+        self.recent.setdefault(key, []).append(entry)
+        self.recent_count += 1
+        if self.recent_count >= max(MIN_MERGE_SIZE, len(self.keys) // 16):
+            self.merge()
+
+    def find(self, key: int, limit: int | None = None) -> list[int]:
+        """The entries under `key`, or only the `limit` most recently added."""
+        found = self.recent.get(key, [])
+        sorted_key = np.uint64(key)
+        start = np.searchsorted(self.keys, sorted_key, side="left")
+        if start < len(self.keys) and self.keys[start] == sorted_key:
+            end = np.searchsorted(self.keys, sorted_key, side="right")
+            if limit is not None:
+                start = max(start, end - limit)
+            # Entries are sorted by id within a key, and recent ones come last
+            found = self.ids[start:end].tolist() + found
+        return found if limit is None else found[-limit:]
+
+    def merge(self) -> None:
+        if not self.recent:
+            return
+        keys = np.fromiter(
+            (key for key, entries in self.recent.items() for _ in entries),
+            np.uint64,
+            self.recent_count,
+        )
+        ids = np.fromiter(
+            (entry for entries in self.recent.values() for entry in entries),
+            np.uint32,
+            self.recent_count,
+        )
+        keys = np.concatenate([self.keys, keys])
+        ids = np.concatenate([self.ids, ids])
+        order = np.argsort(keys, kind="stable")
+        # Replaced rather than updated in place, so a save in progress is safe
+        self.keys, self.ids = keys[order], ids[order]
+        self.recent, self.recent_count = {}, 0
+
+
+class SimilarityIndex:
+    """
+    Corrections of past inputs, reused for inputs that normalise the same or,
+    if `min_similarity` is below 1, whose n-grams are at least that similar.
+    Only the `max_candidates` entries sharing the most bands with an input are
+    checked for similarity, so inputs with many look-alikes stay quick to look
+    up.
+    """
+
+    def __init__(
+        self,
+        path: str = config.SIMILARITY_INDEX_PATH,
+        min_similarity: float = config.SIMILARITY_INDEX_MIN_SIMILARITY,
+        max_entries: int = config.SIMILARITY_INDEX_MAX_ENTRIES,
+        save_every: int = config.SIMILARITY_INDEX_SAVE_EVERY,
+        ngram: int = 3,
+        bands: int = 8,
+        rows: int = 4,
+        max_candidates: int = 16,
+    ):
+        self.path = path
+        self.min_similarity = min_similarity
+        self.max_entries = max_entries
+        self.save_every = save_every
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = rows
+        self.max_candidates = max_candidates
+        self.counters = metrics.counters(
+            "similarity_index", "lookups", "exact_hits", "near_hits", "added"
+        )
+        # The MinHash hash functions, seeded so saved signatures stay comparable
+        generator = np.random.default_rng(FORMAT_VERSION)
+        self._a = generator.integers(
+            1, _MERSENNE_PRIME, bands * rows, dtype=np.uint64, endpoint=False
+        )
+        self._b = generator.integers(
+            0, _MERSENNE_PRIME, bands * rows, dtype=np.uint64, endpoint=False
+        )
+        # The hash of the normalised input, then one per band
+        self._keys = [_Keys() for _ in range(1 + bands)]
+        # UTF-8 normalised input and correction of each entry, back to back
+        self._data = bytearray()
+        self._offsets = array("Q", [0])
+        self._unsaved = 0
+        self._saving = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return (len(self._offsets) - 1) // 2
+
+    def _field(self, index: int) -> str:
+        return self._data[self._offsets[index] : self._offsets[index + 1]].decode(
+            "utf-8"
+        )
+
+    def signature(self, grams: set[str]) -> np.ndarray:
+        """
+        The MinHash signature of `grams`. Each component of two signatures
+        agrees with a probability equal to the Jaccard similarity of the sets.
+        """
+        hashes = np.fromiter(
+            (zlib.crc32(gram.encode("utf-8")) for gram in grams), np.uint64, len(grams)
+        )
+        hashes %= _MERSENNE_PRIME
+        return ((hashes[:, None] * self._a + self._b) % _MERSENNE_PRIME).min(axis=0)
+
+    def _band_keys(self, grams: set[str], template: str) -> list[int]:
+        prefix = template.encode("utf-8") + b"\n"
+        return [
+            _hash64(prefix + band.tobytes())
+            for band in self.signature(grams).reshape(self.bands, self.rows)
+        ]
+
+    def lookup(self, text: str, template: str = "") -> str | None:
+        """
+        The correction stored by `template` for `text`, or for an input similar
+        enough to it.
+        """
+        normalised = normalise(text)
+        if not normalised:
+            return None
+        self.counters.increment("lookups")
+        # Normalised inputs have no newlines, so this separates the two
+        stored = f"{template}\n{normalised}"
+        key = _hash64(stored.encode("utf-8"))
+        with self._lock:
+            for entry in self._keys[0].find(key):
+                if self._field(2 * entry) == stored:
+                    self.counters.increment("exact_hits")
+                    return self._field(2 * entry + 1)
+        if self.min_similarity >= 1:
+            return None
+        grams = ngrams(normalised, self.ngram)
+        band_keys = self._band_keys(grams, template)
+        with self._lock:
+            shared_bands: Counter[int] = Counter()
+            for keys, band_key in zip(self._keys[1:], band_keys):
+                shared_bands.update(keys.find(band_key, MAX_BAND_ENTRIES))
+            best, best_similarity = None, self.min_similarity
+            for entry, _ in shared_bands.most_common(self.max_candidates):
+                entry_template, entry_input = self._field(2 * entry).split("\n", 1)
+                if entry_template != template:
+                    continue
+                similarity = jaccard(grams, ngrams(entry_input, self.ngram))
+                if similarity >= best_similarity:
+                    best, best_similarity = entry, similarity
+            if best is None:
+                return None
+            self.counters.increment("near_hits")
+            logger.debug(
+                "Reusing correction of `%s` (similarity %.2f)",
+                self._field(2 * best),
+                best_similarity,
+            )
+            return self._field(2 * best + 1)
+
+    def add(self, text: str, correction: str, template: str = "") -> None:
+        normalised = normalise(text)
+        if not normalised:
+            return
+        stored = f"{template}\n{normalised}"
+        key = _hash64(stored.encode("utf-8"))
+        band_keys = self._band_keys(ngrams(normalised, self.ngram), template)
+        with self._lock:
+            entry = (len(self._offsets) - 1) // 2
+            if entry >= self.max_entries:
+                return
+            if any(
+                self._field(2 * existing) == stored
+                for existing in self._keys[0].find(key)
+            ):
+                return
+            for value in (stored, correction):
+                self._data += value.encode("utf-8")
+                self._offsets.append(len(self._data))
+            for keys, band_key in zip(self._keys, [key, *band_keys]):
+                keys.add(band_key, entry)
+            self._unsaved += 1
+            save = self._unsaved >= self.save_every and not self._saving
+            self._saving = self._saving or save
+        self.counters.increment("added")
+        if save:
+            threading.Thread(target=self.save, name="similarity-index-save").start()
+
+    def save(self) -> None:
+        """Atomically write the index to `path`."""
+        if not self.path:
+            return
+        # Unique to the process, as worker processes may share the index path
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            # Snapshot under the save lock too, so an older snapshot can never
+            # overwrite a newer one
+            with self._save_lock:
+                with self._lock:
+                    for keys in self._keys:
+                        keys.merge()
+                    arrays: dict[str, Any] = {
+                        "meta": np.array(
+                            [FORMAT_VERSION, self.ngram, self.bands, self.rows],
+                            np.int64,
+                        ),
+                        "offsets": np.frombuffer(self._offsets, np.uint64).copy(),
+                        "data": np.frombuffer(bytes(self._data), np.uint8),
+                    }
+                    for i, keys in enumerate(self._keys):
+                        arrays[f"keys_{i}"], arrays[f"ids_{i}"] = keys.keys, keys.ids
+                    saved = self._unsaved
+                with open(temp_path, "wb") as file:
+                    np.savez(file, **arrays)
+                os.replace(temp_path, self.path)
+                with self._lock:
+                    self._unsaved -= saved
+        except OSError:
+            logger.exception(f"Could not save the similarity index to `{self.path}`")
+        finally:
+            with self._lock:
+                self._saving = False
+
+    def load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as saved:
+                meta = saved["meta"].tolist()
+                if meta != [FORMAT_VERSION, self.ngram, self.bands, self.rows]:
+                    logger.warning(
+                        f"Ignoring similarity index `{self.path}` built with other settings"
+                    )
+                    return
+                keys = [
+                    _Keys(saved[f"keys_{i}"], saved[f"ids_{i}"])
+                    for i in range(1 + self.bands)
+                ]
+                offsets = array("Q", saved["offsets"].tobytes())
+                data = bytearray(saved["data"].tobytes())
+        except (OSError, ValueError, KeyError):
+            logger.exception(f"Could not load the similarity index from `{self.path}`")
+            return
+        with self._lock:
+            self._keys, self._offsets, self._data = keys, offsets, data
+        logger.info(
+            f"Loaded {len(self)} corrections into the similarity index from `{self.path}`"
+        )
+
+
+async def indexed_correction(turn: Turn, call: Call, text: str, **fields) -> str:
+    """
+    The correction of `text` from the similarity index, at no cost, or else
+    from `call` with the prompt `fields`, which is then added to the index.
+    """
+    if similarity_index is None:
+        return await turn.call(call, **fields)
+    template = call.template or call.stage
+    correction = similarity_index.lookup(text, template)
+    if correction is not None:
+        turn.session.record_call(CallRecord(call.stage, call.model, cached=True))
+        return correction
+    correction = await turn.call(call, **fields)
+    similarity_index.add(text, correction, template)
+    return correction
+
+
+def _build_similarity_index() -> SimilarityIndex | None:
+    if not config.SIMILARITY_INDEX_ENABLED:
+        return None
+    index = SimilarityIndex()
+    index.load()
+    atexit.register(index.save)
+    return index
+
+
+similarity_index = _build_similarity_index()
@@ -0,0 +1,102 @@
+import asyncio
+from concurrent.futures import Future
+from dataclasses import dataclass
+import logging
+import threading
+from typing import Any, Callable, Coroutine
+
+import config
+import metrics
+
+logger = logging.getLogger()
+
+
+@dataclass
+class _Flight:
+    future: Future
+    waiters: int = 1
+    claimed: bool = False
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls that are in flight at the same time. The first
+    caller for a key starts the call on `loop` and later callers for the same
+    key, from any thread or event loop, wait on it instead of starting their
+    own. Every waiter gets the call's result or exception. A waiter that is
+    cancelled only stops waiting; the call itself is cancelled once nobody is
+    left waiting for it. Keys are forgotten as soon as their call finishes, so
+    nothing is cached.
+    """
+
+    def __init__(self, name: str = "single_flight"):
+        self.counters = metrics.counters(
+            name, "calls", "coalesced", "abandoned", "cancelled", "failed"
+        )
+        self._flights: dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+    async def do(
+        self,
+        key: str,
+        call: Callable[[], Coroutine[Any, Any, Any]],
+        loop: asyncio.AbstractEventLoop,
+    ) -> tuple[Any, bool]:
+        """
+        The result of `call()`, or of an identical call already in flight for
+        `key`, and whether this caller is the first to receive it. Exactly one
+        caller per call receives `True`, so exactly one pays for it.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight(asyncio.run_coroutine_threadsafe(call(), loop))
+                self._flights[key] = flight
+                flight.future.add_done_callback(
+                    lambda future: self._finish(key, flight)
+                )
+                self.counters.increment("calls")
+            else:
+                flight.waiters += 1
+                self.counters.increment("coalesced")
+                logger.debug("Coalescing call for key `%s`", key)
+        try:
+            # Shielded so that a cancelled waiter does not cancel the call
+            result = await asyncio.shield(asyncio.wrap_future(flight.future))
+        except asyncio.CancelledError:
+            self._abandon(key, flight)
+            raise
+        except Exception:
+            with self._lock:
+                flight.waiters -= 1
+            raise
+        with self._lock:
+            flight.waiters -= 1
+            owner, flight.claimed = not flight.claimed, True
+        return result, owner
+
+    def _abandon(self, key: str, flight: _Flight) -> None:
+        with self._lock:
+            flight.waiters -= 1
+            self.counters.increment("abandoned")
+            if flight.waiters or flight.future.done():
+                return
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        logger.debug("Cancelling call for key `%s` with no waiters left", key)
+        self.counters.increment("cancelled")
+        flight.future.cancel()
+
+    def _finish(self, key: str, flight: _Flight) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if not flight.future.cancelled() and flight.future.exception() is not None:
+            self.counters.increment("failed")
+
+
+single_flight = SingleFlight() if config.SINGLE_FLIGHT_ENABLED else None
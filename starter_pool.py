@@ -0,0 +1,195 @@
+import asyncio
+from collections import deque
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import threading
+
+from accounting import CallRecord
+import config
+import llm
+import metrics
+from session import Session
+from topic_index import topic_sampler
+
+logger = logging.getLogger()
+
+PROMPT_CONVERSATION_STARTER = open("prompts/conversation_starter.txt", "r").read()
+PROMPT_SYSTEM_MAIN = open("prompts/system_main.txt", "r").read()
+
+
+def conversation_topic(seen: set[str] | None = None) -> str:
+    return topic_sampler().sample(seen)
+
+
+async def generate_starter(session: Session, topic: str) -> str:
+    logger.info(f"Making request for conversation starter about topic `{topic}`...")
+    message = await llm.complete(
+        session,
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": PROMPT_SYSTEM_MAIN},
+            {
+                "role": "user",
+                "content": PROMPT_CONVERSATION_STARTER.format(topic),
+            },
+        ],
+        temperature=0.8,
+        stage="starter",
+    )
+    conversation_starter = message["content"]
+    logger.debug("Received conversation starter `%s`", conversation_starter)
+    return conversation_starter
+
+
+@dataclass
+class Starter:
+    topic: str
+    starter: str
+    # What generating the starter cost, charged to the session that receives it
+    calls: list[CallRecord] = field(default_factory=list)
+
+
+class StarterPool:
+    """
+    Conversation starters for random topics, generated ahead of time in the
+    background so that a new session can be handed one without waiting on the
+    API. The pool is topped back up to `size` whenever it falls below
+    `low_water`, and is saved to `path` so it survives restarts.
+    """
+
+    def __init__(
+        self,
+        size: int = config.STARTER_POOL_SIZE,
+        low_water: int = config.STARTER_POOL_LOW_WATER,
+        path: str = config.STARTER_POOL_PATH,
+    ):
+        self.size = size
+        self.low_water = low_water
+        self.path = path
+        self.counters = metrics.counters(
+            "starter_pool", "generated", "served", "misses", "failures"
+        )
+        self._starters: deque[Starter] = deque()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._refilling = False
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._starters)
+
+    def start(self) -> None:
+        """Load the saved pool and begin filling it in the background."""
+        if not self.size:
+            return
+        self._load()
+        self._schedule_refill()
+
+    async def get(self, session: Session) -> tuple[str, str]:
+        """
+        A `(topic, starter)` for `session` on a topic it has not had yet,
+        generating one only if none are ready.
+        """
+        with self._lock:
+            starter = next(
+                (s for s in self._starters if s.topic not in session.seen_topics),
+                None,
+            )
+            if starter is not None:
+                self._starters.remove(starter)
+        if starter is not None:
+            self.counters.increment("served")
+            session.seen_topics.add(starter.topic)
+            for record in starter.calls:
+                session.record_call(record)
+            await asyncio.to_thread(self._save)
+            if len(self) < self.low_water:
+                self._schedule_refill()
+            return starter.topic, starter.starter
+        if self.size:
+            self.counters.increment("misses")
+            self._schedule_refill()
+        topic = conversation_topic(session.seen_topics)
+        return topic, await generate_starter(session, topic)
+
+    def _schedule_refill(self) -> None:
+        with self._lock:
+            if self._refilling or not self.size:
+                return
+            self._refilling = True
+        asyncio.run_coroutine_threadsafe(self._refill(), llm.client_loop())
+
+    async def _refill(self) -> None:
+        try:
+            missing = self.size - len(self)
+            if missing <= 0:
+                return
+            logger.info(f"Generating {missing} conversation starters for the pool...")
+            # Pooled starters are spread over as many topics as possible
+            with self._lock:
+                pooled = {starter.topic for starter in self._starters}
+            results = await asyncio.gather(
+                *(self._generate(pooled) for _ in range(missing)),
+                return_exceptions=True,
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    logger.warning(
+                        f"Failed to generate conversation starter: {result!r}"
+                    )
+                    self.counters.increment("failures")
+                    continue
+                with self._lock:
+                    self._starters.append(result)
+                self.counters.increment("generated")
+            await asyncio.to_thread(self._save)
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    async def _generate(self, pooled: set[str]) -> Starter:
+        session = Session(session_id="starter-pool")
+        topic = conversation_topic(pooled)
+        starter = await generate_starter(session, topic)
+        return Starter(topic, starter, session.ledger.records)
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                starters = [
+                    Starter(
+                        item["topic"],
+                        item["starter"],
+                        [CallRecord(**record) for record in item.get("calls", [])],
+                    )
+                    for item in json.load(file)
+                ]
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception(f"Could not load conversation starters from `{self.path}`")
+            return
+        with self._lock:
+            self._starters.extend(starters)
+        logger.info(f"Loaded {len(starters)} conversation starters from `{self.path}`")
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        try:
+            # Snapshot under the save lock too, so an older snapshot can never
+            # overwrite a newer one
+            with self._save_lock:
+                with self._lock:
+                    starters = [asdict(starter) for starter in self._starters]
+                with open(temp_path, "w", encoding="utf-8") as file:
+                    json.dump(starters, file, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+        except OSError:
+            logger.exception(f"Could not save conversation starters to `{self.path}`")
+
+
+starter_pool = StarterPool()
@@ -0,0 +1,259 @@
+import asyncio
+from dataclasses import fields
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+import config
+from session import TRANSIENT_FIELDS, Session
+
+logger = logging.getLogger()
+
+# Session fields that concurrent turns each add to, or each append to
+ADDITIVE_FIELDS = (
+    "input_tokens_used",
+    "output_tokens_used",
+    "cached_responses",
+    "coalesced_responses",
+    "prompt_tokens_saved",
+)
+APPENDED_FIELDS = ("message_history", "ledger")
+
+
+def merge_session_data(base: dict, ours: dict, theirs: dict) -> dict:
+    """
+    Three-way merge of a session that another process saved after we read
+    `base`: the messages, calls and counts added by both are kept, and any
+    other field we changed is taken from `ours`.
+    """
+    merged = dict(theirs)
+    for name, value in ours.items():
+        if name in APPENDED_FIELDS:
+            merged[name] = theirs[name] + value[len(base[name]) :]
+        elif name in ADDITIVE_FIELDS:
+            merged[name] = theirs[name] + value - base[name]
+        elif value != base.get(name):
+            merged[name] = value
+    return merged
+
+
+class MemorySessionStore:
+    """Sessions held in this process, keyed by the id held in the browser."""
+
+    def __init__(self, idle_timeout: float = config.SESSION_IDLE_TIMEOUT_SECONDS):
+        self.idle_timeout = idle_timeout
+        self._sessions: dict[str, Session] = {}
+        self._lock = threading.Lock()
+
+    def create(self, message_history: list[dict], topic: str = "") -> Session:
+        session = Session(
+            session_id=uuid.uuid4().hex,
+            message_history=message_history,
+            topic=topic,
+        )
+        with self._lock:
+            self._evict_idle()
+            self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id: str | None) -> Session | None:
+        if session_id is None:
+            return None
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None:
+            session.touch()
+        return session
+
+    def save(self, session: Session) -> None:
+        # Sessions are shared by reference, so there is nothing to write back
+        pass
+
+    async def aget(self, session_id: str | None) -> Session | None:
+        return self.get(session_id)
+
+    async def asave(self, session: Session) -> None:
+        self.save(session)
+
+    def remove(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def _evict_idle(self) -> None:
+        cutoff = time.monotonic() - self.idle_timeout
+        for session_id in [
+            session_id
+            for session_id, session in self._sessions.items()
+            if session.last_active < cutoff
+        ]:
+            del self._sessions[session_id]
+
+
+class SQLiteSessionStore:
+    """
+    Sessions saved to a SQLite file, so that any worker process on the host can
+    serve any session. Each process keeps the sessions it has used in memory,
+    and only reads one back from the file when another process has saved a
+    newer version of it. Sessions must be saved after every change. A save
+    only succeeds against the version it was read at; if another process saved
+    in between, the two are merged (see `merge_session_data`) and saved again.
+    """
+
+    def __init__(
+        self,
+        path: str = config.SESSION_STORE_PATH,
+        idle_timeout: float = config.SESSION_IDLE_TIMEOUT_SECONDS,
+    ):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        # The version of each session last read or written by this process,
+        # and its data as of that version
+        self._local: dict[str, tuple[int, Session, str]] = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, data TEXT NOT NULL, "
+            "version INTEGER NOT NULL, last_active REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_last_active "
+            "ON sessions (last_active)"
+        )
+        self._connection.commit()
+
+    def create(self, message_history: list[dict], topic: str = "") -> Session:
+        session = Session(
+            session_id=uuid.uuid4().hex,
+            message_history=message_history,
+            topic=topic,
+        )
+        with self._lock:
+            self._evict_idle()
+        self.save(session)
+        return session
+
+    def get(self, session_id: str | None) -> Session | None:
+        if session_id is None:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                self._local.pop(session_id, None)
+                return None
+            cached = self._local.get(session_id)
+            if cached is not None and cached[0] == row[0]:
+                session = cached[1]
+            else:
+                version, data = self._connection.execute(
+                    "SELECT version, data FROM sessions WHERE session_id = ?",
+                    (session_id,),
+                ).fetchone()
+                logger.debug("Loading session `%s` version %d", session_id, version)
+                session = Session.from_dict(json.loads(data))
+                self._local[session_id] = (version, session, data)
+        session.touch()
+        return session
+
+    def save(self, session: Session) -> None:
+        session_id = session.session_id
+        data = json.dumps(session.to_dict(), ensure_ascii=False)
+        merged = False
+        with self._lock:
+            version, _, base = self._local.get(session_id, (0, session, ""))
+            while True:
+                with self._connection:
+                    saved = self._connection.execute(
+                        "UPDATE sessions SET data = ?, version = version + 1, "
+                        "last_active = ? WHERE session_id = ? AND version = ?",
+                        (data, time.time(), session_id, version),
+                    ).rowcount
+                    if not saved:
+                        # New, or evicted since it was read
+                        saved = self._connection.execute(
+                            "INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?)",
+                            (session_id, data, version + 1, time.time()),
+                        ).rowcount
+                    row = self._connection.execute(
+                        "SELECT version, data FROM sessions WHERE session_id = ?",
+                        (session_id,),
+                    ).fetchone()
+                if saved:
+                    break
+                logger.info(
+                    f"Session `{session_id}` was saved by another process, merging..."
+                )
+                version, theirs = row
+                if base:
+                    data = json.dumps(
+                        merge_session_data(
+                            json.loads(base), json.loads(data), json.loads(theirs)
+                        ),
+                        ensure_ascii=False,
+                    )
+                    merged = True
+                base = theirs
+            self._local[session_id] = (row[0], session, data)
+        if merged:
+            _update(session, Session.from_dict(json.loads(data)))
+
+    async def aget(self, session_id: str | None) -> Session | None:
+        return await asyncio.to_thread(self.get, session_id)
+
+    async def asave(self, session: Session) -> None:
+        await asyncio.to_thread(self.save, session)
+
+    def remove(self, session_id: str) -> None:
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM sessions WHERE session_id = ?", (session_id,)
+                )
+            self._local.pop(session_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[
+                0
+            ]
+
+    def _evict_idle(self) -> None:
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM sessions WHERE last_active < ?",
+                (time.time() - self.idle_timeout,),
+            )
+        cutoff = time.monotonic() - self.idle_timeout
+        for session_id in [
+            session_id
+            for session_id, (_, session, _) in self._local.items()
+            if session.last_active < cutoff
+        ]:
+            del self._local[session_id]
+
+
+def _update(session: Session, saved: Session) -> None:
+    """Bring `session` in line with the `saved` state, keeping its transient state."""
+    for f in fields(Session):
+        if f.name not in TRANSIENT_FIELDS:
+            setattr(session, f.name, getattr(saved, f.name))
+
+
+def build_session_store() -> MemorySessionStore | SQLiteSessionStore:
+    if config.SESSION_STORE == "sqlite":
+        logger.info(f"Using SQLite session store at `{config.SESSION_STORE_PATH}`")
+        return SQLiteSessionStore()
+    if config.SESSION_STORE != "memory":
+        raise ValueError(f"Unknown session store `{config.SESSION_STORE}`")
+    return MemorySessionStore()
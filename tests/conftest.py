@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Must be set before the modules under test import config, and the prompts they
+# load at import time are relative to the repository root
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+# Corrections must come from the stages under test, not from earlier runs
+os.environ["SIMILARITY_INDEX_ENABLED"] = "0"
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
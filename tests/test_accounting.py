@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from accounting import Budget, BudgetExceeded, CallRecord, Ledger, cost, pricing
+import llm
+from session import Session
+from tokens import count_message_tokens
+
+
+def message(role: str, words: int) -> dict:
+    return {"role": role, "content": " ".join(["palabra"] * words)}
+
+
+def test_dated_snapshots_use_the_longest_matching_price():
+    assert pricing("gpt-3.5-turbo-0613") == pricing("gpt-3.5-turbo")
+    assert pricing("gpt-3.5-turbo-16k-0613") == pricing("gpt-3.5-turbo-16k")
+    assert pricing("unknown-model") == pricing("gpt-3.5-turbo")
+    assert cost("gpt-4", 1000, 1000) == pytest.approx(0.09)
+
+
+def test_ledger_totals_by_stage():
+    ledger = Ledger()
+    ledger.record(CallRecord("explanation", "gpt-3.5-turbo", 100, 10))
+    ledger.record(CallRecord("conversation", "gpt-3.5-turbo", 200, 20))
+    ledger.record(CallRecord("explanation", "gpt-3.5-turbo", cached=True))
+    by_stage = ledger.by_stage()
+    assert list(by_stage) == ["conversation", "explanation"]
+    assert by_stage["explanation"].calls == 2
+    assert by_stage["explanation"].cached_calls == 1
+    assert ledger.total().prompt_tokens == 300
+    assert ledger.cost() == pytest.approx(cost("gpt-3.5-turbo", 300, 30))
+
+
+def test_prompts_over_the_limit_are_rejected():
+    budget = Budget(max_prompt_tokens=50, action="reject", session_limit_usd=0)
+    with pytest.raises(BudgetExceeded):
+        budget.apply(Ledger(), "gpt-3.5-turbo", [message("user", 100)])
+
+
+def test_prompts_over_the_limit_are_trimmed_oldest_first():
+    messages = [
+        message("system", 10),
+        message("user", 30),
+        message("assistant", 30),
+        message("user", 10),
+    ]
+    kept = [messages[0], messages[2], messages[3]]
+    limit = count_message_tokens(kept, "gpt-3.5-turbo")
+    budget = Budget(max_prompt_tokens=limit, action="trim", session_limit_usd=0)
+    assert budget.apply(Ledger(), "gpt-3.5-turbo", messages) == (kept, limit)
+    # The system prompt and the final message are never dropped
+    limit = count_message_tokens([messages[0], messages[3]], "gpt-3.5-turbo") - 1
+    budget = Budget(max_prompt_tokens=limit, action="trim", session_limit_usd=0)
+    with pytest.raises(BudgetExceeded):
+        budget.apply(Ledger(), "gpt-3.5-turbo", messages)
+
+
+def test_exhausted_session_budget_refuses_calls(monkeypatch):
+    async def create_chat_completion(**kwargs):
+        raise AssertionError("sent a request over budget")
+
+    monkeypatch.setattr(llm, "create_chat_completion", create_chat_completion)
+    monkeypatch.setattr(
+        llm, "budget", Budget(max_prompt_tokens=0, session_limit_usd=0.01)
+    )
+    session = Session("test")
+    session.record_call(CallRecord("conversation", "gpt-4", 1000, 0))
+    with pytest.raises(BudgetExceeded):
+        asyncio.run(
+            llm.complete(
+                session,
+                model="gpt-3.5-turbo",
+                messages=[message("user", 5)],
+                temperature=0.0,
+            )
+        )
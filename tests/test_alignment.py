@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from alignment import align_correction
+import config
+from engine import Turn
+import new_handler
+from session import Session
+
+
+@pytest.mark.parametrize(
+    "input_str, corrected_str, correction_tuples",
+    [
+        ("Yo es un estudiante", "Yo soy un estudiante", [("es", "soy")]),
+        ("Voy al tienda mañana", "Voy a la tienda mañana", [("al", "a la")]),
+        ("Hola, como estas?", "Hola, ¿cómo estás?", [("como estas?", "¿cómo estás?")]),
+        (
+            "Tengo hambre mucho",
+            "Tengo mucha hambre",
+            [("hambre mucho", "mucha hambre")],
+        ),
+        ("hola", "Hola.", []),
+    ],
+)
+def test_align_correction(input_str, corrected_str, correction_tuples):
+    assert align_correction(input_str, corrected_str)[0] == correction_tuples
+
+
+def test_rewrites_have_low_confidence():
+    _, confidence = align_correction("abc def ghi jkl", "xyz uvw rst")
+    assert confidence < config.ALIGNMENT_MIN_CONFIDENCE
+
+
+@pytest.fixture
+def llm_correction_tuples(monkeypatch):
+    calls = []
+
+    async def get_llm_correction_tuples(turn):
+        calls.append(turn.user_input)
+        return [("llm", "tuple")]
+
+    monkeypatch.setattr(
+        new_handler, "get_llm_correction_tuples", get_llm_correction_tuples
+    )
+    return calls
+
+
+def get_correction_tuples(input_str: str, corrected_input: str) -> list | None:
+    turn = Turn(input_str, Session("test"))
+    turn.results["corrected_input"] = corrected_input
+    turn.results["alignment"] = align_correction(input_str, corrected_input)
+    return asyncio.run(new_handler.get_correction_tuples(turn))
+
+
+def test_confident_alignment_stays_local(llm_correction_tuples):
+    assert get_correction_tuples("Yo es un estudiante", "Yo soy un estudiante") == [
+        ("es", "soy")
+    ]
+    assert llm_correction_tuples == []
+
+
+def test_low_confidence_falls_back_to_llm(llm_correction_tuples):
+    assert get_correction_tuples("abc def ghi jkl", "xyz uvw rst") == [("llm", "tuple")]
+    assert llm_correction_tuples == ["abc def ghi jkl"]
+
+
+def test_local_mode_never_falls_back(monkeypatch, llm_correction_tuples):
+    monkeypatch.setattr(config, "CORRECTION_TUPLES_MODE", "local")
+    assert get_correction_tuples("abc def ghi jkl", "xyz uvw rst") == [
+        ("abc def ghi jkl", "xyz uvw rst")
+    ]
+    assert llm_correction_tuples == []
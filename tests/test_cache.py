@@ -0,0 +1,67 @@
+import time
+
+from cache import MemoryBackend, ResponseCache, SQLiteBackend
+
+
+def test_memory_backend_evicts_least_recently_used():
+    memory = MemoryBackend(max_entries=2)
+    expires_at = time.time() + 60
+    memory.set("a", 1, expires_at)
+    memory.set("b", 2, expires_at)
+    assert memory.get("a") == 1
+    memory.set("c", 3, expires_at)
+    assert memory.get("b") is None
+    assert (memory.get("a"), memory.get("c")) == (1, 3)
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = ResponseCache(
+        MemoryBackend(10), SQLiteBackend(str(tmp_path / "cache.sqlite3"), 10), ttl=-1
+    )
+    cache.set("key", {"content": "Hola"})
+    assert cache.get("key") is None
+    assert len(cache.disk) == 0
+    assert cache.stats()["misses"] == 1
+
+
+def test_disk_entries_survive_restarts(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(MemoryBackend(10), SQLiteBackend(path, 10)).set(
+        "key", {"content": "Hola"}
+    )
+    cache = ResponseCache(MemoryBackend(10), SQLiteBackend(path, 10))
+    assert cache.get("key") == {"content": "Hola"}
+    assert len(cache.memory) == 1
+    assert cache.stats()["hit_rate"] == 1.0
+
+
+def test_promotion_keeps_the_disk_expiry(tmp_path):
+    disk = SQLiteBackend(str(tmp_path / "cache.sqlite3"), 10)
+    expires_at = time.time() + 0.2
+    disk.set("key", "Hola", expires_at)
+    cache = ResponseCache(MemoryBackend(10), disk, ttl=60)
+    assert cache.get("key") == "Hola"
+    time.sleep(0.3)
+    assert cache.get("key") is None
+
+
+def test_disk_evicts_least_recently_used_rows(tmp_path):
+    disk = SQLiteBackend(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    disk.EVICT_EVERY_N_WRITES = 1
+    expires_at = time.time() + 60
+    disk.set("a", 1, expires_at)
+    time.sleep(0.01)
+    disk.set("b", 2, expires_at)
+    time.sleep(0.01)
+    assert disk.get("a") == (expires_at, 1)
+    time.sleep(0.01)
+    disk.set("c", 3, expires_at)
+    assert disk.get("b") is None
+    assert len(disk) == 2
+
+
+def test_make_key_depends_on_every_part():
+    key = ResponseCache.make_key("gpt", "template", {"messages": []}, 0.0)
+    assert key == ResponseCache.make_key("gpt", "template", {"messages": []}, 0.0)
+    assert key != ResponseCache.make_key("gpt", "other", {"messages": []}, 0.0)
+    assert key != ResponseCache.make_key("gpt", "template", {"messages": []}, 0.5)
@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+import pytest
+
+import config
+from engine import (
+    PENDING_EXPLANATIONS,
+    Engine,
+    Stage,
+    Strategy,
+    Turn,
+    get_conversation_response,
+    late_correction,
+    stream_conversation_response,
+)
+import llm
+import new_handler
+from session import Session
+
+
+async def reply(turn: Turn) -> str:
+    return "reply"
+
+
+async def correct(turn: Turn) -> str:
+    # Sentences ending in "..." take their time
+    await asyncio.sleep(0.5 if "..." in turn.user_input else 0)
+    return turn.user_input.upper()
+
+
+STRATEGY = Strategy(
+    name="test",
+    stages=(Stage("reply", reply), Stage("corrected", correct)),
+    reply="reply",
+    correction=lambda turn: (turn["corrected"], ["explained"]),
+    validate_explanations=False,
+    incremental=True,
+)
+
+
+def test_late_correction_is_handed_over():
+    engine = Engine(STRATEGY, deadline=0.1)
+    session = Session("test")
+    correction_response, conversation_response = llm.run_sync(
+        engine.run("Hola...", session)
+    )
+    assert correction_response.startswith("Hola...")
+    assert PENDING_EXPLANATIONS in correction_response
+    assert conversation_response == "reply"
+    assert session.late_correction is not None
+
+    late = llm.run_sync(late_correction(session))
+    assert late is not None and late.startswith("HOLA...")
+    assert "explained" in late
+    # Delivered once only
+    assert session.late_correction is None
+    assert llm.run_sync(late_correction(session)) is None
+
+
+def test_next_turn_cancels_late_correction():
+    engine = Engine(STRATEGY, deadline=0.1)
+    session = Session("test")
+    llm.run_sync(engine.run("Hola...", session))
+    late = session.late_correction
+    correction_response, _ = llm.run_sync(engine.run("Adios.", session))
+    assert late is not None and late.cancelled()
+    assert correction_response.startswith("ADIOS.")
+    assert session.late_correction is None
+
+
+def test_partial_correction_keeps_finished_sentences():
+    engine = Engine(STRATEGY, deadline=0.1)
+    session = Session("test")
+    engine.prepare("Hola. Espera... Adios.", session)
+    # Past the debounce, and the quick sentences are corrected
+    time.sleep(config.INCREMENTAL_CORRECTION_DEBOUNCE_SECONDS + 0.1)
+    correction_response, _ = llm.run_sync(engine.run("Hola. Espera... Adios.", session))
+    corrected_input, explanations = correction_response.split("\n\n", 1)
+    assert corrected_input == "HOLA. Espera... ADIOS."
+    assert "explained" in explanations and PENDING_EXPLANATIONS in explanations
+    late = llm.run_sync(late_correction(session))
+    assert late is not None and late.startswith("HOLA. ESPERA... ADIOS.")
+
+
+def test_new_handler_partial_correction_marks_only_missing_explanations():
+    turn = Turn("Yo es cansado y tengo hambre", Session("test"))
+    turn.results.update(
+        corrected_input="Yo estoy cansado y tengo hambre",
+        alignment=([("es", "estoy")], 1.0),
+        correction_tuples=[("es", "estoy"), ("cansado", "cansada")],
+        finished_explanations={
+            new_handler.pair_key("es", "estoy"): "Estar is for states."
+        },
+    )
+    assert new_handler.partial_correction(turn) == (
+        "Yo estoy cansado y tengo hambre",
+        [
+            "Estar is for states.",
+            '"cansado" was changed to "cansada" (explanation pending)',
+        ],
+    )
+
+
+async def failing_stream(session, **kwargs):
+    yield "Hola"
+    raise RuntimeError("upstream failed")
+
+
+def test_failed_stream_leaves_history_unchanged(monkeypatch):
+    monkeypatch.setattr(llm, "stream", failing_stream)
+    session = Session("test", message_history=[{"role": "system", "content": "S"}])
+
+    async def consume():
+        async for _ in stream_conversation_response(Turn("Hola", session)):
+            pass
+
+    with pytest.raises(RuntimeError):
+        llm.run_sync(consume())
+    assert session.message_history == [{"role": "system", "content": "S"}]
+
+
+def test_abandoned_stream_leaves_history_unchanged(monkeypatch):
+    monkeypatch.setattr(llm, "stream", failing_stream)
+    session = Session("test", message_history=[{"role": "system", "content": "S"}])
+
+    async def abandon():
+        deltas = stream_conversation_response(Turn("Hola", session))
+        assert await deltas.__anext__() == "Hola"
+        await deltas.aclose()
+
+    llm.run_sync(abandon())
+    assert session.message_history == [{"role": "system", "content": "S"}]
+
+
+def test_finished_reply_is_added_with_its_input(monkeypatch):
+    async def complete(session, **kwargs):
+        return {"role": "assistant", "content": "Hola, ¿qué tal?"}
+
+    monkeypatch.setattr(llm, "complete", complete)
+    session = Session("test", message_history=[{"role": "system", "content": "S"}])
+    assert llm.run_sync(get_conversation_response(Turn("Hola", session))) == (
+        "Hola, ¿qué tal?"
+    )
+    assert session.message_history[1:] == [
+        {"role": "user", "content": "Hola"},
+        {"role": "assistant", "content": "Hola, ¿qué tal?"},
+    ]
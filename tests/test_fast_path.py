@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+import func_arg_handler
+from func_arg_handler import FastPath, InvalidResponse, parse_combined_response
+from session import Session
+
+ARGUMENTS = {
+    "corrected_input": "Yo soy un estudiante.",
+    "correction_explanations": ['"es" was changed to "soy"'],
+    "conversation_response": "¿Qué estudias?",
+}
+
+
+def function_call(arguments: str) -> dict:
+    return {"function_call": {"name": "receive_outputs", "arguments": arguments}}
+
+
+class FakeEngine:
+    def __init__(self, name: str, invalid: bool = False) -> None:
+        self.name = name
+        self.invalid = invalid
+        self.turns = 0
+        self.incremental = False
+
+    async def run(self, user_input: str, session: Session) -> tuple[str, str]:
+        self.turns += 1
+        if self.invalid:
+            raise InvalidResponse("missing field")
+        return self.name, user_input
+
+
+def run(fast_path: FastPath) -> tuple[str, str]:
+    return asyncio.run(fast_path.run("Hola", Session("test")))
+
+
+def test_valid_responses_take_the_fast_path():
+    engine, fallback = FakeEngine("fast"), FakeEngine("fallback")
+    assert run(FastPath(engine, fallback)) == ("fast", "Hola")
+    assert fallback.turns == 0
+
+
+def test_invalid_responses_fall_back():
+    engine, fallback = FakeEngine("fast", invalid=True), FakeEngine("fallback")
+    assert run(FastPath(engine, fallback)) == ("fallback", "Hola")
+    assert (engine.turns, fallback.turns) == (1, 1)
+
+
+def test_frequent_fallbacks_bypass_the_fast_path_but_probe_it():
+    engine, fallback = FakeEngine("fast", invalid=True), FakeEngine("fallback")
+    fast_path = FastPath(
+        engine, fallback, window=5, max_fallback_rate=0.5, probe_every=3
+    )
+    for _ in range(5):
+        run(fast_path)
+    assert engine.turns == 5
+    engine.invalid = False
+    assert [run(fast_path)[0] for _ in range(3)] == ["fallback", "fallback", "fast"]
+    assert engine.turns == 6
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        function_call("{not json"),
+        function_call(json.dumps({"corrected_input": "Hola"})),
+        {"content": "Hola"},
+    ],
+)
+def test_malformed_responses_are_invalid(message):
+    with pytest.raises(InvalidResponse):
+        parse_combined_response(message)
+
+
+def test_prompt_tokens_saved_are_only_counted_when_valid(monkeypatch):
+    responses = [function_call("{not json"), function_call(json.dumps(ARGUMENTS))]
+
+    async def complete(session, **kwargs):
+        return responses.pop(0)
+
+    monkeypatch.setattr(func_arg_handler.llm, "complete", complete)
+    monkeypatch.setattr(
+        func_arg_handler.history_manager, "window", lambda session: ([], 7)
+    )
+    session = Session("test")
+    turn = func_arg_handler.Turn("Yo es un estudiante.", session)
+    with pytest.raises(InvalidResponse):
+        asyncio.run(func_arg_handler.get_combined_response(turn))
+    assert session.prompt_tokens_saved == 0
+    assert asyncio.run(func_arg_handler.get_combined_response(turn)) == ARGUMENTS
+    assert session.prompt_tokens_saved == 7
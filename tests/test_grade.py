@@ -0,0 +1,16 @@
+from grade import errors_path, graded_ids
+
+
+def test_graded_ids_drop_a_line_cut_off_mid_write(tmp_path):
+    output = tmp_path / "graded.jsonl"
+    output.write_text('{"id": "1"}\n{"id": "2"}\n{"id": "3", "corr', encoding="utf-8")
+    assert graded_ids(str(output)) == {"1", "2"}
+    assert output.read_text(encoding="utf-8") == '{"id": "1"}\n{"id": "2"}\n'
+
+
+def test_nothing_is_graded_without_an_output(tmp_path):
+    assert graded_ids(str(tmp_path / "graded.jsonl")) == set()
+
+
+def test_failures_are_kept_beside_the_output():
+    assert errors_path("out/graded.jsonl") == "out/graded.errors.jsonl"
@@ -0,0 +1,94 @@
+from engine import Engine, Stage, Strategy, Turn
+from incremental import IncrementalCorrector, split_sentences
+import llm
+from session import Session
+
+
+def test_split_sentences_keeps_unfinished_tail():
+    assert split_sentences("Hola. Como estas? Yo es") == (
+        ["Hola.", "Como estas?"],
+        "Yo es",
+    )
+    assert split_sentences("Hola. Adios! ") == (["Hola.", "Adios!"], "")
+    assert split_sentences("  ") == ([], "")
+
+
+class FakeCorrections:
+    def __init__(self) -> None:
+        self.corrected: list[str] = []
+
+    async def __call__(self, text: str, session: Session) -> tuple[str, list[str]]:
+        self.corrected.append(text)
+        return text.upper(), [f"{text} explained"]
+
+
+def test_finish_reuses_prepared_sentences():
+    correct = FakeCorrections()
+    corrector = IncrementalCorrector(correct, debounce=0)
+    session = Session("test")
+    corrector.update("Uno. Dos. Tr", session)
+    assert len(session.sentence_corrections) == 2
+    correction = llm.run_sync(corrector.finish("Uno. Dos. Tres", session))
+    assert correction == (
+        "UNO. DOS. TRES",
+        ["Uno. explained", "Dos. explained", "Tres explained"],
+    )
+    assert sorted(correct.corrected) == ["Dos.", "Tres", "Uno."]
+    assert session.sentence_corrections == {}
+
+
+def test_update_cancels_removed_sentences():
+    correct = FakeCorrections()
+    corrector = IncrementalCorrector(correct, debounce=60)
+    session = Session("test")
+    corrector.update("Uno. Dos.", session)
+    futures = list(session.sentence_corrections.values())
+    corrector.update("Uno.", session)
+    assert len(session.sentence_corrections) == 1
+    assert futures[1].cancelled() and not futures[0].cancelled()
+    for future in session.sentence_corrections.values():
+        future.cancel()
+
+
+async def reply(turn: Turn) -> str:
+    return "reply"
+
+
+async def correct_whole(turn: Turn) -> str:
+    return f"whole: {turn.user_input}"
+
+
+STRATEGY = Strategy(
+    name="test",
+    stages=(Stage("reply", reply), Stage("corrected", correct_whole)),
+    reply="reply",
+    correction=lambda turn: (turn["corrected"], []),
+    validate_explanations=False,
+    incremental=True,
+)
+
+
+def test_unprepared_turn_runs_correction_stages():
+    engine = Engine(STRATEGY)
+    correction_response, conversation_response = llm.run_sync(
+        engine.run("Uno. Dos.", Session("test"))
+    )
+    assert correction_response.startswith("whole: Uno. Dos.")
+    assert conversation_response == "reply"
+
+
+def test_prepared_turn_finishes_incrementally():
+    engine = Engine(STRATEGY)
+    session = Session("test")
+    engine.prepare("Uno. Dos.", session)
+    correction_response, _ = llm.run_sync(engine.run("Uno. Dos.", session))
+    # Each sentence was corrected on its own
+    assert correction_response.startswith("whole: Uno. whole: Dos.")
+    assert session.sentence_corrections == {}
+
+
+def test_prepare_without_typing_does_nothing():
+    engine = Engine(STRATEGY)
+    session = Session("test")
+    engine.prepare("Uno", session)
+    assert session.sentence_corrections == {}
@@ -0,0 +1,85 @@
+import dataclasses
+
+import pytest
+
+from engine import Engine, Stage, Strategy, Turn
+import llm
+from local_fixer import LocalFixer
+from session import Session
+
+fixer = LocalFixer.load()
+
+
+@pytest.mark.parametrize(
+    "text, fixed",
+    [
+        ("como te llamas?", "¿Cómo te llamas?"),
+        ("Hola, como te llamas?", "Hola, ¿cómo te llamas?"),
+        ("Por que no vienes?", "¿Por qué no vienes?"),
+        ("que bonito!", "¡Que bonito!"),
+        ("Tengo una cancion nueva.", "Tengo una canción nueva."),
+        ("hola. donde vives?", "Hola. ¿Dónde vives?"),
+        ("¿Cuando llegas?", "¿Cuándo llegas?"),
+        # The question may start after the comma, so neither is touched
+        ("Cuando llegas, me llamas?", "Cuando llegas, me llamas?"),
+        ("Donde esta el bano, por favor?", "Donde esta el baño, por favor?"),
+        ("¿Cuando llegas, me llamas?", "¿Cuando llegas, me llamas?"),
+        ("Cuando llegas me llamas.", "Cuando llegas me llamas."),
+    ],
+)
+def test_fix(text, fixed):
+    assert fixer.fix(text).fixed == fixed
+
+
+def test_fix_keeps_whitespace_between_sentences():
+    assert fixer.fix("Hola.  como te llamas?\nBien!").fixed == (
+        "Hola.  ¿Cómo te llamas?\n¡Bien!"
+    )
+
+
+def test_explanations_only_for_kept_fixes():
+    local_fix = fixer.fix("como te llamas?")
+    assert local_fix.explanations("¿Cómo te llamas?") == [
+        '"¿" was added because Spanish questions open with an inverted question mark.',
+        '"como" was changed to "cómo" because question words are written with an accent.',
+        '"cómo" was changed to "Cómo" because sentences start with a capital letter.',
+    ]
+    # The model put the question word back without its accent
+    assert local_fix.explanations("¿Como te llamas?") == [
+        '"¿" was added because Spanish questions open with an inverted question mark.',
+    ]
+
+
+async def reply(turn: Turn) -> str:
+    return "reply"
+
+
+async def echo_correction_input(turn: Turn) -> str:
+    return turn.correction_input
+
+
+STRATEGY = Strategy(
+    name="test",
+    stages=(Stage("reply", reply), Stage("corrected", echo_correction_input)),
+    reply="reply",
+    correction=lambda turn: (turn["corrected"], []),
+    validate_explanations=False,
+    fix_locally=True,
+)
+
+
+def test_engine_corrects_fixed_input():
+    corrected_input, explanations = llm.run_sync(
+        Engine(STRATEGY).correct("como te llamas?", Session("test"))
+    )
+    assert corrected_input == "¿Cómo te llamas?"
+    assert len(explanations) == 3
+
+
+def test_engine_leaves_input_alone_unless_fixing_locally():
+    strategy = dataclasses.replace(STRATEGY, fix_locally=False)
+    corrected_input, explanations = llm.run_sync(
+        Engine(strategy).correct("como te llamas?", Session("test"))
+    )
+    assert corrected_input == "como te llamas?"
+    assert explanations == []
@@ -0,0 +1,140 @@
+import asyncio
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+import config
+import llm
+from scheduler import RequestScheduler, TokenBucket
+from tokens import count_tokens
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(config, "SCHEDULER_BACKOFF_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(config, "SCHEDULER_HEDGE_MIN_DELAY_SECONDS", 0.05)
+
+
+def test_model_concurrency_is_capped():
+    running, peak = 0, 0
+
+    async def request() -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+
+    async def main() -> None:
+        scheduler = RequestScheduler(model_concurrency=2, hedge=False)
+        await asyncio.gather(
+            *(scheduler.call("concurrency", 10, request) for _ in range(6))
+        )
+
+    asyncio.run(main())
+    assert peak == 2
+
+
+def test_retryable_errors_are_retried():
+    attempts = 0
+
+    async def request() -> str:
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise openai.error.RateLimitError("slow down")
+        return "Hola"
+
+    scheduler = RequestScheduler(hedge=False)
+    assert asyncio.run(scheduler.call("retries", 10, request)) == "Hola"
+    assert attempts == 3
+
+
+def test_other_errors_are_not_retried():
+    attempts = 0
+
+    async def request() -> str:
+        nonlocal attempts
+        attempts += 1
+        raise openai.error.InvalidRequestError("bad request", param=None)
+
+    scheduler = RequestScheduler(hedge=False)
+    with pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(scheduler.call("no_retries", 10, request))
+    assert attempts == 1
+
+
+def test_backoff_honours_retry_after():
+    scheduler = RequestScheduler()
+    error = openai.error.RateLimitError("slow down", headers={"retry-after": "3"})
+    assert scheduler._backoff(0, error) == 3.0
+    assert 0 <= scheduler._backoff(2, openai.error.RateLimitError()) <= 0.04
+
+
+def test_slow_requests_are_hedged_and_charged_once():
+    calls = 0
+
+    async def request() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(1 if calls == 1 else 0)
+        return f"attempt {calls}"
+
+    scheduler = RequestScheduler(tokens_per_minute=1000)
+    assert asyncio.run(scheduler.call("hedged", 100, request)) == "attempt 2"
+    assert calls == 2
+    # Refilled by at most a few tokens since the call
+    assert 900 <= scheduler.token_bucket("hedged").tokens < 910
+
+
+def test_calls_past_the_deadline_time_out():
+    async def request() -> None:
+        await asyncio.sleep(1)
+
+    scheduler = RequestScheduler(deadline=0.05, hedge=False)
+    with pytest.raises(openai.error.Timeout):
+        asyncio.run(scheduler.call("deadline", 10, request))
+
+
+def test_token_bucket_adjusts_to_actual_usage():
+    bucket = TokenBucket(tokens_per_minute=600)
+    assert bucket.try_acquire(500)
+    assert not bucket.try_acquire(500)
+    bucket.adjust(-400)
+    assert bucket.try_acquire(500)
+
+
+def test_streams_adjust_the_budget_by_the_streamed_tokens(monkeypatch):
+    async def acreate(**kwargs):
+        async def chunks():
+            for content in ("Hola, ", "¿qué tal?"):
+                yield SimpleNamespace(
+                    choices=[SimpleNamespace(delta={"content": content})]
+                )
+
+        return chunks()
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(llm, "_get_client_session", lambda: None)
+    kwargs = {"model": "streamed", "messages": [{"role": "user", "content": "Hola"}]}
+
+    async def main() -> tuple[list, RequestScheduler]:
+        scheduler = RequestScheduler(tokens_per_minute=10_000, hedge=False)
+        monkeypatch.setattr(llm, "scheduler", scheduler)
+        queue: asyncio.Queue = asyncio.Queue()
+        await llm._stream_chat_completion(
+            queue, asyncio.get_running_loop(), None, **kwargs
+        )
+        await asyncio.sleep(0)
+        return [queue.get_nowait() for _ in range(queue.qsize())], scheduler
+
+    items, scheduler = asyncio.run(main())
+    assert items[:2] == ["Hola, ", "¿qué tal?"]
+    charged = 10_000 - scheduler.token_bucket("streamed").tokens
+    expected = (
+        llm._estimate_tokens("streamed", kwargs)
+        - config.SCHEDULER_COMPLETION_TOKENS_ESTIMATE
+        + count_tokens("Hola, ¿qué tal?", "streamed")
+    )
+    assert expected - 1 <= charged <= expected
@@ -0,0 +1,92 @@
+from similarity_index import SimilarityIndex, jaccard, ngrams, normalise
+
+
+def test_exact_lookup_ignores_accents_punctuation_and_case(tmp_path):
+    index = SimilarityIndex(path=str(tmp_path / "index.npz"), min_similarity=1.0)
+    index.add("Yo es muy cansado.", "Yo estoy muy cansado.")
+    assert index.lookup("yo  es MUY cansado") == "Yo estoy muy cansado."
+    assert index.lookup("Yo es muy cansada.") is None
+    # Inputs that normalise the same are only stored once
+    index.add("yo es muy cansado", "Otra corrección")
+    assert len(index) == 1
+
+
+def test_near_lookup_needs_enough_similarity(tmp_path):
+    index = SimilarityIndex(path=str(tmp_path / "index.npz"), min_similarity=0.6)
+    index.add(
+        "Ayer voy a la tienda con mi hermana",
+        "Ayer fui a la tienda con mi hermana",
+    )
+    assert (
+        index.lookup("Ayer voy a la tienda con mi hermano")
+        == "Ayer fui a la tienda con mi hermana"
+    )
+    assert index.lookup("Me gusta mucho la música clásica") is None
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "index.npz")
+    index = SimilarityIndex(path=path, min_similarity=0.6)
+    corrections = {
+        f"Tengo {i} años y vivo en Madrid": f"Corrección {i}" for i in range(50)
+    }
+    for text, correction in corrections.items():
+        index.add(text, correction)
+    index.save()
+
+    loaded = SimilarityIndex(path=path, min_similarity=0.6)
+    loaded.load()
+    assert len(loaded) == len(corrections)
+    for text, correction in corrections.items():
+        assert loaded.lookup(text) == correction
+    # Entries added after loading are found alongside the loaded ones
+    loaded.add("Hola, como estas?", "Hola, ¿cómo estás?")
+    assert loaded.lookup("hola como estas") == "Hola, ¿cómo estás?"
+    assert loaded.lookup(next(iter(corrections))) == "Corrección 0"
+
+
+def test_load_ignores_index_built_with_other_settings(tmp_path):
+    path = str(tmp_path / "index.npz")
+    index = SimilarityIndex(path=path)
+    index.add("Yo es muy cansado.", "Yo estoy muy cansado.")
+    index.save()
+    other = SimilarityIndex(path=path, bands=4)
+    other.load()
+    assert len(other) == 0
+
+
+def test_signatures_estimate_jaccard_similarity(tmp_path):
+    index = SimilarityIndex(path=str(tmp_path / "index.npz"), bands=128, rows=4)
+    a = ngrams(normalise("Ayer voy a la tienda con mi hermana y compramos pan"), 3)
+    b = ngrams(normalise("Ayer fui a la tienda con mi hermano y compramos leche"), 3)
+    agreement = (index.signature(a) == index.signature(b)).mean()
+    assert abs(agreement - jaccard(a, b)) < 0.1
+
+
+def test_near_matches_are_on_by_default(tmp_path):
+    index = SimilarityIndex(path=str(tmp_path / "index.npz"))
+    index.add("Me gusta mucho los perros grandes de mi vecino", "Me gustan mucho")
+    assert index.lookup("Me gusta mucho los perros grande de mi vecino") == (
+        "Me gustan mucho"
+    )
+    assert index.counters["near_hits"] >= 1
+
+
+def test_corrections_are_kept_apart_by_template(tmp_path):
+    index = SimilarityIndex(path=str(tmp_path / "index.npz"), min_similarity=0.6)
+    index.add("Yo es muy cansado.", "Yo estoy muy cansado.", "translate_sentence")
+    assert index.lookup("Yo es muy cansado.", "translate_input") is None
+    assert index.lookup("Yo es muy cansado hoy.", "translate_input") is None
+    assert (
+        index.lookup("Yo es muy cansado.", "translate_sentence")
+        == "Yo estoy muy cansado."
+    )
+
+
+def test_near_lookup_checks_the_closest_candidates_first(tmp_path):
+    index = SimilarityIndex(
+        path=str(tmp_path / "index.npz"), min_similarity=0.8, max_candidates=4
+    )
+    for i in range(500):
+        index.add(f"Tengo {i} años y vivo en Madrid con mi familia", f"{i}")
+    assert index.lookup("Tengo 123 años y vivo en Madrid con mi familla") == "123"
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+import llm
+from singleflight import SingleFlight
+
+
+class SlowCall:
+    def __init__(self, result: str = "Hola", error: Exception | None = None) -> None:
+        self.result = result
+        self.error = error
+        self.started = 0
+        self.cancelled = False
+
+    async def __call__(self) -> str:
+        self.started += 1
+        try:
+            await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_identical_calls_are_coalesced():
+    flights, call = SingleFlight("test_single_flight"), SlowCall()
+
+    async def main() -> list:
+        return await asyncio.gather(
+            *(flights.do("key", call, llm.client_loop()) for _ in range(3))
+        )
+
+    results = asyncio.run(main())
+    assert call.started == 1
+    assert [result for result, _ in results] == ["Hola"] * 3
+    # Exactly one caller pays for the call
+    assert sorted(owner for _, owner in results) == [False, False, True]
+    assert len(flights) == 0
+
+
+def test_different_keys_are_not_coalesced():
+    flights, call = SingleFlight("test_single_flight"), SlowCall()
+
+    async def main() -> tuple:
+        return await asyncio.gather(
+            flights.do("a", call, llm.client_loop()),
+            flights.do("b", call, llm.client_loop()),
+        )
+
+    assert [owner for _, owner in asyncio.run(main())] == [True, True]
+    assert call.started == 2
+
+
+def test_errors_reach_every_waiter():
+    flights, call = SingleFlight("test_single_flight"), SlowCall(error=ValueError())
+
+    async def main() -> list:
+        return await asyncio.gather(
+            *(flights.do("key", call, llm.client_loop()) for _ in range(2)),
+            return_exceptions=True,
+        )
+
+    assert [type(result) for result in asyncio.run(main())] == [ValueError] * 2
+    assert call.started == 1
+
+
+def test_cancelled_waiter_leaves_the_call_to_the_others():
+    flights, call = SingleFlight("test_single_flight"), SlowCall()
+
+    async def main() -> tuple:
+        first = asyncio.ensure_future(flights.do("key", call, llm.client_loop()))
+        second = asyncio.ensure_future(flights.do("key", call, llm.client_loop()))
+        await asyncio.sleep(0.02)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == ("Hola", True)
+    assert not call.cancelled
+
+
+def test_call_is_cancelled_once_nobody_waits():
+    flights, call = SingleFlight("test_single_flight"), SlowCall()
+
+    async def main() -> None:
+        waiter = asyncio.ensure_future(flights.do("key", call, llm.client_loop()))
+        await asyncio.sleep(0.02)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0.02)
+
+    asyncio.run(main())
+    assert call.cancelled
+    assert len(flights) == 0
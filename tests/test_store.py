@@ -0,0 +1,53 @@
+from accounting import CallRecord
+from store import SQLiteSessionStore
+
+
+def record_turn(session, user_input: str) -> None:
+    session.message_history.append({"role": "user", "content": user_input})
+    session.message_history.append({"role": "assistant", "content": "Vale."})
+    session.record_call(
+        CallRecord(
+            "conversation", "gpt-3.5-turbo", prompt_tokens=10, completion_tokens=5
+        )
+    )
+
+
+def test_concurrent_saves_are_merged(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    first, second = SQLiteSessionStore(path), SQLiteSessionStore(path)
+    session_id = first.create([{"role": "system", "content": "Hola"}]).session_id
+
+    ours, theirs = first.get(session_id), second.get(session_id)
+    record_turn(theirs, "Uno")
+    second.save(theirs)
+    record_turn(ours, "Dos")
+    ours.topic = "Música"
+    first.save(ours)
+
+    saved = SQLiteSessionStore(path).get(session_id)
+    assert [message["content"] for message in saved.message_history] == [
+        "Hola",
+        "Uno",
+        "Vale.",
+        "Dos",
+        "Vale.",
+    ]
+    assert saved.tokens_used() == (20, 10)
+    assert len(saved.ledger.records) == 2
+    assert saved.topic == "Música"
+    # The process that merged holds the merged session
+    assert ours.message_history == saved.message_history
+    assert ours.tokens_used() == (20, 10)
+
+
+def test_save_reads_back_only_newer_versions(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    first, second = SQLiteSessionStore(path), SQLiteSessionStore(path)
+    session = first.create([])
+    assert first.get(session.session_id) is session
+    copy = second.get(session.session_id)
+    record_turn(copy, "Uno")
+    second.save(copy)
+    reloaded = first.get(session.session_id)
+    assert reloaded is not session
+    assert len(reloaded.message_history) == 2
@@ -0,0 +1,60 @@
+import random
+
+from topic_index import TopicIndex, TopicSampler, build_index, parse_topics
+
+OUTLINE = """# Conversation topics
+
+Culture
+    - Art
+        - Museums
+    - Music
+
+Sports – Football • Tennis
+"""
+
+
+def names(topics):
+    return [
+        (topic.name, None if topic.parent is None else topics[topic.parent].name)
+        for topic in topics
+    ]
+
+
+def test_parse_topics_keeps_parents_and_skips_markdown_headers():
+    assert names(parse_topics(OUTLINE)) == [
+        ("Culture", None),
+        ("Art", "Culture"),
+        ("Museums", "Art"),
+        ("Music", "Culture"),
+        ("Sports", None),
+        ("Football", "Sports"),
+        ("Tennis", "Sports"),
+    ]
+
+
+def build(tmp_path) -> TopicIndex:
+    source = tmp_path / "topics.txt"
+    source.write_text(OUTLINE, encoding="utf-8")
+    build_index(str(source), str(tmp_path / "topics.idx"))
+    return TopicIndex(str(tmp_path / "topics.idx"))
+
+
+def test_index_round_trip(tmp_path):
+    index = build(tmp_path)
+    assert len(index) == 7
+    topics = {index.topic(i): i for i in range(len(index))}
+    assert index.parents(topics["Museums"]) == ["Art", "Culture"]
+    assert index.category(topics["Tennis"]) == "Sports"
+    assert not index.is_stale(str(tmp_path / "topics.txt"))
+
+
+def test_sampler_does_not_repeat_within_a_session(tmp_path):
+    sampler = TopicSampler(build(tmp_path), rng=random.Random(0))
+    first, second = set(), set()
+    assert len({sampler.sample(first) for _ in range(7)}) == 7
+    # Another session's history is its own
+    assert sampler.sample(second) in first
+    assert len(second) == 1
+    # Once every topic is used, repeats are allowed again
+    sampler.sample(first)
+    assert len(first) == 1
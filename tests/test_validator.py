@@ -0,0 +1,51 @@
+import pytest
+
+from bench.bench_validator import corpus, legacy_validate
+from utils import (
+    ExplanationValidator,
+    explanation_validator,
+    parse_correction_explanations,
+)
+
+LINES = [
+    '1 | "es" was changed to "está" because the state is temporary.',
+    '2 | "como" was changed to "cómo" to add the missing Accent',
+    '3 | "Hola" was changed to "¡Hola!" to add exclamation marks',
+    '4 | "hola" was changed to "Hola." because sentences start with a capital',
+    "5 | The change makes the sentence sound more natural",
+    '6 | "voy" was changed to "fui" because the action is in the past',
+    "7 | No changes were needed",
+]
+
+
+def test_agrees_with_the_previous_filter():
+    lines = LINES + corpus(2000)
+    for line, (explanation, failed_check) in zip(
+        lines, explanation_validator.validate_many(lines)
+    ):
+        assert legacy_validate(line) == ("" if failed_check else explanation)
+
+
+@pytest.mark.parametrize(
+    "line, failed_check",
+    [
+        (LINES[0], None),
+        (LINES[1], "Does not contain 'accent'"),
+        (LINES[2], "Does not contain '¡'"),
+        (LINES[3], ExplanationValidator.CHANGE_CHECK),
+        (LINES[4], "Does not contain 'the change'"),
+    ],
+)
+def test_reports_the_failed_check(line, failed_check):
+    assert explanation_validator.validate(line)[1] == failed_check
+
+
+def test_parse_correction_explanations():
+    assert parse_correction_explanations(["\n".join(LINES)]) == (
+        '1. "es" was changed to "está" because the state is temporary\n'
+        '2. "voy" was changed to "fui" because the action is in the past'
+    )
+    assert parse_correction_explanations([LINES[5]]) == (
+        '"voy" was changed to "fui" because the action is in the past'
+    )
+    assert parse_correction_explanations([LINES[4]]) == "No corrections made."
@@ -0,0 +1,58 @@
+from functools import lru_cache
+import logging
+from typing import Any
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken is optional
+    HAVE_TIKTOKEN = False
+else:
+    HAVE_TIKTOKEN = True
+
+logger = logging.getLogger()
+
+# Chat messages carry a few tokens of framing on top of their content
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+# Rough characters-per-token ratio used when tiktoken is unavailable
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str) -> Any:
+    if not HAVE_TIKTOKEN:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The encoding files are downloaded on first use, which can fail offline
+        logger.warning(f"Could not load tokenizer for `{model}`, estimating tokens")
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return max(1, len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def count_single_message_tokens(message: dict, model: str) -> int:
+    return TOKENS_PER_MESSAGE + sum(
+        count_tokens(value, model)
+        for value in message.values()
+        if isinstance(value, str)
+    )
+
+
+def count_message_tokens(messages: list[dict], model: str) -> int:
+    """Local estimate of the prompt tokens OpenAI will bill for `messages`."""
+    return TOKENS_PER_REPLY + sum(
+        count_single_message_tokens(message, model) for message in messages
+    )
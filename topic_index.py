@@ -0,0 +1,408 @@
+"""
+Compiled, memory-mapped catalogue of conversation topics.
+
+`conversation_topics.txt` is an outline: indented `-`/`–` items under headers,
+`Header – item • item` lines (also `→` and `|` separated), standalone section
+headers, and a few lists whose items were run together without separators.
+It is parsed into topics that each keep their parent category, and written to a
+binary index laid out as:
+
+    header | topic records | category table | bucket table | UTF-8 names
+
+Topics are sorted by (category, depth), so each bucket of the same category and
+depth is one contiguous range of records. Sampling a topic, uniformly or
+weighted by category and learner level, is one bucket lookup plus one record
+read. The index stores the size, mtime and hash of the source it was built
+from, and is rebuilt when the source changes.
+"""
+
+from bisect import bisect
+from dataclasses import dataclass
+import hashlib
+from itertools import accumulate
+import logging
+import mmap
+import os
+import random
+import re
+import struct
+import threading
+
+import config
+
+logger = logging.getLogger()
+
+MAGIC = b"TPIX"
+VERSION = 1
+# magic, version, source sha256, source size, source mtime (ns), topic count,
+# category count, bucket count, names offset
+HEADER = struct.Struct("<4sI32sQqIIII")
+# name offset, name length, parent record (-1 for none), category, depth
+RECORD = struct.Struct("<IIiHH")
+# root record of the category
+CATEGORY = struct.Struct("<I")
+# category, depth, first record, record count
+BUCKET = struct.Struct("<HHII")
+
+# Relative weight of topics at each depth of the outline (deeper is more
+# specialised), by learner level; the last weight applies to anything deeper
+LEVEL_DEPTH_WEIGHTS = {
+    "beginner": (4.0, 2.0, 1.0, 0.5),
+    "intermediate": (1.0, 1.0, 1.0, 1.0),
+    "advanced": (0.5, 1.0, 2.0, 4.0),
+}
+
+# Shared by samples that are not given their own generator
+_rng = random.Random()
+
+_ITEM_SEPARATORS = ("•", "→", "|")
+_HEADER_SEPARATOR_REGEX = re.compile(r"\s+[–-]\s+|:\s+")
+_OUTLINE_ITEM_REGEX = re.compile(r"^[-–]\s*")
+_RUN_TOGETHER_REGEX = re.compile(r"(?<=[a-z])(?=[A-Z])")
+# Run-together lists are told apart from headers by how many words they glue
+_RUN_TOGETHER_MIN_ITEMS = 4
+
+
+@dataclass
+class ParsedTopic:
+    name: str
+    parent: int | None
+
+
+def _split_items(text: str) -> list[str]:
+    """Split on item separators outside parentheses."""
+    items: list[str] = []
+    current: list[str] = []
+    depth = 0
+    for char in text:
+        depth += (char == "(") - (char == ")")
+        if depth == 0 and char in _ITEM_SEPARATORS:
+            items.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    items.append("".join(current))
+    return [stripped for item in items if (stripped := item.strip(" ?"))]
+
+
+def parse_topics(text: str) -> list[ParsedTopic]:
+    """Parse the topic outline into topics in file order, each with its parent."""
+    topics: list[ParsedTopic] = []
+
+    def add(name: str, parent: int | None) -> int:
+        topics.append(ParsedTopic(name, parent))
+        return len(topics) - 1
+
+    # (indent, topic) of the open headers in an indented outline
+    outline: list[tuple[int, int]] = []
+    section: int | None = None
+    for raw_line in text.split("\n"):
+        if not raw_line:
+            outline, section = [], None
+            continue
+        line = raw_line.strip()
+        # Markdown headers only title the file
+        if not line or line.startswith(("See also:", "#")):
+            continue
+        if line.startswith("Main article:"):
+            section = add(line.split(":", 1)[1].strip(), None)
+            continue
+
+        indent = len(raw_line) - len(raw_line.lstrip())
+        if indent or _OUTLINE_ITEM_REGEX.match(line):
+            while outline and outline[-1][0] >= indent:
+                outline.pop()
+            parent = outline[-1][1] if outline else section
+            topic = add(_OUTLINE_ITEM_REGEX.sub("", line).strip(), parent)
+            outline.append((indent, topic))
+            continue
+
+        header_match = _HEADER_SEPARATOR_REGEX.search(line)
+        if header_match:
+            header = add(line[: header_match.start()].strip(), section)
+            for item in _split_items(line[header_match.end() :]):
+                add(item, header)
+            continue
+        items = _split_items(line)
+        if len(items) > 1:
+            header = add(items[0], section)
+            for item in items[1:]:
+                add(item, header)
+            continue
+        words = _RUN_TOGETHER_REGEX.split(line)
+        if len(words) >= _RUN_TOGETHER_MIN_ITEMS:
+            for word in words:
+                add(word.strip(), section)
+            continue
+        # A standalone header opens a section for the lines that follow it
+        section = add(line, None)
+        outline = [(0, section)]
+    return topics
+
+
+def _source_signature(source_path: str) -> tuple[bytes, int, int]:
+    with open(source_path, "rb") as file:
+        content = file.read()
+    stat = os.stat(source_path)
+    return hashlib.sha256(content).digest(), stat.st_size, stat.st_mtime_ns
+
+
+def build_index(source_path: str, index_path: str) -> None:
+    """Parse `source_path` and atomically write its binary index to `index_path`."""
+    with open(source_path, "r", encoding="utf-8") as file:
+        topics = parse_topics(file.read())
+    source_hash, source_size, source_mtime = _source_signature(source_path)
+
+    roots, depths = [], []
+    for i in range(len(topics)):
+        root, depth = i, 0
+        while (parent := topics[root].parent) is not None:
+            root, depth = parent, depth + 1
+        roots.append(root)
+        depths.append(depth)
+    categories = list(dict.fromkeys(roots))
+    category_of = {root: i for i, root in enumerate(categories)}
+    order = sorted(
+        range(len(topics)), key=lambda i: (category_of[roots[i]], depths[i], i)
+    )
+    position = {old: new for new, old in enumerate(order)}
+
+    names = bytearray()
+    records = []
+    buckets: list[list[int]] = []
+    for new, old in enumerate(order):
+        topic = topics[old]
+        category, depth = category_of[roots[old]], depths[old]
+        encoded = topic.name.encode("utf-8")
+        records.append(
+            RECORD.pack(
+                len(names),
+                len(encoded),
+                -1 if topic.parent is None else position[topic.parent],
+                category,
+                depth,
+            )
+        )
+        names += encoded
+        if buckets and buckets[-1][:2] == [category, depth]:
+            buckets[-1][3] += 1
+        else:
+            buckets.append([category, depth, new, 1])
+
+    names_offset = (
+        HEADER.size
+        + RECORD.size * len(records)
+        + CATEGORY.size * len(categories)
+        + BUCKET.size * len(buckets)
+    )
+    temp_path = f"{index_path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                source_hash,
+                source_size,
+                source_mtime,
+                len(records),
+                len(categories),
+                len(buckets),
+                names_offset,
+            )
+        )
+        file.writelines(records)
+        file.writelines(CATEGORY.pack(position[root]) for root in categories)
+        file.writelines(BUCKET.pack(*bucket) for bucket in buckets)
+        file.write(names)
+    os.replace(temp_path, index_path)
+    logger.info(
+        f"Indexed {len(records)} topics in {len(categories)} categories to `{index_path}`"
+    )
+
+
+class TopicIndex:
+    """Read-only view of a topic index file, memory-mapped."""
+
+    def __init__(self, index_path: str):
+        with open(index_path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            self.source_hash,
+            self.source_size,
+            self.source_mtime,
+            self.topic_count,
+            category_count,
+            bucket_count,
+            self._names_offset,
+        ) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"`{index_path}` is not a version {VERSION} topic index")
+        self._records_offset = HEADER.size
+        categories_offset = self._records_offset + RECORD.size * self.topic_count
+        buckets_offset = categories_offset + CATEGORY.size * category_count
+        # The category and bucket tables are tiny, so they are read up front
+        self.categories = [
+            self.topic(CATEGORY.unpack_from(self._mmap, offset)[0])
+            for offset in range(categories_offset, buckets_offset, CATEGORY.size)
+        ]
+        self._buckets = [
+            BUCKET.unpack_from(self._mmap, buckets_offset + i * BUCKET.size)
+            for i in range(bucket_count)
+        ]
+        self._cumulative_weights: dict[tuple, list[float]] = {}
+
+    def __len__(self) -> int:
+        return self.topic_count
+
+    def _record(self, i: int) -> tuple[int, int, int, int, int]:
+        return RECORD.unpack_from(self._mmap, self._records_offset + i * RECORD.size)
+
+    def topic(self, i: int) -> str:
+        name_offset, name_length, *_ = self._record(i)
+        start = self._names_offset + name_offset
+        return self._mmap[start : start + name_length].decode("utf-8")
+
+    def category(self, i: int) -> str:
+        return self.categories[self._record(i)[3]]
+
+    def parents(self, i: int) -> list[str]:
+        """The categories `i` sits under, nearest first."""
+        parents = []
+        while (i := self._record(i)[2]) != -1:
+            parents.append(self.topic(i))
+        return parents
+
+    def is_stale(self, source_path: str) -> bool:
+        stat = os.stat(source_path)
+        if (stat.st_size, stat.st_mtime_ns) == (self.source_size, self.source_mtime):
+            return False
+        return _source_signature(source_path)[0] != self.source_hash
+
+    def _bucket_weights(
+        self, category_weights: dict[str, float] | None, level: str | None
+    ) -> list[float]:
+        key = (tuple(sorted((category_weights or {}).items())), level)
+        if key not in self._cumulative_weights:
+            depth_weights = LEVEL_DEPTH_WEIGHTS.get(level or "", (1.0,))
+            self._cumulative_weights[key] = list(
+                accumulate(
+                    count
+                    * (category_weights or {}).get(self.categories[category], 1.0)
+                    * depth_weights[min(depth, len(depth_weights) - 1)]
+                    for category, depth, _, count in self._buckets
+                )
+            )
+        return self._cumulative_weights[key]
+
+    def sample(
+        self,
+        rng: random.Random | None = None,
+        category_weights: dict[str, float] | None = None,
+        level: str | None = None,
+    ) -> int:
+        """
+        A random topic. `category_weights` multiply the chance of picking
+        topics in the named categories (others weigh 1), and `level` favours
+        broad topics for beginners and specialised ones for advanced learners.
+        """
+        rng = rng or _rng
+        if not category_weights and not level:
+            return rng.randrange(self.topic_count)
+        cumulative = self._bucket_weights(category_weights, level)
+        bucket = bisect(cumulative, rng.random() * cumulative[-1])
+        _, _, first, count = self._buckets[min(bucket, len(self._buckets) - 1)]
+        return first + rng.randrange(count)
+
+
+class TopicSampler:
+    """
+    Samples topics without repeating a name in `seen` (a learner's session, say)
+    until every topic is in it. Rejection sampling keeps each draw O(1) on
+    average; only once nearly every topic has been seen does it fall back to
+    scanning for one that has not.
+    """
+
+    MAX_ATTEMPTS = 32
+
+    def __init__(
+        self,
+        index: TopicIndex,
+        category_weights: dict[str, float] | None = None,
+        level: str | None = None,
+        rng: random.Random | None = None,
+    ):
+        self.index = index
+        self.category_weights = category_weights
+        self.level = level
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def sample(self, seen: set[str] | None = None) -> str:
+        """A topic not in `seen`, which it is then added to."""
+        seen = set() if seen is None else seen
+        with self._lock:
+            for _ in range(self.MAX_ATTEMPTS):
+                topic = self.index.topic(
+                    self.index.sample(self.rng, self.category_weights, self.level)
+                )
+                if topic not in seen:
+                    break
+            else:
+                topic = self._unseen_topic(seen)
+            seen.add(topic)
+            return topic
+
+    def _unseen_topic(self, seen: set[str]) -> str:
+        start = self.rng.randrange(len(self.index))
+        for offset in range(len(self.index)):
+            topic = self.index.topic((start + offset) % len(self.index))
+            if topic not in seen:
+                return topic
+        logger.info("Every topic has been used, allowing repeats again")
+        seen.clear()
+        return self.index.topic(start)
+
+
+def parse_weights(weights: str) -> dict[str, float]:
+    """Parse `name=weight,name=weight` into a dict."""
+    parsed = {}
+    for item in weights.split(","):
+        if "=" in item:
+            name, value = item.rsplit("=", 1)
+            parsed[name.strip()] = float(value)
+    return parsed
+
+
+def load_index(
+    source_path: str = config.TOPIC_SOURCE_PATH,
+    index_path: str = config.TOPIC_INDEX_PATH,
+) -> TopicIndex:
+    """Open the index, first rebuilding it if it is missing or out of date."""
+    try:
+        index = TopicIndex(index_path)
+        if not index.is_stale(source_path):
+            return index
+        logger.info(f"`{source_path}` has changed, rebuilding topic index...")
+    except (OSError, ValueError, struct.error):
+        logger.info(f"Building topic index `{index_path}`...")
+    build_index(source_path, index_path)
+    return TopicIndex(index_path)
+
+
+_sampler: TopicSampler | None = None
+_sampler_lock = threading.Lock()
+
+
+def topic_sampler() -> TopicSampler:
+    """The shared sampler, reloaded if the source changes."""
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None or _sampler.index.is_stale(config.TOPIC_SOURCE_PATH):
+            _sampler = TopicSampler(
+                load_index(),
+                category_weights=parse_weights(config.TOPIC_CATEGORY_WEIGHTS),
+                level=config.TOPIC_LEVEL or None,
+            )
+        return _sampler
@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import atexit
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+import queue
+import random
+import statistics
+import threading
+import time
+from typing import Any, Iterator
+import urllib.request
+
+import config
+
+logger = logging.getLogger()
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Spans are exported in batches of up to this many, at least this often
+EXPORT_BATCH_SIZE = 512
+EXPORT_INTERVAL_SECONDS = 1.0
+
+_STOP = object()
+
+
+def configure_logging(level: str = config.LOG_LEVEL) -> None:
+    """Configure the root logger once, for the process's entry point."""
+    logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT, level=level)
+
+
+@dataclass
+class Span:
+    """A timed operation, such as a handler stage or an API call, within a trace."""
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int = 0
+    status: str = "ok"
+    error: str | None = None
+    # The root of the trace, which collects its spans as they end
+    root: "Span | None" = field(default=None, repr=False)
+    children: list["Span"] = field(default_factory=list, repr=False)
+
+    sampled = True
+
+    @property
+    def duration(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        span = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+        if self.error is not None:
+            span["error"] = self.error
+        return span
+
+
+class _UnsampledSpan:
+    """Stands in for every span of a trace that is not sampled, at no cost."""
+
+    sampled = False
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+UNSAMPLED = _UnsampledSpan()
+
+_current_span: ContextVar[Span | _UnsampledSpan | None] = ContextVar(
+    "current_span", default=None
+)
+
+
+class JsonLinesExporter:
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list[Span]) -> None:
+        with open(self.path, "a", encoding="utf-8") as file:
+            for span in spans:
+                file.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpExporter:
+    """Sends spans to an OpenTelemetry collector using OTLP/HTTP with JSON."""
+
+    def __init__(self, endpoint: str, service_name: str = config.TRACE_SERVICE_NAME):
+        endpoint = endpoint.rstrip("/")
+        if not endpoint.endswith("/v1/traces"):
+            endpoint += "/v1/traces"
+        self.endpoint = endpoint
+        self.service_name = service_name
+
+    def _span(self, span: Span) -> dict:
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in span.attributes.items()
+                if value is not None
+            ],
+            "status": (
+                {"code": 2, "message": span.error or span.status}
+                if span.status != "ok"
+                else {"code": 1}
+            ),
+        }
+        if span.parent_id is not None:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def export(self, spans: list[Span]) -> None:
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [self._span(span) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=5):
+            pass
+
+
+class Tracer:
+    """
+    Records spans for handler stages and API calls. Whether a trace is kept is
+    decided once, at its root span, with probability `sample_rate`; spans of
+    traces that are not kept cost next to nothing. Kept spans are exported in
+    batches from a background thread to a JSON-lines file at `path` and/or an
+    OpenTelemetry collector at `otlp_endpoint`, and any traced turn that takes
+    longer than `slow_turn_seconds` is logged with its slowest stage.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = config.TRACE_SAMPLE_RATE,
+        path: str = config.TRACE_PATH,
+        otlp_endpoint: str = config.TRACE_OTLP_ENDPOINT,
+        slow_turn_seconds: float = config.TRACE_SLOW_TURN_SECONDS,
+    ):
+        self.sample_rate = sample_rate
+        self.slow_turn_seconds = slow_turn_seconds
+        self.exporters: list[JsonLinesExporter | OtlpExporter] = []
+        if path:
+            self.exporters.append(JsonLinesExporter(path))
+        if otlp_endpoint:
+            self.exporters.append(OtlpExporter(otlp_endpoint))
+        self.enabled = sample_rate > 0 and bool(self.exporters or slow_turn_seconds)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span | _UnsampledSpan]:
+        """
+        Time the enclosed block as a child of the current span, or as the root of
+        a new trace. Tasks started inside the block inherit the span as their
+        parent.
+        """
+        parent = _current_span.get()
+        if parent is None:
+            span = (
+                Span(name, os.urandom(16).hex(), os.urandom(8).hex(), None, attributes)
+                if self.enabled and random.random() < self.sample_rate
+                else UNSAMPLED
+            )
+        elif isinstance(parent, Span):
+            span = Span(
+                name,
+                parent.trace_id,
+                os.urandom(8).hex(),
+                parent.span_id,
+                attributes,
+                root=parent.root or parent,
+            )
+        else:
+            yield UNSAMPLED
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            if isinstance(span, Span):
+                span.status = "cancelled"
+            raise
+        except BaseException as e:
+            if isinstance(span, Span):
+                span.status = "error"
+                span.error = repr(e)
+            raise
+        finally:
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # Ended from another context, e.g. an abandoned async generator
+                pass
+            if isinstance(span, Span):
+                self._end(span)
+
+    def _end(self, span: Span) -> None:
+        span.end_ns = time.time_ns()
+        if span.root is not None:
+            span.root.children.append(span)
+        elif self.slow_turn_seconds and span.duration >= self.slow_turn_seconds:
+            self._log_slow_trace(span)
+        if self.exporters:
+            self._queue.put(span)
+            self._ensure_thread()
+
+    def _log_slow_trace(self, root: Span) -> None:
+        stages = [child for child in root.children if child.name.startswith("stage.")]
+        if not stages:
+            logger.info("Slow %s took %.2fs", root.name, root.duration)
+            return
+        slowest = max(stages, key=lambda child: child.duration)
+        logger.info(
+            "Slow %s took %.2fs, slowest stage `%s` took %.2fs (trace %s)",
+            root.name,
+            root.duration,
+            slowest.name[len("stage.") :],
+            slowest.duration,
+            root.trace_id,
+        )
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._export_forever, name="trace-exporter", daemon=True
+                )
+                self._thread.start()
+
+    def _export_forever(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            flush_at = time.monotonic() + EXPORT_INTERVAL_SECONDS
+            while batch[-1] is not _STOP and len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(
+                        self._queue.get(timeout=max(0, flush_at - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is _STOP
+            spans = [span for span in batch if span is not _STOP]
+            for exporter in self.exporters:
+                try:
+                    if spans:
+                        exporter.export(spans)
+                except Exception:
+                    logger.warning(
+                        "Could not export %d spans with %s",
+                        len(spans),
+                        type(exporter).__name__,
+                        exc_info=True,
+                    )
+            if stopping:
+                return
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Export any spans still queued."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+
+tracer = Tracer()
+atexit.register(tracer.close)
+
+
+def summarise(path: str) -> list[dict]:
+    """Duration statistics per span name from an exported JSON-lines file."""
+    durations: dict[str, list[float]] = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            span = json.loads(line)
+            durations.setdefault(span["name"], []).append(span["duration_ms"])
+    rows = []
+    for name, values in durations.items():
+        values.sort()
+        rows.append(
+            {
+                "name": name,
+                "count": len(values),
+                "mean_ms": statistics.mean(values),
+                "p95_ms": values[min(len(values) - 1, int(0.95 * len(values)))],
+                "total_ms": sum(values),
+            }
+        )
+    return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Summarise span durations from a JSON-lines trace file."
+    )
+    parser.add_argument("path", nargs="?", default=config.TRACE_PATH or "traces.jsonl")
+    args = parser.parse_args()
+    print(f"{'span':<36}{'count':>8}{'mean ms':>10}{'p95 ms':>10}{'total ms':>12}")
+    for row in summarise(args.path):
+        print(
+            f"{row['name']:<36}{row['count']:>8}{row['mean_ms']:>10.1f}"
+            f"{row['p95_ms']:>10.1f}{row['total_ms']:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,18 @@
+import json
 import logging
 import re
 import string
-from typing import Callable
 
 from unidecode import unidecode
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level=logging.DEBUG,
-)
+import metrics
+
 logger = logging.getLogger()
 
+precheck_counters = metrics.counters(
+    "correction_precheck", "checks", "identical", "short_circuits"
+)
+
 PHRASES_TO_CHECK = [
     "¿",
     "¡",
@@ -28,73 +29,152 @@ PHRASES_TO_CHECK = [
 ]
 
 
-def _check_closure(phrase: str) -> Callable:
-    return lambda x: phrase not in x.lower()
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
 
 
-def _change_with_punctuation_or_accent_only(s: str) -> bool:
-    match = re.search(r'"(.+?)" was changed to "(.+?)"', s)
-    if match:
-        x, y = match.groups()
-        x_clean = (
-            unidecode(x).translate(str.maketrans("", "", string.punctuation)).lower()
-        )
-        y_clean = (
-            unidecode(y).translate(str.maketrans("", "", string.punctuation)).lower()
-        )
-        return x_clean != y_clean
-    return True
+def normalise_for_comparison(s: str) -> str:
+    return unidecode(s).translate(_PUNCTUATION_TABLE).lower()
 
 
-named_checks = [
-    ("Does not contain '" + phrase + "'", _check_closure(phrase))
-    for phrase in PHRASES_TO_CHECK
-]
-named_checks.append(
-    ("Change with punctuation or accent only", _change_with_punctuation_or_accent_only)
-)
+def correction_is_trivial(input_str: str, corrected_str: str) -> bool:
+    """
+    Whether a correction only changes punctuation, accents or capitalisation.
+    orig_handler's explanation filter drops every explanation of such a change
+    anyway, but new_handler does not filter its explanations, so there skipping
+    them hides accent-only fixes like "anos" -> "años" from the learner.
+    Whitespace is collapsed as well, because removing punctuation can leave
+    double spaces.
+    """
+    precheck_counters.increment("checks")
+    if input_str.strip() == corrected_str.strip():
+        precheck_counters.increment("identical")
+        precheck_counters.increment("short_circuits")
+        return True
+    if (
+        normalise_for_comparison(input_str).split()
+        == normalise_for_comparison(corrected_str).split()
+    ):
+        precheck_counters.increment("short_circuits")
+        return True
+    return False
 
 
-def validated_correction_explanation(correction_explanation: str) -> str:
-    logger.debug(f"Parsing correction explanation `{correction_explanation}`")
-    correction_explanation = correction_explanation.split("|")[1].strip(" .")
-
-    logger.debug(
-        f"Checking correction explanation `{correction_explanation}` for filter phrases"
-    )
-    for name, check in named_checks:
-        if not check(correction_explanation):
+class ExplanationValidator:
+    """
+    Filters out correction explanations that only concern punctuation, accents
+    or the correction itself. All filter phrases are matched in a single scan of
+    the lowercased explanation, and patterns are compiled once up front.
+    """
+
+    CHANGE_CHECK = "Change with punctuation or accent only"
+
+    def __init__(self, phrases: list[str] = PHRASES_TO_CHECK):
+        # Longest first, so the reported phrase is the most specific match
+        self._phrase_pattern = re.compile(
+            "|".join(
+                re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True)
+            )
+        )
+        self._change_pattern = re.compile(r'"(.+?)" was changed to "(.+?)"')
+
+    def failed_check(self, explanation: str) -> str | None:
+        """Name of the first check `explanation` fails, or None if it passes."""
+        match = self._phrase_pattern.search(explanation.lower())
+        if match:
+            return f"Does not contain '{match.group()}'"
+        match = self._change_pattern.search(explanation)
+        if match:
+            x, y = match.groups()
+            if normalise_for_comparison(x) == normalise_for_comparison(y):
+                return self.CHANGE_CHECK
+        return None
+
+    def validate(self, line: str) -> tuple[str, str | None]:
+        """Parse a `number | explanation` line and check it."""
+        explanation = line.split("|")[1].strip(" .")
+        failed_check = self.failed_check(explanation)
+        if failed_check and logger.isEnabledFor(logging.DEBUG):
             logger.debug(
-                f"Correction explanation `{correction_explanation}` fails check `{name}`"
+                "Correction explanation `%s` fails check `%s`",
+                explanation,
+                failed_check,
             )
-            return ""
+        return explanation, failed_check
+
+    def validate_many(self, lines: list[str]) -> list[tuple[str, str | None]]:
+        return [self.validate(line) for line in lines]
+
+
+explanation_validator = ExplanationValidator()
+
+
+def validated_correction_explanation(correction_explanation: str) -> str:
+    explanation, failed_check = explanation_validator.validate(correction_explanation)
+    return "" if failed_check else explanation
+
+
+def validated_explanations(correction_explanations: list[str]) -> list[str]:
+    """The explanations on the `number | explanation` lines that pass every check."""
+    lines = [y for x in correction_explanations for y in x.split("\n") if "|" in y]
+    return [
+        explanation
+        for explanation, failed_check in explanation_validator.validate_many(lines)
+        if explanation and not failed_check
+    ]
+
+
+def format_explanations(explanations: list[str]) -> str:
+    if len(explanations) == 0:
+        return "No corrections made."
+    elif len(explanations) == 1:
+        return explanations[0]
     else:
-        logger.debug(
-            f"Correction explanation `{correction_explanation}` passes all checks"
-        )
-        return correction_explanation
+        return "\n".join([f"{i}. {x}" for i, x in enumerate(explanations, 1)])
 
 
 def parse_correction_explanations(
     correction_explanations: list[str], validate: bool = True
 ) -> str:
     if validate:
-        validated_correction_explanations = [
-            validated_correction_explanation(y)
-            for x in correction_explanations
-            for y in x.split("\n")
-            if "|" in y
-        ]
-        validated_correction_explanations = [
-            x for x in validated_correction_explanations if x
+        correction_explanations = validated_explanations(correction_explanations)
+    return format_explanations(correction_explanations)
+
+
+def batched(items: list, size: int) -> list[list]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def explanations_function_definition(count: int, description: str) -> dict:
+    """Function-calling schema for a request that returns `count` explanations."""
+    return {
+        "name": "receive_outputs",
+        "description": "A function that receives outputs",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "correction_explanations": {
+                    "type": "array",
+                    "minItems": count,
+                    "maxItems": count,
+                    "items": {
+                        "type": "string",
+                    },
+                    "description": description,
+                },
+            },
+            "required": [
+                "correction_explanations",
+            ],
+        },
+    }
+
+
+def parse_explanations_function_call(message: dict) -> list[str]:
+    """The explanations from a response to a request made with the schema above."""
+    try:
+        return json.loads(message["function_call"]["arguments"])[
+            "correction_explanations"
         ]
-    else:
-        validated_correction_explanations = correction_explanations
-    if len(validated_correction_explanations) == 0:
-        return "No corrections made."
-    elif len(validated_correction_explanations) == 1:
-        return validated_correction_explanations[0]
-    else:
-        return "\n".join(
-            [f"{i}. {x}" for i, x in enumerate(validated_correction_explanations, 1)]
-        )
+    except (KeyError, TypeError, ValueError):
+        logger.warning("Could not parse batched correction explanations")
+        return []